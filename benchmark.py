@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+#
+# Benchmark suite for the hot paths of gpl_to_html.py: parsing, Color objects,
+# unique color counting, HTML rendering, linkify() and the whole script; and
+# for the image remapping of quantize_image.py.
+#
+# Results can be saved as JSON and compared against a previously saved
+# baseline; the exit status is 1 if anything got slower than the tolerance, or
+# if a command took longer to start than its budget:
+#
+#   ./benchmark.py --save baseline.json
+#   (change something)
+#   ./benchmark.py --baseline baseline.json
+
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import timeit
+from collections import namedtuple
+from html import escape
+from math import ceil
+from textwrap import dedent
+
+from gpl_to_html import Color, FrozenColor, GimpPalette, clamp_to_byte, linkify, palette_to_html
+
+
+# Palettes from this repository used by the parser and render benchmarks.
+PARSER_PALETTES = [
+    'palettes/Pantone-Graphic-Designers.gpl',
+    'palettes/Pantone-Industrial-Designers.gpl',
+    'palettes/Pantone.gpl',
+    'palettes/RAL.gpl',
+]
+RENDER_PALETTES = [
+    'palettes/HW-NES.gpl',
+    'palettes/RHLPixels_2015-11-21_A.gpl',
+    'palettes/Pantone.gpl',
+    'palettes/RAL.gpl',
+    'palettes/Pantone-Graphic-Designers.gpl',
+]
+
+# One measurement: the best time of a single run, in seconds.
+Result = namedtuple('Result', 'name colors seconds')
+
+
+def best_time(func, repeat):
+    '''Returns the best wall time of a single call to func, in seconds.'''
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def write_synthetic_palette(filename, size):
+    '''Writes a palette with size random colors, always the same ones.'''
+    rng = random.Random(size)
+    with open(filename, 'w') as f:
+        f.write('GIMP Palette\nName: Synthetic {0}\nColumns: 32\n# Generated by benchmark.py\n'.format(size))
+        for i in range(size):
+            f.write('{0:3d} {1:3d} {2:3d}\tColor {3}\n'.format(
+                rng.randrange(256), rng.randrange(256), rng.randrange(256), i))
+
+
+def legacy_palette_to_html(pal):
+    # The original implementation, kept for comparison.
+    cols = pal.columns or 16
+    return dedent('''\
+        <article class="palette">
+            <h1 class="name"><a href="{filename}">{name}</a></h1>
+            <p class="properties">{cols}x{rows} ({len} colors, {len_unique} unique)</p>
+            {comments}
+            <table class="colors">{colors}</table>
+        </article>
+    ''').strip().format(
+        filename=escape(pal.filename),
+        name=escape(pal.name),
+        cols=cols,
+        rows=(ceil(len(pal.colors) / cols)),
+        len=len(pal.colors),
+        len_unique=pal.how_many_unique_colors(),
+        comments='\n'.join(
+            '<p class="comment">{0}</p>'.format(linkify(escape(comment)))
+            for comment in pal.comments
+        ),
+        colors=''.join(
+            '<tr>{line}</tr>'.format(line=''.join(
+                dedent('''\
+                    <td
+                    class="color"
+                    style="background-color:{color.prrggbb}"
+                    title="{name}
+                    {color.pRRGGBB}
+                    {color.r}, {color.g}, {color.b}"
+                    ></td>
+                ''').strip().format(
+                    name=escape(color.name),
+                    color=color
+                )
+                for color in pal.colors[offset:offset + cols]
+            )) for offset in range(0, len(pal.colors), cols)
+        ),
+    )
+
+
+def legacy_parse_palette(f, filename):
+    # The original line-based parser, kept for comparison.
+    pal = GimpPalette()
+    pal.filename = filename
+
+    lineno = 1
+    header_magic = next(f)
+    assert header_magic.strip() == 'GIMP Palette', '{0}: Incorrect header at the first line'.format(filename)
+
+    rgb = pal.rgb
+    color_names = pal.color_names
+    for line in f:
+        lineno += 1
+        if line.startswith('Name:'):
+            pal.name = line.partition('Name:')[2].strip()
+        elif line.startswith('Columns:'):
+            pal.columns = int(line.partition('Columns:')[2].strip())
+        elif line.startswith('Channels:'):
+            # Present in Aseprite palette, ignored here.
+            pass
+        else:
+            line = line.strip()
+            if line.startswith('#'):
+                pal.comments.append(line[1:].strip())
+            elif line:
+                splitted = line.split(maxsplit=3)
+                if len(splitted) == 3:
+                    splitted.append('Untitled')
+                assert len(splitted) == 4, 'Invalid line at {0}:{1}'.format(filename, lineno)
+
+                r, g, b, name = splitted
+                rgb.append(clamp_to_byte(int(r)))
+                rgb.append(clamp_to_byte(int(g)))
+                rgb.append(clamp_to_byte(int(b)))
+                color_names.append(name.strip())
+
+    if pal.name == '':
+        pal.name = os.path.basename(filename)
+
+    return pal
+
+
+def bench_parser(options):
+    '''The original line-based parser and mmap-based new_from_filename().'''
+    def legacy(path):
+        with open(path) as f:
+            return legacy_parse_palette(f, path)
+
+    for path in PARSER_PALETTES:
+        label = os.path.basename(path)
+        pal = GimpPalette.new_from_filename(path)
+        old = legacy(path)
+        if (old.name, old.columns, old.comments, old.rgb, old.color_names) != (
+                pal.name, pal.columns, pal.comments, pal.rgb, pal.color_names):
+            raise AssertionError('Different result for {0}'.format(path))
+        count = len(pal.colors)
+        yield Result('parser/legacy/' + label, count, best_time(lambda: legacy(path), options.repeat))
+        yield Result('parser/mmap/' + label, count, best_time(lambda: GimpPalette.new_from_filename(path), options.repeat))
+
+
+def bench_render(options):
+    '''The original palette_to_html() and the precompiled templates.'''
+    for path in RENDER_PALETTES:
+        label = os.path.basename(path)
+        pal = GimpPalette.new_from_filename(path)
+        if legacy_palette_to_html(pal) != palette_to_html(pal):
+            raise AssertionError('Different output for {0}'.format(path))
+        count = len(pal.colors)
+        yield Result('render/legacy/' + label, count, best_time(lambda: legacy_palette_to_html(pal), options.repeat))
+        yield Result('render/templates/' + label, count, best_time(lambda: palette_to_html(pal), options.repeat))
+
+
+def bench_synthetic(options):
+    '''Parsing, unique counting and rendering of large synthetic palettes.'''
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in options.sizes:
+            path = os.path.join(tmp, 'synthetic-{0}.gpl'.format(size))
+            write_synthetic_palette(path, size)
+            pal = GimpPalette.new_from_filename(path)
+            yield Result('synthetic/parse/{0}'.format(size), size, best_time(lambda: GimpPalette.new_from_filename(path), options.repeat))
+            yield Result('synthetic/unique/{0}'.format(size), size, best_time(pal.how_many_unique_colors, options.repeat))
+            yield Result('synthetic/render/{0}'.format(size), size, best_time(lambda: palette_to_html(pal), options.repeat))
+
+
+def bench_color(options):
+    '''Color construction and hexadecimal properties, per 1000 colors.'''
+    rng = random.Random(1000)
+    triples = [(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(1000)]
+    strings = ['#{0:02x}{1:02x}{2:02x}'.format(*t) for t in triples]
+    colors = [Color(*t) for t in triples]
+    values = [hash(c) for c in colors]
+    frozen = [c.frozen() for c in colors]
+    cases = [
+        ('color/init-rgb', lambda: [Color(r, g, b) for r, g, b in triples]),
+        ('color/init-hex', lambda: [Color(s) for s in strings]),
+        ('color/prrggbb', lambda: [c.prrggbb for c in colors]),
+        ('color/pRRGGBB', lambda: [c.pRRGGBB for c in colors]),
+        ('color/hash', lambda: set(colors)),
+        ('color/from-int', lambda: [Color.from_int(v) for v in values]),
+        ('color/from-hex', lambda: [Color.from_hex(s) for s in strings]),
+        ('color/frozen-from-int', lambda: [FrozenColor.from_int(v) for v in values]),
+        ('color/frozen-prrggbb', lambda: [c.prrggbb for c in frozen]),
+        ('color/frozen-hash', lambda: set(frozen)),
+    ]
+    for name, func in cases:
+        yield Result(name, len(triples), best_time(func, options.repeat))
+
+
+def bench_linkify(options):
+    '''linkify() over all comments of all palettes in this repository.'''
+    comments = [
+        escape(comment)
+        for path in sorted(glob.glob('palettes/*.gpl'))
+        for comment in GimpPalette.new_from_filename(path).comments
+    ]
+    yield Result('linkify/all-comments', 0, best_time(lambda: [linkify(c) for c in comments], options.repeat))
+
+
+def bench_quantize(options):
+    '''quantize_image.py over a synthetic 512x512 image with DawnBringer's 32
+    colors: building the lookup table, then remapping with each dithering.
+    The count is in pixels; megapixels per second are count / time (ms) / 1000.
+    '''
+    import quantize_image
+
+    width = height = 512
+    pixels = bytes(
+        channel
+        for y in range(height)
+        for x in range(width)
+        for channel in ((x * 255) // width, (y * 255) // height, (x ^ y) & 255)
+    )
+    rgb = GimpPalette.new_from_filename('palettes/DawnBringer32.gpl').rgb
+    yield Result('quantize/table/5-bits', len(rgb) // 3, best_time(lambda: quantize_image.NearestColorTable.build(rgb, bits=5), options.repeat))
+    table = quantize_image.NearestColorTable.build(rgb, bits=5)
+    for name, dither in sorted(quantize_image.DITHERING.items()):
+        yield Result('quantize/remap/' + name, width * height, best_time(lambda: dither(pixels, width, 3, table), options.repeat))
+
+
+def bench_main(options):
+    '''The whole gpl_to_html.py script over palettes/*.gpl, as a new process.'''
+    paths = sorted(glob.glob('palettes/*.gpl'))
+    count = sum(len(GimpPalette.new_from_filename(path).colors) for path in paths)
+    command = [sys.executable, 'gpl_to_html.py', '-o', os.devnull] + paths
+    yield Result('main/serial', count, best_time(lambda: subprocess.run(command, check=True), options.repeat))
+
+
+# Most time a command may take to start, over a bare interpreter, as a
+# multiple of the time of that bare interpreter, so that the budgets hold on
+# slower and faster machines alike. They leave about twice the time measured
+# when they were set.
+STARTUP_BUDGETS = {
+    'startup/palette.py-help': 0.5,
+    'startup/palette.py-hex2rgb': 0.5,
+    'startup/palette.py-sort': 4.0,
+    'startup/palette.py-html': 5.0,
+}
+
+
+def bench_startup(options):
+    '''Time to run trivial commands through palette.py, as new processes,
+    over the time of a bare "python3 -c pass". Each one must stay within its
+    budget in STARTUP_BUDGETS, relative to that bare time. The scripts run
+    directly are measured too, for comparison.
+    '''
+    small = 'palettes/DawnBringer16.gpl'
+    commands = [
+        ('palette.py-help', ['palette.py', '--help'], None),
+        ('palette.py-hex2rgb', ['palette.py', 'hex2rgb'], os.devnull),
+        ('palette.py-sort', ['palette.py', 'sort'], small),
+        ('palette.py-html', ['palette.py', 'html', '-o', os.devnull, small], None),
+        ('sort_by_hue.py', ['sort_by_hue.py'], small),
+        ('gpl_to_html.py', ['gpl_to_html.py', '-o', os.devnull, small], None),
+    ]
+
+    def run(command, stdin):
+        with open(stdin or os.devnull, 'rb') as f:
+            subprocess.run([sys.executable] + command, stdin=f, stdout=subprocess.DEVNULL, check=True)
+
+    bare = best_time(lambda: subprocess.run([sys.executable, '-c', 'pass'], check=True), options.repeat)
+    yield Result('startup/python', 0, bare)
+    for name, command, stdin in commands:
+        seconds = best_time(lambda: run(command, stdin), options.repeat)
+        yield Result('startup/' + name, 0, max(0.0, seconds - bare))
+
+
+BENCHMARKS = {
+    'parser': bench_parser,
+    'render': bench_render,
+    'synthetic': bench_synthetic,
+    'color': bench_color,
+    'linkify': bench_linkify,
+    'quantize': bench_quantize,
+    'startup': bench_startup,
+    'main': bench_main,
+}
+
+
+def compare(results, baseline, tolerance):
+    '''Returns (result, baseline seconds or None, problem) tuples, where the
+    problem is 'REGRESSION', 'OVER BUDGET' or an empty string.
+
+    >>> results = [Result('startup/python', 0, 0.020), Result('startup/palette.py-sort', 0, 0.070),
+    ...            Result('startup/palette.py-html', 0, 0.110)]
+    >>> [problem for _, _, problem in compare(results, {}, 0.1)]
+    ['', '', 'OVER BUDGET']
+    '''
+    bare = None
+    for result in results:
+        if result.name == 'startup/python':
+            bare = result.seconds
+        previous = baseline.get(result.name, {}).get('seconds')
+        if previous is not None and result.seconds > previous * (1 + tolerance):
+            problem = 'REGRESSION'
+        elif bare is not None and result.seconds > STARTUP_BUDGETS.get(result.name, float('inf')) * bare:
+            problem = 'OVER BUDGET'
+        else:
+            problem = ''
+        yield result, previous, problem
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Runs the benchmark suite of gpl_to_html.py',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-r', '--repeat',
+        type=int,
+        default=5,
+        help='How many times each measurement is repeated (the best one is kept)'
+    )
+    parser.add_argument(
+        '--sizes',
+        type=lambda value: [int(size) for size in value.split(',')],
+        default='10000,100000,1000000',
+        help='Comma-separated sizes of the synthetic palettes'
+    )
+    parser.add_argument(
+        '--save',
+        metavar='FILE',
+        help='Write the results to this JSON file'
+    )
+    parser.add_argument(
+        '--baseline',
+        metavar='FILE',
+        help='Compare against results previously saved with --save'
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.25,
+        help='Relative slowdown over the baseline reported as a regression'
+    )
+    parser.add_argument(
+        'benchmarks',
+        nargs='*',
+        help='Benchmarks to run, from: {0} (default: all)'.format(', '.join(BENCHMARKS))
+    )
+    options = parser.parse_args()
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {0!r}'.format(name))
+    return options
+
+
+def main():
+    options = parse_args()
+    # The benchmarks use paths relative to the repository.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results = []
+    regressions = 0
+    print('{0:<52} {1:>8} {2:>11} {3:>11} {4:>7}'.format(
+        'benchmark', 'colors', 'time (ms)', 'base (ms)', 'ratio'))
+    for name in options.benchmarks or BENCHMARKS:
+        for result, previous, problem in compare(BENCHMARKS[name](options), baseline, options.tolerance):
+            results.append(result)
+            regressions += bool(problem)
+            print('{0:<52} {1:>8} {2:>11.3f} {3:>11} {4:>7}{5}'.format(
+                result.name,
+                result.colors,
+                result.seconds * 1000,
+                '' if previous is None else '{0:.3f}'.format(previous * 1000),
+                '' if previous is None else '{0:.2f}'.format(result.seconds / previous),
+                '  ' + problem if problem else '',
+            ))
+            sys.stdout.flush()
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.platform(),
+                'results': {
+                    result.name: {'colors': result.colors, 'seconds': result.seconds}
+                    for result in results
+                },
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if regressions:
+        print('{0} benchmarks slower than the baseline by more than {1:.0%}, or over their budget'.format(regressions, options.tolerance))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+# Conversions from 8-bit sRGB colors to other color spaces.
+#
+# The scalar functions receive the three components as integers in 0..255
+# range and return a tuple of three floats. The batch functions convert a
+# whole packed RGB buffer (such as GimpPalette.rgb) at once, using NumPy when
+# it is installed. Run "python3 -m doctest colorspaces.py" to test this module.
+
+from colorsys import rgb_to_hls as _rgb_to_hls, rgb_to_hsv as _rgb_to_hsv
+
+# https://en.wikipedia.org/wiki/SRGB
+# https://en.wikipedia.org/wiki/CIELAB_color_space
+# https://bottosson.github.io/posts/oklab/
+
+
+def srgb_to_linear(value):
+    '''Converts one sRGB component from 0.0..1.0 to linear light.
+
+    >>> srgb_to_linear(0.0)
+    0.0
+    >>> srgb_to_linear(1.0)
+    1.0
+    >>> round(srgb_to_linear(0.5), 6)
+    0.214041
+    '''
+    if value <= 0.04045:
+        return value / 12.92
+    return ((value + 0.055) / 1.055) ** 2.4
+
+
+# Linear value of every possible 8-bit component.
+LINEAR_TABLE = tuple(srgb_to_linear(i / 255) for i in range(256))
+
+# Reference white (D65) used by CIELAB.
+D65_WHITE = (0.95047, 1.0, 1.08883)
+
+
+def rgb_to_rgb(r, g, b):
+    '''Returns the components unchanged, as floats.
+
+    >>> rgb_to_rgb(1, 2, 3)
+    (1.0, 2.0, 3.0)
+    '''
+    return (float(r), float(g), float(b))
+
+
+def rgb_to_linear(r, g, b):
+    '''Converts to linear-light RGB, each component in 0.0..1.0 range.
+
+    >>> rgb_to_linear(255, 0, 0)
+    (1.0, 0.0, 0.0)
+    '''
+    return (LINEAR_TABLE[r], LINEAR_TABLE[g], LINEAR_TABLE[b])
+
+
+def rgb_to_xyz(r, g, b):
+    '''Converts to CIE XYZ (D65), with Y in 0.0..1.0 range.
+
+    >>> [round(v, 4) for v in rgb_to_xyz(255, 255, 255)]
+    [0.9505, 1.0, 1.0888]
+    '''
+    r, g, b = LINEAR_TABLE[r], LINEAR_TABLE[g], LINEAR_TABLE[b]
+    return (
+        0.4124564 * r + 0.3575761 * g + 0.1804375 * b,
+        0.2126729 * r + 0.7151522 * g + 0.0721750 * b,
+        0.0193339 * r + 0.1191920 * g + 0.9503041 * b,
+    )
+
+
+def _lab_f(t):
+    if t > 216 / 24389:
+        return t ** (1 / 3)
+    return t * 841 / 108 + 4 / 29
+
+
+def rgb_to_lab(r, g, b):
+    '''Converts to CIELAB (D65), with L in 0..100 range.
+
+    >>> round(rgb_to_lab(255, 255, 255)[0], 2)
+    100.0
+    >>> [round(v, 2) for v in rgb_to_lab(255, 0, 0)]
+    [53.24, 80.09, 67.2]
+    '''
+    x, y, z = rgb_to_xyz(r, g, b)
+    fx = _lab_f(x / D65_WHITE[0])
+    fy = _lab_f(y / D65_WHITE[1])
+    fz = _lab_f(z / D65_WHITE[2])
+    return (116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz))
+
+
+def rgb_to_oklab(r, g, b):
+    '''Converts to OKLab, with L in 0.0..1.0 range.
+
+    >>> [round(v, 4) for v in rgb_to_oklab(255, 255, 255)]
+    [1.0, 0.0, 0.0]
+    >>> [round(v, 4) for v in rgb_to_oklab(0, 0, 255)]
+    [0.452, -0.0325, -0.3115]
+    '''
+    r, g, b = LINEAR_TABLE[r], LINEAR_TABLE[g], LINEAR_TABLE[b]
+    l = (0.4122214708 * r + 0.5363325363 * g + 0.0514459929 * b) ** (1 / 3)
+    m = (0.2119034982 * r + 0.6806995451 * g + 0.1073969566 * b) ** (1 / 3)
+    s = (0.0883024619 * r + 0.2817188376 * g + 0.6299787005 * b) ** (1 / 3)
+    return (
+        0.2104542553 * l + 0.7936177850 * m - 0.0040720468 * s,
+        1.9779984951 * l - 2.4285922050 * m + 0.4505937099 * s,
+        0.0259040371 * l + 0.7827717662 * m - 0.8086757660 * s,
+    )
+
+
+def rgb_to_hls(r, g, b):
+    '''Converts to hue, lightness and saturation, all in 0.0..1.0 range.
+
+    >>> rgb_to_hls(255, 0, 0)
+    (0.0, 0.5, 1.0)
+    '''
+    return _rgb_to_hls(r / 255, g / 255, b / 255)
+
+
+def rgb_to_hsv(r, g, b):
+    '''Converts to hue, saturation and value, all in 0.0..1.0 range.
+
+    >>> rgb_to_hsv(0, 0, 255)
+    (0.6666666666666666, 1.0, 1.0)
+    '''
+    return _rgb_to_hsv(r / 255, g / 255, b / 255)
+
+
+# Conversion function for each supported color space name.
+CONVERTERS = {
+    'hls': rgb_to_hls,
+    'hsv': rgb_to_hsv,
+    'rgb': rgb_to_rgb,
+    'linear': rgb_to_linear,
+    'xyz': rgb_to_xyz,
+    'lab': rgb_to_lab,
+    'oklab': rgb_to_oklab,
+}
+
+
+def convert(space, r, g, b):
+    '''Converts one color to the named color space.
+
+    >>> convert('rgb', 0, 128, 255)
+    (0.0, 128.0, 255.0)
+    >>> convert('hsl', 0, 0, 0)
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown color space 'hsl'
+    '''
+    return _get_converter(space)(r, g, b)
+
+
+def _get_converter(space):
+    try:
+        return CONVERTERS[space]
+    except KeyError:
+        raise ValueError('Unknown color space {0!r}'.format(space)) from None
+
+
+def have_numpy():
+    '''Returns whether NumPy is installed, importing it on the first call.'''
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy is not False
+
+
+# Set by have_numpy(). Not imported up front, as it is slow to import.
+numpy = None
+
+# Smallest buffer, in colors, for which convert_all() imports NumPy.
+NUMPY_IMPORT_MIN_COLORS = 65536
+
+
+def convert_all(space, rgb):
+    '''Converts all colors of a packed RGB buffer, returning a list of tuples.
+
+    Uses NumPy when it is installed, and plain Python otherwise. Both agree
+    up to floating-point rounding: NumPy sums the matrix products in another
+    order, so xyz, lab and oklab may differ in the last few bits (about 1e-13
+    for lab).
+
+    >>> convert_all('hls', bytes([255, 0, 0, 0, 0, 0]))
+    [(0.0, 0.5, 1.0), (0.0, 0.0, 0.0)]
+    >>> [[round(v, 2) for v in lab] for lab in convert_all('lab', b'\\xff\\x00\\x00')]
+    [[53.24, 80.09, 67.2]]
+    '''
+    converter = _get_converter(space)
+    # Importing NumPy takes as long as converting some 65536 colors without
+    # it, so smaller buffers only use it if it was already imported.
+    if len(rgb) >= 3 * (64 if numpy else NUMPY_IMPORT_MIN_COLORS) and have_numpy():
+        return list(map(tuple, convert_array(space, rgb).tolist()))
+    return list(map(converter, rgb[0::3], rgb[1::3], rgb[2::3]))
+
+
+def convert_array(space, rgb):
+    '''Converts all colors of a packed RGB buffer into a (N, 3) float64
+    NumPy array. Requires NumPy.
+
+    The results match the plain Python converters up to rounding:
+
+    >>> from math import isclose
+    >>> rgb = bytes(range(256)) * 3 + bytes(range(255, 0, -7)) * 3
+    >>> for space in (CONVERTERS if have_numpy() else ()):
+    ...     expected = map(CONVERTERS[space], rgb[0::3], rgb[1::3], rgb[2::3])
+    ...     for p, q in zip(expected, convert_array(space, rgb).tolist()):
+    ...         assert all(isclose(a, b, rel_tol=1e-12, abs_tol=1e-12) for a, b in zip(p, q)), (space, p, q)
+    '''
+    _get_converter(space)
+    if not have_numpy():
+        raise ImportError('convert_array() requires NumPy')
+    pixels = numpy.frombuffer(rgb, dtype=numpy.uint8).reshape(-1, 3)
+    return _NUMPY_CONVERTERS[space](pixels)
+
+
+def _np_rgb(pixels):
+    return pixels.astype(numpy.float64)
+
+
+def _np_linear(pixels):
+    return numpy.array(LINEAR_TABLE)[pixels]
+
+
+def _np_xyz(pixels):
+    return _np_linear(pixels) @ numpy.array([
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]).T
+
+
+def _np_lab(pixels):
+    t = _np_xyz(pixels) / numpy.array(D65_WHITE)
+    f = numpy.where(t > 216 / 24389, numpy.cbrt(t), t * 841 / 108 + 4 / 29)
+    fx, fy, fz = f[:, 0], f[:, 1], f[:, 2]
+    return numpy.stack([116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz)], axis=1)
+
+
+def _np_oklab(pixels):
+    lms = numpy.cbrt(_np_linear(pixels) @ numpy.array([
+        [0.4122214708, 0.5363325363, 0.0514459929],
+        [0.2119034982, 0.6806995451, 0.1073969566],
+        [0.0883024619, 0.2817188376, 0.6299787005],
+    ]).T)
+    return lms @ numpy.array([
+        [0.2104542553, 0.7936177850, -0.0040720468],
+        [1.9779984951, -2.4285922050, 0.4505937099],
+        [0.0259040371, 0.7827717662, -0.8086757660],
+    ]).T
+
+
+def _np_hue(rgb, maxc, rangec):
+    '''Hue as computed by colorsys, for colors where rangec is not zero.'''
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    safe_range = numpy.where(rangec == 0, 1.0, rangec)
+    rc = (maxc - r) / safe_range
+    gc = (maxc - g) / safe_range
+    bc = (maxc - b) / safe_range
+    h = numpy.where(r == maxc, bc - gc, numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = (h / 6.0) % 1.0
+    return numpy.where(rangec == 0, 0.0, h)
+
+
+def _np_hls(pixels):
+    rgb = pixels / 255.0
+    maxc = rgb.max(axis=1)
+    minc = rgb.min(axis=1)
+    sumc = maxc + minc
+    rangec = maxc - minc
+    l = sumc / 2.0
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        s = numpy.where(l <= 0.5, rangec / sumc, rangec / (2.0 - maxc - minc))
+    s = numpy.where(rangec == 0, 0.0, s)
+    return numpy.stack([_np_hue(rgb, maxc, rangec), l, s], axis=1)
+
+
+def _np_hsv(pixels):
+    rgb = pixels / 255.0
+    maxc = rgb.max(axis=1)
+    minc = rgb.min(axis=1)
+    rangec = maxc - minc
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        s = numpy.where(maxc == 0, 0.0, rangec / maxc)
+    return numpy.stack([_np_hue(rgb, maxc, rangec), s, maxc], axis=1)
+
+
+_NUMPY_CONVERTERS = {
+    'hls': _np_hls,
+    'hsv': _np_hsv,
+    'rgb': _np_rgb,
+    'linear': _np_linear,
+    'xyz': _np_xyz,
+    'lab': _np_lab,
+    'oklab': _np_oklab,
+}
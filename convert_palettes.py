@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+#
+# Converts GIMP palettes to other palette formats, and back.
+#
+# Each format in FORMATS has a reader, from the bytes of a file to a
+# GimpPalette, and a writer, from a GimpPalette to a binary file object.
+# Every source is parsed once and then written in all requested formats.
+# Supporting another format is a matter of adding an entry to FORMATS.
+#
+# Formats:
+#
+#   gpl   GIMP Palette
+#   ase   Adobe Swatch Exchange, with one group per palette
+#   aco   Adobe Photoshop color swatches, version 1 followed by version 2
+#   pal   JASC-PAL, as used by Paint Shop Pro and Aseprite (no color names)
+#   hex   one RRGGBB per line, as in lospec.com (no color names)
+#   json  {"name", "columns", "comments", "colors": [{"name", "hex"}]}
+
+import argparse
+import colorsys
+import glob
+import json
+import os.path
+import re
+import struct
+import sys
+from collections import namedtuple
+
+from gpl_to_html import GimpPalette, GimpPaletteError, expand_palette_sources, load_palette_source
+
+
+PaletteFormat = namedtuple('PaletteFormat', 'extension description read write')
+
+
+def _new_palette(filename, name=''):
+    pal = GimpPalette()
+    pal.filename = filename or ''
+    pal.name = name or os.path.splitext(os.path.basename(pal.filename))[0]
+    return pal
+
+
+def _to_byte(value):
+    '''Converts a component from 0.0..1.0 to 0..255, rounding and clamping.'''
+    return min(255, max(0, round(value * 255)))
+
+
+# GIMP Palette
+
+def read_gpl(data, filename=None):
+    return GimpPalette.new_from_bytes(data, filename=filename)
+
+
+def write_gpl(pal, f):
+    f.write(b'GIMP Palette\n')
+    f.write('Name: {0}\n'.format(pal.name).encode('utf-8'))
+    if pal.columns:
+        f.write('Columns: {0}\n'.format(pal.columns).encode('utf-8'))
+    for comment in pal.comments:
+        f.write('# {0}\n'.format(comment).encode('utf-8'))
+    rgb = pal.rgb
+    f.writelines(
+        '{0:3d} {1:3d} {2:3d}\t{3}\n'.format(rgb[3 * i], rgb[3 * i + 1], rgb[3 * i + 2], name).encode('utf-8')
+        for i, name in enumerate(pal.color_names)
+    )
+
+
+# Adobe Swatch Exchange
+# http://www.selapa.net/swatches/colors/fileformats.php#adobe_ase
+
+ASE_MAGIC = b'ASEF'
+ASE_GROUP_START = 0xc001
+ASE_GROUP_END = 0xc002
+ASE_COLOR = 0x0001
+ASE_NORMAL_COLOR = 2
+_ASE_BLOCK = struct.Struct('>HI')
+
+
+def _ase_string(text):
+    encoded = (text + '\0').encode('utf-16-be')
+    return struct.pack('>H', len(encoded) // 2) + encoded
+
+
+def _ase_block(block_type, payload):
+    return _ASE_BLOCK.pack(block_type, len(payload)) + payload
+
+
+def read_ase(data, filename=None):
+    '''Reads all colors of a swatch exchange file into one palette, named
+    after its first group.
+
+    >>> import io
+    >>> pal = GimpPalette.new_from_bytes(b'GIMP Palette\\nName: Foo\\n1 2 3 One\\n255 255 255\\n')
+    >>> f = io.BytesIO(); write_ase(pal, f)
+    >>> pal = read_ase(f.getvalue(), 'foo.ase')
+    >>> pal.name, list(pal.colors)
+    ('Foo', [NamedColor(1, 2, 3, name='One'), NamedColor(255, 255, 255, name='Untitled')])
+    '''
+    if data[:4] != ASE_MAGIC:
+        raise GimpPaletteError('Not an Adobe Swatch Exchange file', filename)
+    pal = _new_palette(filename)
+    group_name = None
+    offset = 12
+    try:
+        (count,) = struct.unpack_from('>I', data, 8)
+        for _ in range(count):
+            block_type, length = _ASE_BLOCK.unpack_from(data, offset)
+            offset += _ASE_BLOCK.size
+            block = data[offset:offset + length]
+            offset += length
+            if block_type not in (ASE_GROUP_START, ASE_COLOR):
+                continue
+            (name_length,) = struct.unpack_from('>H', block)
+            name = block[2:2 + 2 * name_length].decode('utf-16-be').rstrip('\0')
+            if block_type == ASE_GROUP_START:
+                if group_name is None:
+                    group_name = name
+                continue
+
+            model = block[2 + 2 * name_length:6 + 2 * name_length]
+            values_offset = 6 + 2 * name_length
+            if model == b'RGB ':
+                r, g, b = struct.unpack_from('>3f', block, values_offset)
+            elif model == b'Gray':
+                (r,) = struct.unpack_from('>f', block, values_offset)
+                g = b = r
+            elif model == b'CMYK':
+                c, m, y, k = struct.unpack_from('>4f', block, values_offset)
+                r, g, b = ((1 - c) * (1 - k), (1 - m) * (1 - k), (1 - y) * (1 - k))
+            else:
+                raise GimpPaletteError('Unsupported color model {0!r}'.format(model.decode('latin-1')), filename)
+            pal.add_color(_to_byte(r), _to_byte(g), _to_byte(b), name or 'Untitled')
+    except (struct.error, UnicodeDecodeError) as e:
+        raise GimpPaletteError('Truncated or corrupt file: {0}'.format(e), filename) from e
+    if group_name:
+        pal.name = group_name
+    return pal
+
+
+def write_ase(pal, f):
+    count = len(pal.color_names)
+    f.write(ASE_MAGIC + struct.pack('>HHI', 1, 0, count + 2))
+    f.write(_ase_block(ASE_GROUP_START, _ase_string(pal.name)))
+    rgb = pal.rgb
+    for i, name in enumerate(pal.color_names):
+        f.write(_ase_block(ASE_COLOR, b''.join((
+            _ase_string(name),
+            b'RGB ',
+            struct.pack('>3fH', rgb[3 * i] / 255, rgb[3 * i + 1] / 255, rgb[3 * i + 2] / 255, ASE_NORMAL_COLOR),
+        ))))
+    f.write(_ase_block(ASE_GROUP_END, b''))
+
+
+# Adobe Photoshop color swatches
+# https://www.adobe.com/devnet-apps/photoshop/fileformatashtml/#50577411_pgfId-1055819
+
+ACO_RGB = 0
+ACO_HSB = 1
+ACO_CMYK = 2
+ACO_GRAY = 8
+_ACO_COLOR = struct.Struct('>5H')
+
+
+def _aco_to_rgb(space, w, x, y, z, filename):
+    if space == ACO_RGB:
+        return w / 65535, x / 65535, y / 65535
+    if space == ACO_HSB:
+        return colorsys.hsv_to_rgb(w / 65536, x / 65535, y / 65535)
+    if space == ACO_CMYK:
+        # Components are stored inverted: 0 is 100% ink.
+        return w * z / 65535 ** 2, x * z / 65535 ** 2, y * z / 65535 ** 2
+    if space == ACO_GRAY:
+        gray = 1 - w / 10000
+        return gray, gray, gray
+    raise GimpPaletteError('Unsupported color space {0}'.format(space), filename)
+
+
+def read_aco(data, filename=None):
+    '''Reads a swatches file, taking the names from its version 2 section.
+
+    >>> import io
+    >>> pal = GimpPalette.new_from_bytes(b'GIMP Palette\\n1 2 3 One\\n255 255 255\\n')
+    >>> f = io.BytesIO(); write_aco(pal, f)
+    >>> list(read_aco(f.getvalue(), 'foo.aco').colors)
+    [NamedColor(1, 2, 3, name='One'), NamedColor(255, 255, 255, name='Untitled')]
+    '''
+    pal = _new_palette(filename)
+    try:
+        version, count = struct.unpack_from('>HH', data)
+        if version not in (1, 2):
+            raise GimpPaletteError('Not an Adobe color swatches file', filename)
+        offset = 4
+        if version == 1:
+            # Skips to the version 2 section, if there is one.
+            end = offset + count * _ACO_COLOR.size
+            if len(data) >= end + 4 and struct.unpack_from('>H', data, end)[0] == 2:
+                version, count = struct.unpack_from('>HH', data, end)
+                offset = end + 4
+        for _ in range(count):
+            space, w, x, y, z = _ACO_COLOR.unpack_from(data, offset)
+            offset += _ACO_COLOR.size
+            name = 'Untitled'
+            if version == 2:
+                (name_length,) = struct.unpack_from('>I', data, offset)
+                name = data[offset + 4:offset + 4 + 2 * name_length].decode('utf-16-be').rstrip('\0') or name
+                offset += 4 + 2 * name_length
+            r, g, b = _aco_to_rgb(space, w, x, y, z, filename)
+            pal.add_color(_to_byte(r), _to_byte(g), _to_byte(b), name)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise GimpPaletteError('Truncated or corrupt file: {0}'.format(e), filename) from e
+    return pal
+
+
+def write_aco(pal, f):
+    rgb = pal.rgb
+    count = len(pal.color_names)
+    colors = [
+        _ACO_COLOR.pack(ACO_RGB, rgb[i] * 257, rgb[i + 1] * 257, rgb[i + 2] * 257, 0)
+        for i in range(0, 3 * count, 3)
+    ]
+    f.write(struct.pack('>HH', 1, count))
+    f.writelines(colors)
+    f.write(struct.pack('>HH', 2, count))
+    for color, name in zip(colors, pal.color_names):
+        encoded = (name + '\0').encode('utf-16-be')
+        f.write(color + struct.pack('>I', len(encoded) // 2) + encoded)
+
+
+# JASC-PAL
+
+def read_jasc_pal(data, filename=None):
+    '''Reads a JASC-PAL file.
+
+    >>> list(read_jasc_pal(b'JASC-PAL\\r\\n0100\\r\\n2\\r\\n1 2 3\\r\\n255 255 255\\r\\n').colors)
+    [NamedColor(1, 2, 3, name='Untitled'), NamedColor(255, 255, 255, name='Untitled')]
+    '''
+    lines = bytes(data).decode('ascii', 'replace').splitlines()
+    if len(lines) < 3 or lines[0].strip() != 'JASC-PAL':
+        raise GimpPaletteError('Incorrect header at the first line', filename, 1)
+    pal = _new_palette(filename)
+    for lineno, line in enumerate(lines[3:], 4):
+        if not line.strip():
+            continue
+        try:
+            r, g, b = map(int, line.split()[:3])
+        except ValueError:
+            raise GimpPaletteError('Invalid line', filename, lineno) from None
+        pal.add_color(r, g, b)
+    return pal
+
+
+def write_jasc_pal(pal, f):
+    rgb = pal.rgb
+    count = len(pal.color_names)
+    f.write('JASC-PAL\r\n0100\r\n{0}\r\n'.format(count).encode('ascii'))
+    f.writelines(
+        '{0} {1} {2}\r\n'.format(rgb[i], rgb[i + 1], rgb[i + 2]).encode('ascii')
+        for i in range(0, 3 * count, 3)
+    )
+
+
+# Plain list of hex colors
+
+_HEX_LINE_RE = re.compile(r'^\s*#?([0-9a-fA-F]{6}|[0-9a-fA-F]{3})\b\s*(.*?)\s*$')
+
+
+def read_hex(data, filename=None):
+    '''Reads one color per line, as RRGGBB or #RGB, optionally followed by a
+    name. Blank lines and lines starting with ; or // are skipped.
+
+    >>> list(read_hex(b'ff0000\\n#0f0 Green\\n\\n; comment\\n').colors)
+    [NamedColor(255, 0, 0, name='Untitled'), NamedColor(0, 255, 0, name='Green')]
+    '''
+    pal = _new_palette(filename)
+    for lineno, line in enumerate(bytes(data).decode('utf-8').splitlines(), 1):
+        stripped = line.strip()
+        if not stripped or stripped.startswith((';', '//')):
+            continue
+        match = _HEX_LINE_RE.match(line)
+        if not match:
+            raise GimpPaletteError('Invalid line', filename, lineno)
+        value, name = match.groups()
+        if len(value) == 3:
+            value = value[0] * 2 + value[1] * 2 + value[2] * 2
+        rgb = bytes.fromhex(value)
+        pal.add_color(rgb[0], rgb[1], rgb[2], name or 'Untitled')
+    return pal
+
+
+def write_hex(pal, f):
+    rgb = bytes(pal.rgb)
+    f.writelines(
+        rgb[i:i + 3].hex().encode('ascii') + b'\n'
+        for i in range(0, len(rgb), 3)
+    )
+
+
+# JSON
+
+def read_json(data, filename=None):
+    try:
+        value = json.loads(bytes(data).decode('utf-8'))
+        pal = _new_palette(filename, value.get('name', ''))
+        pal.columns = int(value.get('columns', 0))
+        pal.comments = [str(comment) for comment in value.get('comments', [])]
+        for color in value['colors']:
+            rgb = bytes.fromhex(color['hex'].lstrip('#'))
+            pal.add_color(rgb[0], rgb[1], rgb[2], color.get('name') or 'Untitled')
+    except (ValueError, KeyError, TypeError, AttributeError, IndexError) as e:
+        raise GimpPaletteError('Invalid palette JSON: {0}'.format(e), filename) from e
+    return pal
+
+
+def write_json(pal, f):
+    rgb = bytes(pal.rgb)
+    json_text = json.dumps({
+        'name': pal.name,
+        'columns': pal.columns,
+        'comments': pal.comments,
+        'colors': [
+            {'name': name, 'hex': '#' + rgb[3 * i:3 * i + 3].hex()}
+            for i, name in enumerate(pal.color_names)
+        ],
+    }, ensure_ascii=False, indent=1)
+    f.write(json_text.encode('utf-8'))
+    f.write(b'\n')
+
+
+FORMATS = {
+    'gpl': PaletteFormat('.gpl', 'GIMP Palette', read_gpl, write_gpl),
+    'ase': PaletteFormat('.ase', 'Adobe Swatch Exchange', read_ase, write_ase),
+    'aco': PaletteFormat('.aco', 'Adobe Photoshop color swatches', read_aco, write_aco),
+    'pal': PaletteFormat('.pal', 'JASC-PAL', read_jasc_pal, write_jasc_pal),
+    'hex': PaletteFormat('.hex', 'list of hex colors', read_hex, write_hex),
+    'json': PaletteFormat('.json', 'JSON', read_json, write_json),
+}
+
+
+def format_of(filename):
+    '''Returns the name of the format of a file, from its extension.
+
+    >>> format_of('palettes/Tango.gpl'), format_of('foo.ASE')
+    ('gpl', 'ase')
+    '''
+    extension = os.path.splitext(filename)[1].lower()
+    for name, palette_format in FORMATS.items():
+        if palette_format.extension == extension:
+            return name
+    raise ValueError('{0}: unknown palette format'.format(filename))
+
+
+def read_palette(source):
+    '''Reads a palette in any known format, or from a compiled collection.'''
+    if not isinstance(source, str) or source.endswith('.gpl'):
+        return load_palette_source(source)
+    with open(source, 'rb') as f:
+        data = f.read()
+    return FORMATS[format_of(source)].read(data, source)
+
+
+def output_filenames(stem, output, formats):
+    return [
+        os.path.join(output.format(format=name), stem + FORMATS[name].extension)
+        for name in formats
+    ]
+
+
+def _is_up_to_date(filename, source_mtime_ns):
+    try:
+        return os.stat(filename).st_mtime_ns >= source_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def convert_palette(source, output, formats, changed_only=False):
+    '''Reads one palette and writes it in each of the formats, under the
+    output directory, where {format} is replaced by the format name.
+
+    Returns (source, written filenames, error message). With changed_only,
+    outputs newer than the source are left alone, and the source is not even
+    parsed if all of them are.
+    '''
+    if isinstance(source, str):
+        source_filename = source
+        stem = os.path.splitext(os.path.basename(source))[0]
+    else:
+        source_filename = source.collection
+        stem = None
+
+    try:
+        pending = formats
+        if changed_only:
+            source_mtime_ns = os.stat(source_filename).st_mtime_ns
+            if stem is not None:
+                pending = [
+                    name for name, filename in zip(formats, output_filenames(stem, output, formats))
+                    if not _is_up_to_date(filename, source_mtime_ns)
+                ]
+            if not pending:
+                return (source, [], None)
+
+        pal = read_palette(source)
+        if stem is None:
+            stem = os.path.splitext(os.path.basename(pal.filename))[0]
+            if changed_only:
+                pending = [
+                    name for name, filename in zip(formats, output_filenames(stem, output, formats))
+                    if not _is_up_to_date(filename, source_mtime_ns)
+                ]
+
+        written = []
+        for name, filename in zip(pending, output_filenames(stem, output, pending)):
+            directory = os.path.dirname(filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Writing to a temporary file first, so that an interrupted run
+            # never leaves a truncated palette behind.
+            temporary = '{0}.{1}.tmp'.format(filename, os.getpid())
+            with open(temporary, 'wb') as f:
+                FORMATS[name].write(pal, f)
+            os.replace(temporary, filename)
+            written.append(filename)
+        return (source, written, None)
+    except (OSError, ValueError) as e:
+        return (source, [], str(e))
+
+
+def _convert_palette_star(args):
+    return convert_palette(*args)
+
+
+def convert_palettes(sources, output, formats, changed_only=False, jobs=1):
+    '''Converts many palettes, in parallel with jobs processes (0 means one
+    per CPU). Yields the results of convert_palette() as they complete, in
+    the order of the sources.
+    '''
+    sources = expand_palette_sources(sources)
+    tasks = [(source, output, formats, changed_only) for source in sources]
+    if jobs == 1 or len(tasks) < 2:
+        yield from map(_convert_palette_star, tasks)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(
+            _convert_palette_star,
+            tasks,
+            chunksize=max(1, len(tasks) // (4 * jobs)),
+        )
+
+
+def parse_args():
+    default_palettes = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'palettes', '*.gpl')
+    parser = argparse.ArgumentParser(
+        description='Converts palettes between GIMP Palette and other formats',
+        epilog='Formats: ' + '; '.join(
+            '{0}: {1} (*{2})'.format(name, palette_format.description, palette_format.extension)
+            for name, palette_format in FORMATS.items()
+        ) + '. Each source is parsed once and written in all the requested'
+        ' formats. Sources can be in any of these formats, or be directories'
+        ' of *.gpl files, or compiled collections (*.gplpack).',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-f', '--format',
+        dest='formats',
+        action='append',
+        choices=list(FORMATS),
+        help='Format to write; can be given many times (default: all but gpl)'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        metavar='DIR',
+        default=os.path.join('converted', '{format}'),
+        help='Directory for the converted files; {format} is replaced by the'
+        ' format name'
+    )
+    parser.add_argument(
+        '--changed-only',
+        action='store_true',
+        help='Skip outputs that are newer than their source'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Convert in this many processes (0 means one per CPU)'
+    )
+    parser.add_argument(
+        '-q', '--quiet',
+        action='store_true',
+        help='Only report errors'
+    )
+    parser.add_argument(
+        'palettes',
+        nargs='*',
+        default=sorted(glob.glob(default_palettes)),
+        help='Palette files, directories with *.gpl files, or compiled'
+        ' collections (*.gplpack)'
+    )
+    options = parser.parse_args()
+    if not options.formats:
+        options.formats = [name for name in FORMATS if name != 'gpl']
+    options.formats = list(dict.fromkeys(options.formats))
+    for filename in options.palettes:
+        if os.path.isfile(filename) and not filename.endswith('.gplpack'):
+            try:
+                format_of(filename)
+            except ValueError as e:
+                parser.error(str(e))
+    return options
+
+
+def main():
+    options = parse_args()
+
+    failed = False
+    for source, written, error in convert_palettes(
+        options.palettes,
+        options.output,
+        options.formats,
+        changed_only=options.changed_only,
+        jobs=options.jobs,
+    ):
+        if error:
+            failed = True
+            sys.stderr.write('{0}\n'.format(error))
+        elif not options.quiet:
+            for filename in written:
+                print('Wrote {0}'.format(filename))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
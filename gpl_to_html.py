@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
+import io
+import mmap
 import os.path
 import re
 import sys
+import time
 from collections import namedtuple
+from collections.abc import Sequence
 from html import escape
 from math import ceil
 from textwrap import dedent
@@ -31,6 +35,49 @@ def clamp_to_byte(value):
     return min(255, max(0, value))
 
 
+class GimpPaletteError(ValueError):
+    '''Raised when a GIMP Palette file cannot be parsed.
+
+    >>> str(GimpPaletteError('Invalid line', 'foo.gpl', 3))
+    'foo.gpl:3: Invalid line'
+    >>> str(GimpPaletteError('Not a palette', 'foo.ase'))
+    'foo.ase: Not a palette'
+    '''
+
+    def __init__(self, message, filename=None, lineno=None):
+        if lineno is None:
+            super().__init__('{0}: {1}'.format(filename, message))
+        else:
+            super().__init__('{0}:{1}: {2}'.format(filename, lineno, message))
+        self.message = message
+        self.filename = filename
+        self.lineno = lineno
+
+
+# Matches one whole line of a *.gpl file, after the "GIMP Palette" header.
+# Exactly one of the alternatives matches each line, the last one being the
+# catch-all for invalid lines. Only ASCII whitespace separates the numbers of
+# a color: unlike str.split(), other Unicode whitespace such as U+00A0 makes
+# the line invalid. Both parsers of GimpPalette use this expression.
+_GPL_LINE_RE = re.compile(rb'''
+    ^(?:
+        (?P<key>Name|Columns|Channels):(?P<value>[^\n]*)
+    |
+        [ \t\r\f\v]*(?P<comment>\#[^\n]*)
+    |
+        [ \t\r\f\v]*
+        (?P<r>[-+]?[0-9]+)[ \t\r\f\v]+
+        (?P<g>[-+]?[0-9]+)[ \t\r\f\v]+
+        (?P<b>[-+]?[0-9]+)
+        (?:[ \t\r\f\v]+(?P<name>[^\n]*))?
+    |
+        [ \t\r\f\v]*
+    |
+        (?P<invalid>[^\n]+)
+    )$
+''', re.MULTILINE | re.VERBOSE)
+
+
 def ignore_comments(f):
     for line in f:
         if line.strip() and not line.strip().startswith('#'):
@@ -111,6 +158,12 @@ class Color:
     def __init__(self, r=None, g=None, b=None):
         '''Can be Initialized with three integers, or with a single string.
         '''
+        if r is not None and g is not None and b is not None:
+            self._r = clamp_to_byte(int(r))
+            self._g = clamp_to_byte(int(g))
+            self._b = clamp_to_byte(int(b))
+            return
+
         self._r = 0
         self._g = 0
         self._b = 0
@@ -126,12 +179,41 @@ class Color:
             if g is None and b is not None:
                 raise ValueError(
                     'Either pass all three parameters, or pass only one')
-            if g is not None:  # and b is not None
-                self.r = r
-                self.g = g
-                self.b = b
-            else:
-                self.set(r)
+            self.set(r)
+
+    @classmethod
+    def from_int(cls, value):
+        '''Builds a color from a 0xRRGGBB integer, without any validation.
+
+        >>> Color.from_int(0x7fff00)
+        Color(127, 255, 0)
+        '''
+        color = cls.__new__(cls)
+        color._r = value >> 16
+        color._g = value >> 8 & 0xff
+        color._b = value & 0xff
+        return color
+
+    @classmethod
+    def from_bytes(cls, data, offset=0):
+        '''Builds a color from three bytes (R, G, B) at the offset of a
+        bytes-like object, such as GimpPalette.rgb.
+
+        >>> Color.from_bytes(b'\\x00\\x7f\\xff\\x00', 1)
+        Color(127, 255, 0)
+        '''
+        return cls.from_int(int.from_bytes(data[offset:offset + 3], 'big'))
+
+    @classmethod
+    def from_hex(cls, value):
+        '''Builds a color from a 'rrggbb' or '#rrggbb' string. Unlike
+        Color(value), the short '#rgb' form is not accepted and the string
+        is not validated.
+
+        >>> Color.from_hex('#7FFF00')
+        Color(127, 255, 0)
+        '''
+        return cls.from_int(int(value[-6:], 16))
 
     def __str__(self):
         return self.prrggbb
@@ -146,7 +228,7 @@ class Color:
         return not self.__eq__(other)
 
     def __hash__(self):
-        return self.r << 16 | self.g << 8 | self.b
+        return self._r << 16 | self._g << 8 | self._b
 
     def __bool__(self):
         '''Black is false, everything else is true.
@@ -223,7 +305,7 @@ class Color:
     @property
     def rrggbb(self):
         '''The color as rrggbb hexadecimal string.'''
-        return ''.join([self.rr, self.gg, self.bb])
+        return '{0:02x}{1:02x}{2:02x}'.format(self._r, self._g, self._b)
 
     @rrggbb.setter
     def rrggbb(self, value):
@@ -240,7 +322,7 @@ class Color:
     @property
     def RRGGBB(self):
         '''The color as RRGGBB hexadecimal string.'''
-        return ''.join([self.RR, self.GG, self.BB])
+        return '{0:02X}{1:02X}{2:02X}'.format(self._r, self._g, self._b)
 
     @RRGGBB.setter
     def RRGGBB(self, value):
@@ -249,7 +331,7 @@ class Color:
     @property
     def prrggbb(self):
         '''The color as #rrggbb hexadecimal string.'''
-        return '#' + self.rrggbb
+        return '#{0:02x}{1:02x}{2:02x}'.format(self._r, self._g, self._b)
 
     @prrggbb.setter
     def prrggbb(self, value):
@@ -262,7 +344,7 @@ class Color:
     @property
     def pRRGGBB(self):
         '''The color as #RRGGBB hexadecimal string.'''
-        return '#' + self.RRGGBB
+        return '#{0:02X}{1:02X}{2:02X}'.format(self._r, self._g, self._b)
 
     @pRRGGBB.setter
     def pRRGGBB(self, value):
@@ -281,6 +363,110 @@ class Color:
         '''
         return 'rgb({self.r},{space}{self.g},{space}{self.b})'.format(self=self, space=space)
 
+    def frozen(self):
+        '''Returns the shared FrozenColor with the same value.'''
+        return FrozenColor.from_int(hash(self))
+
+
+class FrozenColor(Color):
+    '''Immutable Color, backed by a single 0xRRGGBB integer, with its
+    hexadecimal string computed once. There is a single, shared instance for
+    each value, so equal frozen colors are the same object.
+
+    The per-component slots inherited from Color are left unused.
+
+    >>> FrozenColor(255, 0, 0) is FrozenColor('#f00') is Color(255, 0, 0).frozen()
+    True
+    >>> red = FrozenColor.from_int(0xff0000)
+    >>> red
+    FrozenColor(255, 0, 0)
+    >>> red.r, red.g, red.b, red['b'], list(red)
+    (255, 0, 0, 0, [255, 0, 0])
+    >>> red.prrggbb, red.RRGGBB, red.gg, red.as_gpl()
+    ('#ff0000', 'FF0000', '00', '255   0   0')
+    >>> red == Color(255, 0, 0), red == FrozenColor(0, 0, 255), Color(255, 0, 0) == red
+    (True, False, True)
+    >>> FrozenColor.from_hex('00ff00') is FrozenColor.from_bytes(b'\\x00\\xff\\x00')
+    True
+    >>> red.r = 0
+    Traceback (most recent call last):
+        ...
+    AttributeError: FrozenColor is immutable
+    >>> import copy, pickle
+    >>> pickle.loads(pickle.dumps(red)) is copy.deepcopy(red) is red
+    True
+    '''
+
+    __slots__ = ('_value', '_hex')
+
+    # All instances ever created, by packed 0xRRGGBB value.
+    _instances = {}
+
+    def __new__(cls, r=None, g=None, b=None):
+        return cls.from_int(hash(Color(r, g, b)))
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @classmethod
+    def from_int(cls, value):
+        '''Returns the instance for a 0xRRGGBB integer, which must be in
+        0..0xFFFFFF range.
+        '''
+        color = cls._instances.get(value)
+        if color is None:
+            color = object.__new__(cls)
+            object.__setattr__(color, '_value', value)
+            object.__setattr__(color, '_hex', '#{0:06x}'.format(value))
+            color = cls._instances.setdefault(value, color)
+        return color
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FrozenColor is immutable')
+
+    def __reduce__(self):
+        return (FrozenColor.from_int, (self._value,))
+
+    def __repr__(self):
+        return 'FrozenColor({self.r}, {self.g}, {self.b})'.format(self=self)
+
+    def __str__(self):
+        return self._hex
+
+    def __eq__(self, other):
+        if type(other) is FrozenColor:
+            return self is other
+        return Color.__eq__(self, other)
+
+    def __hash__(self):
+        return self._value
+
+    def __bool__(self):
+        return self._value != 0
+
+    r = property(lambda self: self._value >> 16)
+    g = property(lambda self: self._value >> 8 & 0xff)
+    b = property(lambda self: self._value & 0xff)
+
+    # Color methods read the components through the slots it defines.
+    _r, _g, _b = r, g, b
+
+    rr = property(lambda self: self._hex[1:3])
+    gg = property(lambda self: self._hex[3:5])
+    bb = property(lambda self: self._hex[5:7])
+
+    RR = property(lambda self: self._hex[1:3].upper())
+    GG = property(lambda self: self._hex[3:5].upper())
+    BB = property(lambda self: self._hex[5:7].upper())
+
+    rrggbb = property(lambda self: self._hex[1:])
+    RRGGBB = property(lambda self: self._hex[1:].upper())
+    prrggbb = property(lambda self: self._hex)
+    pRRGGBB = property(lambda self: self._hex.upper())
+
+    def frozen(self):
+        return self
+
 
 class NamedColor(Color):
     __slots__ = ('name',)
@@ -289,17 +475,85 @@ class NamedColor(Color):
         super().__init__(*args, **kwargs)
         self.name = name
 
+    @classmethod
+    def from_int(cls, value, name=None):
+        '''Same as Color.from_int(), with a name.
+
+        >>> NamedColor.from_int(0xff0000, 'Red')
+        NamedColor(255, 0, 0, name='Red')
+        '''
+        color = super().from_int(value)
+        color.name = name
+        return color
+
     def __repr__(self):
         return 'NamedColor({self.r}, {self.g}, {self.b}, name={self.name!r})'.format(self=self)
 
 
+class PaletteColors(Sequence):
+    '''Read-only sequence view over the packed colors of a GimpPalette.
+
+    NamedColor objects are built on demand, so changing them does not change
+    the palette. Use GimpPalette.add_color() for that.
+
+    >>> pal = GimpPalette()
+    >>> pal.add_color(255, 0, 0, 'Red')
+    >>> pal.add_color(0, 300, -5)
+    >>> len(pal.colors)
+    2
+    >>> pal.colors[1]
+    NamedColor(0, 255, 0, name='Untitled')
+    >>> pal.colors[-1:]
+    [NamedColor(0, 255, 0, name='Untitled')]
+    >>> [str(c) for c in pal.colors]
+    ['#ff0000', '#00ff00']
+    >>> bytes(pal.rgb)
+    b'\\xff\\x00\\x00\\x00\\xff\\x00'
+    '''
+
+    __slots__ = ('_palette',)
+
+    def __init__(self, palette):
+        self._palette = palette
+
+    def __len__(self):
+        return len(self._palette.color_names)
+
+    def __getitem__(self, index):
+        pal = self._palette
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        name = pal.color_names[index]
+        if index < 0:
+            index += len(self)
+        return NamedColor.from_int(int.from_bytes(pal.rgb[3 * index:3 * index + 3], 'big'), name)
+
+    def __iter__(self):
+        pal = self._palette
+        rgb = pal.rgb
+        from_int = NamedColor.from_int
+        for i, name in enumerate(pal.color_names):
+            yield from_int(rgb[3 * i] << 16 | rgb[3 * i + 1] << 8 | rgb[3 * i + 2], name)
+
+    def __repr__(self):
+        return 'PaletteColors({0!r})'.format(list(self))
+
+
 class GimpPalette:
+    '''A GIMP palette with its colors packed into a single bytearray.
+
+    The colors are stored as consecutive R, G, B bytes in `rgb`, with their
+    names in the parallel `color_names` list. The `colors` attribute is a
+    sequence of NamedColor objects built on demand from that storage.
+    '''
+
     def __init__(self):
         self.name = ''
         self.filename = ''
         self.columns = 0
         self.comments = []
-        self.colors = []
+        self.rgb = bytearray()
+        self.color_names = []
 
     def __repr__(self):
         return '<GimpPalette {0.name!r}, {1} colors over {0.columns} columns, {2} comments, loaded from {0.filename!r}>'.format(self, len(self.colors), len(self.comments))
@@ -307,56 +561,168 @@ class GimpPalette:
     def __str__(self):
         return 'GimpPalette {0.name}'.format(self)
 
+    @property
+    def colors(self):
+        return PaletteColors(self)
+
+    @colors.setter
+    def colors(self, colors):
+        self.rgb = bytearray()
+        self.color_names = []
+        for color in colors:
+            self.add_color(color.r, color.g, color.b, getattr(color, 'name', 'Untitled'))
+
+    def add_color(self, r, g, b, name='Untitled'):
+        '''Appends one color, clamping each component to 0..255 range.'''
+        self.rgb += bytes((clamp_to_byte(int(r)), clamp_to_byte(int(g)), clamp_to_byte(int(b))))
+        self.color_names.append(name)
+
+    def rgb_array(self):
+        '''Returns the colors as a (N, 3) uint8 NumPy array sharing memory
+        with `rgb`. Requires NumPy.
+        '''
+        import numpy
+        return numpy.frombuffer(self.rgb, dtype=numpy.uint8).reshape(-1, 3)
+
     @classmethod
     def new_from_filename(cls, filename):
-        with open(filename) as f:
-            return cls.new_from_file(f, filename=filename)
+        '''Parses a *.gpl file by memory-mapping it.'''
+        with open(filename, 'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped.
+                return cls.new_from_bytes(b'', filename=filename)
+            try:
+                return cls.new_from_bytes(data, filename=filename)
+            finally:
+                data.close()
 
     @classmethod
-    def new_from_file(cls, f, filename=None):
+    def new_from_bytes(cls, data, filename=None):
+        '''Parses the contents of a *.gpl file in a single pass.
+
+        `data` can be any bytes-like object supported by the re module, such
+        as bytes or mmap.
+
+        >>> pal = GimpPalette.new_from_bytes(
+        ...     b'GIMP Palette\\nName: Foo\\nColumns: 2\\n# Bar\\n'
+        ...     b'  0   0 255\\tBlue \\r\\n300 -1 0\\n', filename='foo.gpl')
+        >>> pal
+        <GimpPalette 'Foo', 2 colors over 2 columns, 1 comments, loaded from 'foo.gpl'>
+        >>> list(pal.colors)
+        [NamedColor(0, 0, 255, name='Blue'), NamedColor(255, 0, 0, name='Untitled')]
+        >>> pal.comments
+        ['Bar']
+        >>> GimpPalette.new_from_bytes(b'GIMP Palette\\n\\n1 2\\n', filename='foo.gpl')  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+            ...
+        GimpPaletteError: foo.gpl:3: Invalid line
+        >>> GimpPalette.new_from_bytes(b'', filename='foo.gpl')  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+            ...
+        GimpPaletteError: foo.gpl:1: Incorrect header at the first line
+        '''
         pal = cls()
 
         if filename:
             pal.filename = filename
 
-        lineno = 1
-        header_magic = next(f)
-        assert header_magic.strip() == 'GIMP Palette', '{0}: Incorrect header at the first line'.format(filename)
+        header_end = data.find(b'\n')
+        if header_end < 0:
+            header_end = len(data)
+        if data[:header_end].strip() != b'GIMP Palette':
+            raise GimpPaletteError('Incorrect header at the first line', filename, 1)
 
-        for line in f:
-            lineno += 1
-            if line.startswith('Name:'):
-                pal.name = line.partition('Name:')[2].strip()
-            elif line.startswith('Columns:'):
-                pal.columns = int(line.partition('Columns:')[2].strip())
-            elif line.startswith('Channels:'):
-                # Present in Aseprite palette, ignored here.
-                pass
-            else:
-                line = line.strip()
-                if line.startswith('#'):
-                    pal.comments.append(line[1:].strip())
-                elif line:
-                    splitted = line.split(maxsplit=3)
-                    if len(splitted) == 3:
-                        splitted.append('Untitled')
-                    assert len(splitted) == 4, 'Invalid line at {0}:{1}'.format(filename, lineno)
-
-                    r, g, b, name = splitted
-                    pal.colors.append(NamedColor(
-                        r=int(r),
-                        g=int(g),
-                        b=int(b),
-                        name=name.strip()
-                    ))
-
-        if pal.name == '':
-            pal.name = os.path.basename(filename)
+        # Each line of the file produces exactly one findall() result, which
+        # is cheaper than creating one match object per line.
+        pal._parse_lines(_GPL_LINE_RE.findall(data, header_end + 1), filename)
+        return pal
+
+    def _parse_lines(self, lines, filename):
+        '''Adds the contents of the lines after the header, given as the
+        groups of _GPL_LINE_RE, with b'' for those that did not match.
+        '''
+        rgb = self.rgb
+        color_names = self.color_names
+        for lineno, (key, value, comment, r, g, b, name, invalid) in enumerate(lines, 2):
+            try:
+                if r:
+                    r = int(r)
+                    g = int(g)
+                    b = int(b)
+                    rgb.append(255 if r > 255 else 0 if r < 0 else r)
+                    rgb.append(255 if g > 255 else 0 if g < 0 else g)
+                    rgb.append(255 if b > 255 else 0 if b < 0 else b)
+                    color_names.append(name.decode().strip() or 'Untitled')
+                elif comment:
+                    self.comments.append(comment[1:].decode().strip())
+                elif key == b'Name':
+                    self.name = value.decode().strip()
+                elif key == b'Columns':
+                    self.columns = int(value)
+                elif key == b'Channels':
+                    # Present in Aseprite palette, ignored here.
+                    pass
+                elif invalid:
+                    raise GimpPaletteError('Invalid line', filename, lineno)
+            except ValueError as e:
+                if isinstance(e, GimpPaletteError):
+                    raise
+                raise GimpPaletteError(str(e), filename, lineno) from e
+
+        if self.name == '' and filename:
+            self.name = os.path.basename(filename)
 
+    @classmethod
+    def new_from_file(cls, f, filename=None):
+        '''Parses a *.gpl file from a text file object, line by line, with
+        the same rules and errors as new_from_bytes().
+
+        >>> from io import StringIO
+        >>> for text in ['GIMP Palette\\n1\\xa02 3\\n', 'GIMP Palette\\nColumns: x\\n']:
+        ...     try:
+        ...         GimpPalette.new_from_file(StringIO(text), 'foo.gpl')
+        ...     except GimpPaletteError as e:
+        ...         print(e)
+        foo.gpl:2: Invalid line
+        foo.gpl:2: invalid literal for int() with base 10: b' x'
+        '''
+        pal = cls()
+
+        if filename:
+            pal.filename = filename
+
+        header_magic = next(f, '')
+        if header_magic.strip() != 'GIMP Palette':
+            raise GimpPaletteError('Incorrect header at the first line', filename, 1)
+
+        match = _GPL_LINE_RE.match
+        pal._parse_lines(
+            (match(line.encode('utf-8', 'surrogateescape')).groups(b'') for line in f),
+            filename,
+        )
         return pal
 
+    def frozen_colors(self):
+        '''Returns the colors as shared FrozenColor instances, in the same
+        order as color_names.
+
+        >>> pal = GimpPalette.new_from_bytes(b'GIMP Palette\\n0 0 0 A\\n0 0 0 B\\n')
+        >>> a, b = pal.frozen_colors()
+        >>> a is b
+        True
+        '''
+        from_int = FrozenColor.from_int
+        rgb = self.rgb
+        return [
+            from_int(r << 16 | g << 8 | b)
+            for r, g, b in zip(rgb[0::3], rgb[1::3], rgb[2::3])
+        ]
+
     def how_many_unique_colors(self):
-        return len(set(c for c in self.colors))
+        rgb = self.rgb
+        return len(set(zip(rgb[0::3], rgb[1::3], rgb[2::3])))
 
 
 def parse_args():
@@ -375,17 +741,124 @@ def parse_args():
     )
     parser.add_argument(
         '-o', '--output',
-        type=argparse.FileType('w'),
         default='-',
-        help='Output HTML file'
+        help='Output HTML file, or - for stdout'
+    )
+    parser.add_argument(
+        '--output-dir',
+        metavar='DIR',
+        help='Instead of a single page, write an index page, one page per'
+        ' shard of palettes, and shared CSS and JavaScript files into this'
+        ' directory. Only files whose content changed are rewritten'
+    )
+    parser.add_argument(
+        '--shard-size',
+        type=int,
+        default=16,
+        help='Palettes per page with --output-dir (1 for one page per palette)'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Parse and render palettes in this many processes (0 means one per CPU)'
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Sort palettes by a header-only pre-scan, then parse, render and'
+        ' write them one at a time, so memory use stays constant'
+    )
+    parser.add_argument(
+        '--manifest',
+        metavar='FILE',
+        help='With --stream, take the names of the palettes from this manifest'
+        ' (see palette_manifest.py), brought up to date first, instead of'
+        ' scanning the header of every file'
+    )
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='Leave the colors out of the HTML; the page draws each palette'
+        ' from the search index when it scrolls into view'
+    )
+    parser.add_argument(
+        '--cache',
+        metavar='FILE',
+        help='Keep rendered palettes in this cache file and reuse them for unchanged files'
+    )
+    parser.add_argument(
+        '--cache-size',
+        metavar='MB',
+        type=int,
+        default=64,
+        help='Maximum size of the HTML kept in the cache'
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Keep running, and update the output whenever palette files'
+        ' change. Only the changed files are parsed and rendered again'
+    )
+    parser.add_argument(
+        '--watch-interval',
+        metavar='SECONDS',
+        type=float,
+        default=1.0,
+        help='How often --watch checks the files for changes'
+    )
+    parser.add_argument(
+        '--debounce',
+        metavar='SECONDS',
+        type=float,
+        default=0.3,
+        help='How long the files must stay unchanged before --watch rebuilds'
+    )
+    parser.add_argument(
+        '--timings',
+        nargs='?',
+        const='table',
+        choices=['table', 'json'],
+        help='Print to stderr the time spent in each stage, and the time,'
+        ' colors and bytes of each palette'
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='FILE',
+        help='Run under cProfile and tracemalloc, save the profile to this file'
+        ' and print a summary to stderr. With --jobs, only the main process is profiled'
     )
     parser.add_argument(
         'palettes',
-        type=argparse.FileType('r'),
         nargs='*',
-        help='GIMP Palette files (*.gpl)'
+        help='GIMP Palette files (*.gpl), directories with such files, or'
+        ' compiled collections (*.gplpack, see palette_pack.py)'
     )
     options = parser.parse_args()
+    if options.jobs < 0:
+        parser.error('--jobs must not be negative')
+    if options.shard_size < 1:
+        parser.error('--shard-size must be positive')
+    if options.output_dir is not None and options.stream:
+        parser.error('--stream cannot be used with --output-dir')
+    if options.manifest is not None and not options.stream:
+        parser.error('--manifest requires --stream')
+    if options.output != '-':
+        # The file is opened only when the page is written, so that --watch
+        # does not truncate the current page while the first build runs.
+        target = options.output
+        if not os.path.exists(target):
+            target = os.path.dirname(target) or '.'
+        if not os.access(target, os.W_OK):
+            parser.error("can't write to {0!r}".format(options.output))
+    if options.watch:
+        if options.output == '-' and options.output_dir is None:
+            parser.error('--watch requires --output or --output-dir')
+        if '-' in options.palettes:
+            parser.error('--watch cannot read from stdin')
+    for filename in options.palettes:
+        if filename != '-' and not os.access(filename, os.R_OK):
+            parser.error("can't open {0!r}".format(filename))
     return options
 
 
@@ -398,14 +871,18 @@ def run_doctests_and_exit():
         sys.exit(0)
 
 
-HTML_PREFIX='''\
+# The page is assembled from these pieces. With --output-dir, the CSS and
+# the scripts go to static files shared by all pages instead.
+HTML_HEAD='''\
 <!DOCTYPE html>
 <html>
 <head>
 <meta charset="utf-8">
-<title>GIMP palettes</title>
+<title>{title}</title>
 <meta name="viewport" content="width=device-width,initial-scale=1.0">
-<style>
+'''
+
+HTML_CSS='''\
 html, body {
     background: white;
     color: black;
@@ -609,10 +1086,9 @@ table.colors .color {
 .search_filtered {
     display: none;
 }
-</style>
-</head>
-<body class="fixed-panel">
+'''
 
+HTML_PANEL='''\
 <aside class="interactivepanel">
 <div class="confcontrols">
     <label><input type="search" id="search_field" placeholder="Search (regex)"></label>
@@ -630,8 +1106,9 @@ table.colors .color {
 (R, G, B)</div>
 </div>
 </aside>
+'''
 
-<script>
+HTML_SCRIPT='''\
 // This function returns a function that debounces a certain event.
 // Arguments:
 //   event_handler             - Function (callback) to handle the event.
@@ -650,14 +1127,34 @@ function debounce(event_handler, timeout_ms, unthrottled_event_handler) {
     };
 }
 
-function matches_search_text_for_palette(palette_elem, search_re) {
-    for (var child_elem of palette_elem.querySelectorAll('.name, .properties, .comment')) {
-        var text = child_elem.textContent.trim();
-        if (search_re.test(text)) {
-            return true;
-        }
+// The search index, written by gpl_to_html.py after all palettes, has one
+// entry per palette, in the same order as the elements:
+//   [name, properties, [comments], [color names], "rrggbbrrggbb..."]
+// Each entry becomes a single string with one line per searchable text, so
+// that searching never touches the DOM.
+var search_index = null;
+var search_texts = null;
+// Whether each palette is currently hidden by the search.
+var search_filtered = [];
+function get_search_index() {
+    if (search_index === null) {
+        search_index = JSON.parse(document.getElementById('search_index').textContent);
+    }
+    return search_index;
+}
+function get_search_texts() {
+    if (search_texts === null) {
+        search_texts = get_search_index().map(function(entry) {
+            var lines = [entry[0], entry[1]].concat(entry[2]);
+            var names = entry[3];
+            var hex = entry[4];
+            for (var i = 0; i < names.length; i++) {
+                lines.push(names[i] + ' #' + hex.substr(6 * i, 6));
+            }
+            return lines.join('\\n');
+        });
     }
-    return false;
+    return search_texts;
 }
 // Event handler to filter all palettes based on the input field.
 function filter_palettes(ev) {
@@ -665,19 +1162,21 @@ function filter_palettes(ev) {
     var search_text = search_field.value;
     var search_re;
     try {
-        search_re = new RegExp(search_text, 'i');
+        search_re = new RegExp(search_text, 'im');
     } catch(error) {
         search_field.setCustomValidity(error.message);
         search_field.reportValidity();
         return;
     }
     search_field.setCustomValidity('');
-    var palettes = document.querySelectorAll('#palettes .palette');
-    for (var palette of palettes) {
-        palette.classList.toggle(
-            'search_filtered',
-            !matches_search_text_for_palette(palette, search_re)
-        );
+    var texts = get_search_texts();
+    var palettes = document.getElementById('palettes').children;
+    for (var i = 0; i < texts.length; i++) {
+        var filtered = !search_re.test(texts[i]);
+        if (filtered !== search_filtered[i]) {
+            palettes[i].classList.toggle('search_filtered', filtered);
+            search_filtered[i] = filtered;
+        }
     }
 }
 function clear_form_validity(ev) {
@@ -702,16 +1201,84 @@ window.addEventListener('load', function(ev) {
     document.getElementById('toggle_border_checkbox').dispatchEvent(new Event('change'));
     document.getElementById('toggle_fixed_checkbox').dispatchEvent(new Event('change'));
 });
-</script>
-
-<div class="palettes" id="palettes">
 '''
 
+HTML_PREFIX = (
+    HTML_HEAD.format(title='GIMP palettes')
+    + '<style>\n' + HTML_CSS + '</style>\n</head>\n<body class="fixed-panel">\n\n'
+    + HTML_PANEL
+    + '\n<script>\n' + HTML_SCRIPT + '</script>\n\n<div class="palettes" id="palettes">\n'
+)
 
-HTML_SUFFIX='''
+
+# Written between the palettes and HTML_SUFFIX, around the search index.
+HTML_PALETTES_END = '''
 </div>
 
-<script>
+<script type="application/json" id="search_index">['''
+HTML_SEARCH_INDEX_END = ''']</script>
+'''
+
+HTML_SUFFIX_SCRIPT='''\
+// With --compact, the colors are not in the HTML. Each palette has a single
+// placeholder cell, replaced by the real cells, built from the search index,
+// when the palette gets near the visible area.
+function escape_html(text) {
+    return text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+}
+function render_lazy_colors(palette_elem, entry) {
+    var placeholder = palette_elem.querySelector('td.lazy');
+    var columns = parseInt(placeholder.dataset.columns, 10);
+    var names = entry[3];
+    var hex = entry[4];
+    var html = [];
+    for (var i = 0; i < names.length; i++) {
+        if (i % columns == 0) {
+            html.push(i ? '</tr><tr>' : '<tr>');
+        }
+        var rrggbb = hex.substr(6 * i, 6);
+        var value = parseInt(rrggbb, 16);
+        html.push(
+            '<td class="color" style="background-color:#' + rrggbb + '" title="' +
+            escape_html(names[i]) + '\\n#' + rrggbb.toUpperCase() + '\\n' +
+            (value >> 16) + ', ' + (value >> 8 & 255) + ', ' + (value & 255) + '"></td>'
+        );
+    }
+    html.push('</tr>');
+    placeholder.parentNode.parentNode.innerHTML = html.join('');
+}
+function observe_lazy_palettes() {
+    var palettes = document.getElementById('palettes').children;
+    var lazy = [];
+    for (var i = 0; i < palettes.length; i++) {
+        if (palettes[i].querySelector('td.lazy')) {
+            palettes[i].dataset.index = i;
+            lazy.push(palettes[i]);
+        }
+    }
+    if (lazy.length == 0) {
+        return;
+    }
+    if (!('IntersectionObserver' in window)) {
+        for (var palette_elem of lazy) {
+            render_lazy_colors(palette_elem, get_search_index()[palette_elem.dataset.index]);
+        }
+        return;
+    }
+    var observer = new IntersectionObserver(function(entries) {
+        for (var entry of entries) {
+            if (entry.isIntersecting) {
+                observer.unobserve(entry.target);
+                render_lazy_colors(entry.target, get_search_index()[entry.target.dataset.index]);
+            }
+        }
+    }, {rootMargin: '256px'});
+    for (var palette_elem of lazy) {
+        observer.observe(palette_elem);
+    }
+}
+observe_lazy_palettes();
+
 function mouse_over_or_click_handler(target, info_id) {
     if (!target.classList.contains('color')) {
         return;
@@ -736,12 +1303,10 @@ document.getElementById('palettes').addEventListener(
     'mouseover', mouse_over_handler);
 document.getElementById('palettes').addEventListener(
     'click', mouse_click_handler);
-</script>
-
-</body>
-</html>
 '''
 
+HTML_SUFFIX = '\n<script>\n' + HTML_SUFFIX_SCRIPT + '</script>\n\n</body>\n</html>\n'
+
 
 def linkify(text):
     '''Adds <a href="...">...</a> around URLs.
@@ -764,73 +1329,1123 @@ def linkify(text):
     )
 
 
-def palette_to_html(pal):
-    # This function is a bit ugly just because I wanted to write it as a single
-    # statement, just for fun.
+# The templates used by palette_to_html(), compiled once at import time.
+_PALETTE_HEAD, _, _PALETTE_TAIL = dedent('''\
+    <article class="palette">
+        <h1 class="name"><a href="{filename}">{name}</a></h1>
+        <p class="properties">{properties}</p>
+        {comments}
+        <table class="colors">{{colors}}</table>
+    </article>
+''').strip().partition('{{colors}}')
+_format_palette_head = _PALETTE_HEAD.format
+_format_lazy_colors = '<tr><td class="lazy" data-columns="{0}" style="width:{1}px;height:{2}px"></td></tr>'.format
+_format_properties = '{cols}x{rows} ({len} colors, {len_unique} unique)'.format
+_format_comment = '<p class="comment">{0}</p>'.format
+_format_color_cell = dedent('''\
+    <td
+    class="color"
+    style="background-color:#{0}"
+    title="{2}
+    #{1}
+    {3}, {4}, {5}"
+    ></td>
+''').strip().format
+
+
+def palette_properties(pal, unique_colors=None):
+    '''Returns the line of a palette with its size and color counts.'''
     cols = pal.columns or 16
-    return dedent('''\
-        <article class="palette">
-            <h1 class="name"><a href="{filename}">{name}</a></h1>
-            <p class="properties">{cols}x{rows} ({len} colors, {len_unique} unique)</p>
-            {comments}
-            <table class="colors">{colors}</table>
-        </article>
-    ''').strip().format(
+    count = len(pal.color_names)
+    if unique_colors is None:
+        unique_colors = pal.how_many_unique_colors()
+    return _format_properties(
+        cols=cols,
+        rows=ceil(count / cols),
+        len=count,
+        len_unique=unique_colors,
+    )
+
+
+def palette_search_entry(pal, unique_colors=None):
+    '''Returns the entry of a palette in the search index of the page, as
+    JSON that is safe to embed in a <script> element.
+
+    >>> pal = GimpPalette.new_from_bytes(b'GIMP Palette\\nName: </script>\\n255 0 0 Red\\n')
+    >>> print(palette_search_entry(pal))
+    ["\\u003c/script>","16x1 (1 colors, 1 unique)",[],["Red"],"ff0000"]
+    '''
+    import json
+
+    return json.dumps(
+        [
+            pal.name.strip(),
+            palette_properties(pal, unique_colors),
+            [comment.strip() for comment in pal.comments],
+            [name.strip() for name in pal.color_names],
+            bytes(pal.rgb).hex(),
+        ],
+        ensure_ascii=False,
+        separators=(',', ':'),
+    ).replace('<', '\\u003c')
+
+
+def write_page(rendered, out):
+    '''Writes the whole HTML page for a list of RenderedPalette.'''
+    out.write(HTML_PREFIX)
+    for r in rendered:
+        out.write(r.html)
+    write_search_index([r.search_entry for r in rendered], out)
+    out.write(HTML_SUFFIX)
+
+
+def write_search_index(entries, out):
+    '''Writes the search index, closing the palettes element of the page.
+
+    The entries are either a list, or a file where they were already written
+    by write_palettes_streaming().
+    '''
+    out.write(HTML_PALETTES_END)
+    if hasattr(entries, 'read'):
+        import shutil
+
+        entries.seek(0)
+        shutil.copyfileobj(entries, out)
+    else:
+        out.write(',\n'.join(entries))
+    out.write(HTML_SEARCH_INDEX_END)
+
+
+def _palette_head_html(pal, unique_colors=None):
+    return _format_palette_head(
         filename=escape(pal.filename),
         name=escape(pal.name),
-        cols=cols,
-        rows=(ceil(len(pal.colors) / cols)),
-        len=len(pal.colors),
-        len_unique=pal.how_many_unique_colors(),
+        properties=palette_properties(pal, unique_colors),
         comments='\n'.join(
-            '<p class="comment">{0}</p>'.format(linkify(escape(comment)))
+            _format_comment(linkify(escape(comment)))
             for comment in pal.comments
         ),
-        colors=''.join(
-            '<tr>{line}</tr>'.format(line=''.join(
-                dedent('''\
-                    <td
-                    class="color"
-                    style="background-color:{color.prrggbb}"
-                    title="{name}
-                    {color.pRRGGBB}
-                    {color.r}, {color.g}, {color.b}"
-                    ></td>
-                ''').strip().format(
-                    name=escape(color.name),
-                    color=color
-                )
-                for color in pal.colors[offset:offset + cols]
-            )) for offset in range(0, len(pal.colors), cols)
-        ),
     )
 
 
-def main():
-    options = parse_args()
+def iter_palette_html(pal, unique_colors=None):
+    '''Yields the HTML of a palette in a few large chunks.
 
-    if options.run_tests:
-        run_doctests_and_exit()
+    The hexadecimal strings of all colors are computed at once from the
+    packed RGB bytes, and each cell is formatted exactly once. The number of
+    unique colors is counted here unless it is given.
+    '''
+    cols = pal.columns or 16
+    count = len(pal.color_names)
+    yield _palette_head_html(pal, unique_colors)
+
+    rgb = pal.rgb
+    lower = rgb.hex()
+    upper = lower.upper()
+    cells = list(map(
+        _format_color_cell,
+        [lower[i:i + 6] for i in range(0, len(lower), 6)],
+        [upper[i:i + 6] for i in range(0, len(upper), 6)],
+        map(escape, pal.color_names),
+        rgb[0::3],
+        rgb[1::3],
+        rgb[2::3],
+    ))
+    for offset in range(0, count, cols):
+        yield '<tr>' + ''.join(cells[offset:offset + cols]) + '</tr>'
+
+    yield _PALETTE_TAIL
+
+
+def iter_compact_palette_html(pal, unique_colors=None):
+    '''Yields the HTML of a palette without its colors, for --compact.
+
+    The table only has a placeholder of the final size; the page draws the
+    colors from the search index when the palette scrolls into view.
+
+    >>> pal = GimpPalette.new_from_bytes(b'GIMP Palette\\nColumns: 4\\n' + b'0 0 0\\n' * 6)
+    >>> print(list(iter_compact_palette_html(pal))[1])
+    <tr><td class="lazy" data-columns="4" style="width:37px;height:19px"></td></tr>
+    '''
+    cols = pal.columns or 16
+    rows = ceil(len(pal.color_names) / cols)
+    yield _palette_head_html(pal, unique_colors)
+    # Collapsed 1px borders around 8px cells.
+    yield _format_lazy_colors(cols, 9 * min(cols, len(pal.color_names)) + 1, 9 * rows + 1)
+    yield _PALETTE_TAIL
+
+
+def palette_to_html(pal, compact=False, unique_colors=None):
+    if compact:
+        return ''.join(iter_compact_palette_html(pal, unique_colors))
+    return ''.join(iter_palette_html(pal, unique_colors))
+
+
+# Everything that is needed to write one palette into the HTML page, plus the
+# file information used to validate cached entries.
+RenderedPalette = namedtuple('RenderedPalette', [
+    'filename', 'size', 'mtime_ns', 'sha256',
+    'name', 'columns', 'colors', 'unique_colors', 'comments',
+    'html', 'search_entry',
+])
+
+
+class StageTimer:
+    '''Adds up the wall time between consecutive calls to lap(), by stage.
+
+    >>> timer = StageTimer()
+    >>> timer.lap('parse')
+    >>> list(timer.stages)
+    ['parse']
+    '''
+
+    def __init__(self):
+        self.stages = {}
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+        self._last = now
+
+
+class _NullTimer:
+    '''A StageTimer that does nothing, used when timings are disabled.'''
+
+    def lap(self, stage):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def render_palette(pal, size=None, mtime_ns=None, sha256=None, timer=NULL_TIMER, compact=False):
+    unique_colors = pal.how_many_unique_colors()
+    timer.lap('unique')
+    html = palette_to_html(pal, compact, unique_colors)
+    timer.lap('html')
+    search_entry = palette_search_entry(pal, unique_colors)
+    timer.lap('index')
+    return RenderedPalette(
+        filename=pal.filename,
+        size=size,
+        mtime_ns=mtime_ns,
+        sha256=sha256,
+        name=pal.name,
+        columns=pal.columns,
+        colors=len(pal.colors),
+        unique_colors=unique_colors,
+        comments=pal.comments,
+        html=html,
+        search_entry=search_entry,
+    )
+
+
+def list_palette_files(paths):
+    '''Replaces each directory in the list by the *.gpl files inside it.'''
+    filenames = []
+    for path in paths:
+        if path != '-' and os.path.isdir(path):
+            import glob
+
+            filenames.extend(sorted(glob.glob(os.path.join(path, '*.gpl'))))
+        else:
+            filenames.append(path)
+    return filenames
+
+
+def expand_palette_sources(filenames):
+    '''Replaces each directory in the list of files by the *.gpl files
+    inside it, and each compiled collection (see palette_pack.py) by
+    references to the palettes inside it.
+    '''
+    sources = []
+    for filename in list_palette_files(filenames):
+        if filename.endswith('.gplpack'):
+            import palette_pack
+
+            with palette_pack.PaletteCollection(filename) as collection:
+                sources.extend(collection.references())
+        else:
+            sources.append(filename)
+    return sources
+
+
+def load_palette_source(source):
+    '''Loads a palette from a file name or from a palette_pack.PaletteRef.'''
+    if isinstance(source, str):
+        return GimpPalette.new_from_filename(source)
+
+    import palette_pack
+
+    return palette_pack.load_palette(source)
+
+
+def render_palette_file(source, timer=NULL_TIMER, compact=False):
+    '''Parses and renders one palette file, where '-' means stdin. It can
+    also be a reference to a palette in a compiled collection.
+
+    This is the unit of work sent to each process when using --jobs.
+    '''
+    if source == '-':
+        pal = GimpPalette.new_from_file(sys.stdin, filename=sys.stdin.name)
+        timer.lap('parse')
+        return render_palette(pal, timer=timer, compact=compact)
+    if not isinstance(source, str):
+        pal = load_palette_source(source)
+        timer.lap('parse')
+        return render_palette(pal, timer=timer, compact=compact)
+
+    import hashlib
+
+    with open(source, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        data = f.read()
+    sha256 = hashlib.sha256(data).hexdigest()
+    timer.lap('read')
+    pal = GimpPalette.new_from_bytes(data, filename=source)
+    timer.lap('parse')
+    return render_palette(
+        pal,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        sha256=sha256,
+        timer=timer,
+        compact=compact,
+    )
+
+
+def render_palette_file_timed(source, compact=False):
+    '''Same as render_palette_file(), but returns the time spent in each
+    stage as well, for --timings.
+    '''
+    timer = StageTimer()
+    return render_palette_file(source, timer, compact), timer.stages
+
+
+def _render_function(timings, compact):
+    function = render_palette_file if timings is None else render_palette_file_timed
+    if compact:
+        from functools import partial
+
+        function = partial(function, compact=True)
+    return function
+
+
+def _rendered(result, timings):
+    if timings is None:
+        return result
+    return timings.add_palette(*result)
+
+
+def _is_cacheable(source):
+    # Stdin cannot be validated, and compiled collections are fast anyway.
+    return isinstance(source, str) and source != '-'
+
+
+def render_palette_files(filenames, jobs=1, cache=None, timings=None, compact=False):
+    '''Returns a RenderedPalette for each file, in the same order.
+
+    Files found in the cache are not parsed again, and the others are added
+    to it. With more than one job, the files are handled by a process pool.
+    Stdin is always read by the current process. Per-palette stage times are
+    added to timings, if given.
+    '''
+    render = _render_function(timings, compact)
+    results = [None] * len(filenames)
+    if cache is not None:
+        for i, filename in enumerate(filenames):
+            if _is_cacheable(filename):
+                results[i] = cache.get(filename)
+                if results[i] is not None and timings is not None:
+                    timings.add_palette(results[i], None)
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    indexes = [i for i in missing if filenames[i] != '-']
+    if jobs == 1 or len(indexes) < 2:
+        for i in missing:
+            results[i] = _rendered(render(filenames[i]), timings)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        jobs = jobs or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunksize = max(1, len(indexes) // (4 * jobs))
+            rendered = executor.map(
+                render,
+                [filenames[i] for i in indexes],
+                chunksize=chunksize,
+            )
+            for i in missing:
+                if filenames[i] == '-':
+                    results[i] = _rendered(render(filenames[i]), timings)
+            for i, result in zip(indexes, rendered):
+                results[i] = _rendered(result, timings)
+
+    if cache is not None:
+        for i in indexes:
+            if _is_cacheable(filenames[i]):
+                cache.put(results[i])
+    return results
+
+
+def read_palette_name(filename):
+    '''Returns the name of a palette by reading only the header of the file.
+
+    The header ends at the first color line, so a Name: line after the colors
+    (which GIMP never writes) is not seen here.
+    '''
+    if not isinstance(filename, str):
+        # A reference to a palette in a compiled collection.
+        return filename.name
+    name = ''
+    with open(filename, 'rb') as f:
+        next(f, None)  # The "GIMP Palette" magic line.
+        for line in f:
+            match = _GPL_LINE_RE.match(line)
+            if match is None or match.group('r'):
+                break
+            if match.group('key') == b'Name':
+                name = match.group('value').decode().strip()
+    return name or os.path.basename(filename)
 
-    # TODO: Print error if len(options.palettes) == 0.
 
-    options.output.write(HTML_PREFIX)
+def iter_rendered_palettes(items, jobs=1, cache=None, timings=None, compact=False):
+    '''Yields a RenderedPalette for each item, in the same order.
 
-    palettes = []
+    Each item is either a file name or an already RenderedPalette. Only a
+    handful of palettes are kept in memory at any time: with more than one
+    job, at most a few files per process are rendered ahead of the consumer.
+    '''
+    render = _render_function(timings, compact)
+
+    def cached_or_filename(item):
+        if cache is None or not _is_cacheable(item):
+            return item
+        cached = cache.get(item)
+        if cached is None:
+            return item
+        if timings is not None:
+            timings.add_palette(cached, None)
+        return cached
+
+    def store(result):
+        rendered = _rendered(result, timings)
+        if cache is not None and rendered.sha256 is not None:
+            cache.put(rendered)
+        return rendered
+
+    if jobs == 1:
+        for item in map(cached_or_filename, items):
+            if isinstance(item, RenderedPalette):
+                yield item
+            else:
+                yield store(render(item))
+        return
+
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    jobs = jobs or os.cpu_count() or 1
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for item in map(cached_or_filename, items):
+            if not isinstance(item, RenderedPalette):
+                item = executor.submit(render, item)
+            pending.append(item)
+            while len(pending) > 4 * jobs:
+                item = pending.popleft()
+                yield item if isinstance(item, RenderedPalette) else store(item.result())
+        for item in pending:
+            yield item if isinstance(item, RenderedPalette) else store(item.result())
+
+
+def write_palettes_streaming(filenames, out, search_index, jobs=1, cache=None, timings=None, compact=False, names=None):
+    '''Writes the HTML of all palettes, sorted by name, one at a time.
+
+    The order comes from a cheap pre-scan of the file headers, so memory use
+    does not depend on how many palettes there are. Files found in `names`,
+    a {filename: palette name} dict such as the one of a manifest, are not
+    scanned. Stdin is read up front, as it cannot be read twice.
+
+    The search index entries go to the search_index file as each palette is
+    written, since the index comes after all palettes in the page. Pass that
+    file to write_search_index() afterwards.
+    '''
+    items = []
+    keys = []
+    for filename in filenames:
+        if filename == '-':
+            rendered = _rendered(_render_function(timings, compact)(filename), timings)
+            items.append(rendered)
+            keys.append(rendered.name.lower())
+        else:
+            items.append(filename)
+            name = names.get(filename) if names is not None and isinstance(filename, str) else None
+            keys.append((name if name is not None else read_palette_name(filename)).lower())
+
+    # Same stable sort as in the non-streaming mode.
+    order = sorted(range(len(items)), key=keys.__getitem__)
+    del keys
+
+    if timings is not None:
+        timings.lap('scan')
+
+    separator = ''
+    rendered_palettes = iter_rendered_palettes(
+        [items[i] for i in order],
+        jobs=jobs,
+        cache=cache,
+        timings=timings,
+        compact=compact,
+    )
+    for rendered in rendered_palettes:
+        out.write(rendered.html)
+        search_index.write(separator + rendered.search_entry)
+        if timings is not None:
+            timings.add_written(separator + rendered.search_entry)
+        separator = ',\n'
+
+
+class RenderCache:
+    '''Persistent cache of RenderedPalette entries, in a SQLite database.
+
+    Entries are keyed by the file name as given in the command line. An entry
+    is valid while the file size and mtime are unchanged; if only the mtime
+    changed (e.g. after a fresh git checkout), the content hash decides.
+    The whole cache is discarded whenever this script changes, because the
+    script itself defines the HTML output, and whenever the variant of the
+    HTML (such as 'compact') is not the one it was filled with. Least recently used entries are
+    evicted once the HTML fragments exceed max_bytes.
+    '''
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, filename, max_bytes=64 * 1024 * 1024, variant=''):
+        import sqlite3
+
+        self.max_bytes = max_bytes
+        self.variant = variant
+        self.db = sqlite3.connect(filename)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        version = self.version(variant)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != version:
+            # The columns may have changed as well.
+            with self.db:
+                self.db.execute('DROP TABLE IF EXISTS palettes')
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS palettes (
+                filename TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sha256 TEXT,
+                name TEXT,
+                columns INTEGER,
+                colors INTEGER,
+                unique_colors INTEGER,
+                comments TEXT,
+                html TEXT,
+                search_entry TEXT,
+                last_used REAL
+            )
+        ''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def version(cls, variant=''):
+        '''Returns a stamp that changes whenever this script changes, or
+        whenever the cache is used for a different variant of the HTML.
+        '''
+        import hashlib
+
+        with open(__file__, 'rb') as f:
+            source = f.read()
+        return '{0}:{1}:{2}'.format(cls.FORMAT_VERSION, hashlib.sha256(source).hexdigest(), variant)
+
+    def get(self, filename):
+        '''Returns the cached RenderedPalette for the file, or None.'''
+        import hashlib
+        import json
+
+        row = self.db.execute(
+            'SELECT {0} FROM palettes WHERE filename = ?'.format(', '.join(RenderedPalette._fields)),
+            (filename,),
+        ).fetchone()
+        if row is None:
+            return None
+        cached = RenderedPalette(*row)
+
+        stat = os.stat(filename)
+        if stat.st_size != cached.size:
+            return None
+        if stat.st_mtime_ns != cached.mtime_ns:
+            with open(filename, 'rb') as f:
+                if hashlib.sha256(f.read()).hexdigest() != cached.sha256:
+                    return None
+            cached = cached._replace(mtime_ns=stat.st_mtime_ns)
+
+        self.db.execute(
+            'UPDATE palettes SET mtime_ns = ?, last_used = ? WHERE filename = ?',
+            (cached.mtime_ns, time.time(), filename),
+        )
+        return cached._replace(comments=json.loads(cached.comments))
+
+    def put(self, rendered):
+        import json
+
+        self.db.execute(
+            'INSERT OR REPLACE INTO palettes VALUES ({0})'.format(
+                ', '.join('?' * (len(RenderedPalette._fields) + 1))),
+            rendered._replace(comments=json.dumps(rendered.comments)) + (time.time(),),
+        )
+
+    def evict(self):
+        '''Deletes the least recently used entries beyond max_bytes.'''
+        total = 0
+        stale = []
+        for filename, size in self.db.execute(
+                'SELECT filename, length(html) FROM palettes ORDER BY last_used DESC'):
+            total += size
+            if total > self.max_bytes:
+                stale.append((filename,))
+        self.db.executemany('DELETE FROM palettes WHERE filename = ?', stale)
+
+    def close(self):
+        '''Evicts old entries and commits all changes in one transaction.'''
+        self.evict()
+        self.db.commit()
+        self.db.close()
+
+
+# Files written by --output-dir, besides index.html.
+SHARD_FILENAME = 'palettes-{0:04d}.html'
+SHARD_GLOB = 'palettes-[0-9][0-9][0-9][0-9].html'
+STATIC_CSS = 'palettes.css'
+STATIC_JS = 'palettes.js'
+
+# Only used by the index page of --output-dir.
+INDEX_CSS = '''
+.palette-index {
+    list-style: none;
+    margin: 0 auto;
+    padding: 8px;
+    max-width: 960px;
+}
+.palette-index li {
+    display: flex;
+    align-items: center;
+    gap: 1ex;
+    padding: 2px 0;
+}
+.palette-index a {
+    flex: 1 1 auto;
+}
+.palette-index .properties {
+    font-style: italic;
+}
+.palette-index .strip {
+    flex: 0 0 128px;
+    height: 12px;
+    border: 1px solid silver;
+}
+'''
+
+_format_index_entry = '<li><a href="{0}">{1}</a> <span class="properties">{2}</span> <span class="strip" style="background:{3}"></span></li>\n'.format
+_format_shard_nav = '<nav class="shard-nav"><a href="index.html">All palettes</a>{0}{1}</nav>\n'.format
+_format_nav_link = ' <a href="{0}">{1}</a>'.format
+
+
+def thumbnail_gradient(hex_colors, count=16):
+    '''Returns a CSS background with up to count colors of the palette,
+    evenly picked, side by side. The colors are given as packed hex.
+
+    >>> thumbnail_gradient('ff000000ff000000ff', 2)
+    'linear-gradient(to right,#ff0000 0% 50%,#00ff00 50% 100%)'
+    >>> thumbnail_gradient('')
+    'none'
+    '''
+    total = len(hex_colors) // 6
+    count = min(count, total)
+    if count == 0:
+        return 'none'
+    stops = []
+    for i in range(count):
+        j = i * total // count
+        stops.append('#{0} {1:g}% {2:g}%'.format(
+            hex_colors[6 * j:6 * j + 6],
+            round(100 * i / count, 2),
+            round(100 * (i + 1) / count, 2),
+        ))
+    return 'linear-gradient(to right,{0})'.format(','.join(stops))
+
+
+def write_if_changed(filename, text):
+    '''Writes the text to the file, unless the file already has exactly
+    this content. Returns whether the file was written.
+    '''
+    data = text.encode('utf-8')
+    try:
+        with open(filename, 'rb') as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    temporary = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, filename)
+    return True
+
+
+def shard_page(rendered, title, nav):
+    '''Returns a page of --output-dir with some palettes, which uses the
+    static CSS and JavaScript files.
+    '''
+    return ''.join([
+        HTML_HEAD.format(title=escape(title)),
+        '<link rel="stylesheet" href="{0}">\n</head>\n<body class="fixed-panel">\n\n'.format(STATIC_CSS),
+        HTML_PANEL,
+        nav,
+        '\n<div class="palettes" id="palettes">\n',
+        ''.join(r.html for r in rendered),
+        HTML_PALETTES_END,
+        ',\n'.join(r.search_entry for r in rendered),
+        HTML_SEARCH_INDEX_END,
+        '<script src="{0}"></script>\n\n</body>\n</html>\n'.format(STATIC_JS),
+    ])
+
+
+def index_page(rendered, shard_filenames):
+    '''Returns the index page of --output-dir, which lists all palettes
+    with a link to their page and a thumbnail of their colors.
+    '''
+    import json
+
+    entries = []
+    for r, filename in zip(rendered, shard_filenames):
+        name, properties, _, _, hex_colors = json.loads(r.search_entry)
+        entries.append(_format_index_entry(
+            filename,
+            escape(name),
+            escape(properties),
+            thumbnail_gradient(hex_colors),
+        ))
+    return ''.join([
+        HTML_HEAD.format(title='GIMP palettes'),
+        '<link rel="stylesheet" href="{0}">\n</head>\n<body>\n\n'.format(STATIC_CSS),
+        '<ul class="palette-index">\n',
+        ''.join(entries),
+        '</ul>\n\n</body>\n</html>\n',
+    ])
+
+
+def write_output_dir(rendered, directory, shard_size=16):
+    '''Writes the palettes as a set of pages: an index page, one page for
+    each shard of shard_size palettes, and the CSS and JavaScript shared by
+    all pages. Files whose content did not change are left untouched, and
+    pages of shards that no longer exist are deleted.
+
+    Returns the names of the files that were written.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    shards = [rendered[i:i + shard_size] for i in range(0, len(rendered), shard_size)]
+    names = [SHARD_FILENAME.format(n + 1) for n in range(len(shards))]
+
+    files = {
+        STATIC_CSS: HTML_CSS + INDEX_CSS,
+        STATIC_JS: HTML_SCRIPT + HTML_SUFFIX_SCRIPT,
+    }
+    for n, shard in enumerate(shards):
+        if len(shard) == 1:
+            title = shard[0].name
+        else:
+            title = '{0} \u2013 {1}'.format(shard[0].name, shard[-1].name)
+        nav = _format_shard_nav(
+            _format_nav_link(names[n - 1], 'Previous') if n > 0 else '',
+            _format_nav_link(names[n + 1], 'Next') if n + 1 < len(shards) else '',
+        )
+        files[names[n]] = shard_page(shard, title, nav)
+    files['index.html'] = index_page(
+        rendered,
+        [names[i // shard_size] for i in range(len(rendered))],
+    )
+
+    written = [
+        name for name, text in files.items()
+        if write_if_changed(os.path.join(directory, name), text)
+    ]
+
+    import glob
+
+    for filename in glob.glob(os.path.join(directory, SHARD_GLOB)):
+        if os.path.basename(filename) not in files:
+            os.remove(filename)
+    return written
+
+
+class BuildTimings:
+    '''What --timings reports: the wall time of each stage of the whole run,
+    and the time, color counts and HTML size of each palette.
+
+    With more than one job, palettes are timed inside the worker processes,
+    so their times add up to more than the wall time of the run.
+    '''
 
-    for f in options.palettes:
-        pal = GimpPalette.new_from_file(f, filename=f.name)
-        f.close()
-        palettes.append(pal)
+    PALETTE_STAGES = ('read', 'parse', 'unique', 'html', 'index')
 
-    palettes.sort(key=lambda pal: pal.name.lower())
+    def __init__(self):
+        self.timer = StageTimer()
+        self.palettes = []
+        self.bytes_written = 0
+
+    def lap(self, stage):
+        self.timer.lap(stage)
+
+    def add_written(self, text):
+        self.bytes_written += len(text.encode('utf-8'))
+
+    def add_palette(self, rendered, stages):
+        '''Records a rendered palette and returns it. The stages are None for
+        palettes that came from the cache.
+        '''
+        size = len(rendered.html.encode('utf-8'))
+        self.bytes_written += size
+        self.palettes.append({
+            'filename': rendered.filename,
+            'name': rendered.name,
+            'colors': rendered.colors,
+            'unique_colors': rendered.unique_colors,
+            'bytes': size,
+            'cached': stages is None,
+            'stages': stages or {},
+        })
+        return rendered
+
+    def as_dict(self):
+        return {
+            'stages': self.timer.stages,
+            'total': sum(self.timer.stages.values()),
+            'colors': sum(p['colors'] for p in self.palettes),
+            'bytes_written': self.bytes_written,
+            'palettes': self.palettes,
+        }
+
+    def write_json(self, out):
+        import json
+
+        json.dump(self.as_dict(), out, indent=2)
+        out.write('\n')
+
+    def write_table(self, out):
+        for stage, seconds in self.timer.stages.items():
+            out.write('{0:<12} {1:10.3f} s\n'.format(stage, seconds))
+        out.write('{0:<12} {1:10.3f} s\n'.format('total', sum(self.timer.stages.values())))
+        out.write('{0} palettes, {1} colors, {2} bytes written\n\n'.format(
+            len(self.palettes), sum(p['colors'] for p in self.palettes), self.bytes_written))
+
+        out.write('{0:<50} {1:>7} {2:>7} {3:>9}'.format('palette (slowest first)', 'colors', 'unique', 'bytes'))
+        out.write(''.join(' {0:>8}'.format(stage + ' ms') for stage in self.PALETTE_STAGES) + '\n')
+        for p in sorted(self.palettes, key=lambda p: -sum(p['stages'].values())):
+            out.write('{0:<50} {1:>7} {2:>7} {3:>9}'.format(p['filename'], p['colors'], p['unique_colors'], p['bytes']))
+            if p['cached']:
+                out.write('   (cached)\n')
+            else:
+                out.write(''.join(
+                    ' {0:8.3f}'.format(p['stages'].get(stage, 0.0) * 1000)
+                    for stage in self.PALETTE_STAGES
+                ) + '\n')
+
+
+def profile_call(func, filename):
+    '''Calls func() under cProfile and tracemalloc. Saves the profile to the
+    file (see the pstats module) and prints a summary to stderr.
+    '''
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    try:
+        profiler.runcall(func)
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        profiler.dump_stats(filename)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+        sys.stderr.write('Peak traced memory: {0:.1f} MiB\n'.format(peak / 1024 / 1024))
+        sys.stderr.write('Largest allocations still alive at the end:\n')
+        for stat in snapshot.statistics('lineno')[:10]:
+            sys.stderr.write('  {0}\n'.format(stat))
+
+
+def build_html(options):
+    '''Writes the HTML page for the palettes given in the command line.'''
+    timings = BuildTimings() if options.timings else None
+    timer = timings or NULL_TIMER
+
+    out = None
+    if options.output_dir is None:
+        out = sys.stdout if options.output == '-' else open(options.output, 'w')
+        out.write(HTML_PREFIX)
+
+    sources = expand_palette_sources(options.palettes)
+    timer.lap('expand')
+
+    cache = None
+    if options.cache:
+        cache = RenderCache(
+            options.cache,
+            max_bytes=options.cache_size * 1024 * 1024,
+            variant='compact' if options.compact else '',
+        )
+        timer.lap('cache open')
+
+    if options.stream:
+        names = None
+        if options.manifest:
+            import palette_manifest
+
+            with palette_manifest.PaletteManifest(options.manifest) as manifest:
+                # Files that cannot be parsed are reported when rendered.
+                manifest.update([source for source in sources if isinstance(source, str)])
+                names = manifest.names()
+            timer.lap('manifest')
+
+        # The search index comes after all palettes in the page, so it waits
+        # in a temporary file instead of memory.
+        import tempfile
+
+        search_entries = tempfile.TemporaryFile('w+', encoding='utf-8')
+        write_palettes_streaming(
+            sources,
+            out,
+            search_entries,
+            jobs=options.jobs,
+            cache=cache,
+            timings=timings,
+            compact=options.compact,
+            names=names,
+        )
+        timer.lap('stream')
+    else:
+        rendered = render_palette_files(
+            sources,
+            jobs=options.jobs,
+            cache=cache,
+            timings=timings,
+            compact=options.compact,
+        )
+        timer.lap('render')
+
+        # The sort is stable, so palettes with the same name keep the
+        # command-line order, regardless of the number of jobs.
+        rendered.sort(key=lambda r: r.name.lower())
+        timer.lap('sort')
+
+        if options.output_dir is not None:
+            written = write_output_dir(rendered, options.output_dir, options.shard_size)
+            timer.lap('write')
+            sys.stderr.write('{0} files changed in {1}\n'.format(len(written), options.output_dir))
+        else:
+            for r in rendered:
+                out.write(r.html)
+            timer.lap('write')
+        search_entries = [r.search_entry for r in rendered]
+
+    if cache is not None:
+        cache.close()
+        timer.lap('cache close')
+
+    if options.output_dir is None:
+        write_search_index(search_entries, out)
+        out.write(HTML_SUFFIX)
+        if out is sys.stdout:
+            # Other commands may still write to it, as in "palette.py batch".
+            out.flush()
+        else:
+            out.close()
+        timer.lap('write')
+        if options.stream:
+            # Its size was added to the timings while streaming.
+            search_entries.close()
+        elif timings is not None:
+            timings.add_written(',\n'.join(search_entries))
+        if timings is not None:
+            timings.add_written(HTML_PREFIX + HTML_PALETTES_END + HTML_SEARCH_INDEX_END + HTML_SUFFIX)
+
+    if timings is not None:
+        if options.timings == 'json':
+            timings.write_json(sys.stderr)
+        else:
+            timings.write_table(sys.stderr)
+
+
+def stat_palette_files(paths):
+    '''Returns {filename: (size, mtime_ns)} for the palette files in the
+    command line, where directories stand for the *.gpl files inside them.
+    Files that cannot be found are left out.
+    '''
+    snapshot = {}
+    for filename in list_palette_files(paths):
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            continue
+        snapshot[filename] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+
+class PaletteWatcher:
+    '''Keeps the rendered palettes of --watch in memory, and updates the
+    output after re-rendering only the files that changed.
+    '''
 
-    for pal in palettes:
-        options.output.write(palette_to_html(pal))
+    def __init__(self, options):
+        self.options = options
+        # RenderedPalette list of each file, in command-line order.
+        self.rendered = {}
+        self.snapshot = {}
 
-    options.output.write(HTML_SUFFIX)
-    options.output.close()
+    def render(self, filenames):
+        '''Renders the files, returning {filename: [RenderedPalette]}. Files
+        that fail to load are reported and left out.
+        '''
+        options = self.options
+        cache = None
+        if options.cache:
+            cache = RenderCache(
+                options.cache,
+                max_bytes=options.cache_size * 1024 * 1024,
+                variant='compact' if options.compact else '',
+            )
+        try:
+            sources = []
+            owners = []
+            for filename in filenames:
+                try:
+                    expanded = expand_palette_sources([filename])
+                except (OSError, ValueError) as e:
+                    sys.stderr.write('{0}\n'.format(e))
+                    continue
+                sources.extend(expanded)
+                owners.extend([filename] * len(expanded))
+            try:
+                results = render_palette_files(sources, jobs=options.jobs, cache=cache, compact=options.compact)
+            except (OSError, ValueError):
+                # Some file is broken, maybe because it is being saved right
+                # now. Rendering each file on its own tells which one.
+                results = []
+                for source in sources:
+                    try:
+                        results.append(render_palette_file(source, compact=options.compact))
+                    except (OSError, ValueError) as e:
+                        sys.stderr.write('{0}\n'.format(e))
+                        results.append(None)
+        finally:
+            if cache is not None:
+                cache.close()
+
+        rendered = {}
+        failed = set()
+        for filename, result in zip(owners, results):
+            if result is None:
+                failed.add(filename)
+            rendered.setdefault(filename, []).append(result)
+        return {
+            filename: palettes
+            for filename, palettes in rendered.items()
+            if filename not in failed
+        }
+
+    def update(self, snapshot):
+        '''Brings the output up to date with a new snapshot of the files.
+        Returns the names of the files that were rendered again.
+        '''
+        changed = [
+            filename for filename, stat in snapshot.items()
+            if self.snapshot.get(filename) != stat
+        ]
+        rendered = self.render(changed)
+        self.rendered = {
+            filename: rendered.get(filename) or self.rendered.get(filename, [])
+            for filename in snapshot
+        }
+        self.snapshot = snapshot
+        self.write()
+        return changed
+
+    def write(self):
+        options = self.options
+        palettes = [r for rendered in self.rendered.values() for r in rendered]
+        # Same order as when not watching.
+        palettes.sort(key=lambda r: r.name.lower())
+        if options.output_dir is not None:
+            write_output_dir(palettes, options.output_dir, options.shard_size)
+        else:
+            page = io.StringIO()
+            write_page(palettes, page)
+            write_if_changed(options.output, page.getvalue())
+
+    def run(self, interval=1.0, debounce=0.3):
+        '''Writes the output, then polls the files forever. A rebuild starts
+        once the files stop changing for the debounce time, so a burst of
+        saves causes a single rebuild.
+        '''
+        seen = stat_palette_files(self.options.palettes)
+        seen_at = time.monotonic()
+        self.update(seen)
+        sys.stderr.write('Watching {0} files\n'.format(len(seen)))
+        while True:
+            time.sleep(interval)
+            snapshot = stat_palette_files(self.options.palettes)
+            now = time.monotonic()
+            if snapshot != seen:
+                seen = snapshot
+                seen_at = now
+            elif seen != self.snapshot and now - seen_at >= debounce:
+                start = time.perf_counter()
+                changed = self.update(seen)
+                sys.stderr.write('Updated the output for {0} changed files in {1:.3f} s\n'.format(
+                    len(changed), time.perf_counter() - start))
+
+
+def main():
+    options = parse_args()
+
+    if options.run_tests:
+        run_doctests_and_exit()
+
+    # TODO: Print error if len(options.palettes) == 0.
+
+    if options.watch:
+        watcher = PaletteWatcher(options)
+        try:
+            watcher.run(interval=options.watch_interval, debounce=options.debounce)
+        except KeyboardInterrupt:
+            pass
+    elif options.profile:
+        profile_call(lambda: build_html(options), options.profile)
+    else:
+        build_html(options)
 
 
 if __name__ == '__main__':
+    # Modules imported on demand, such as palette_pack, import this script
+    # by its name; this way it is not loaded a second time.
+    sys.modules.setdefault('gpl_to_html', sys.modules[__name__])
     main()
@@ -2,11 +2,16 @@
 #
 # Replaces colors in #fff or #ffffff notation with three integers: 255 255 255
 # Useful to generate a Gimp palette based on list of colors in hex notation.
+#
+# Colors are found without the re module, which takes longer to import than
+# this script takes to run, as it is often called from shell loops.
 
-import re
 import sys
 
 
+HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+
 def hex_to_rgb(value):
     if len(value) == 3:
         value = value[0] * 2 + value[1] * 2 + value[2] * 2
@@ -17,9 +22,31 @@ def hex_to_rgb(value):
     ))
 
 
-for line in sys.stdin.readlines():
-    line = re.sub(
-        r'#([0-9a-fA-F]{6}|[0-9a-fA-F]{3})',
-        lambda match: hex_to_rgb(match.group(1)),
-        line)
-    sys.stdout.write(line)
+def replace_hex_colors(line):
+    '''Replaces each # followed by 6, or else 3, hex digits.
+
+    >>> replace_hex_colors('#fff #FF0000 #abcd #12 x#0000ff\\n')
+    '255 255 255 255   0   0 170 187 204d #12 x  0   0 255\\n'
+    '''
+    parts = line.split('#')
+    out = [parts[0]]
+    for part in parts[1:]:
+        digits = 0
+        while digits < 6 and digits < len(part) and part[digits] in HEX_DIGITS:
+            digits += 1
+        if digits == 6:
+            out.append(hex_to_rgb(part[:6]) + part[6:])
+        elif digits >= 3:
+            out.append(hex_to_rgb(part[:3]) + part[3:])
+        else:
+            out.append('#' + part)
+    return ''.join(out)
+
+
+def main():
+    for line in sys.stdin.readlines():
+        sys.stdout.write(replace_hex_colors(line))
+
+
+if __name__ == '__main__':
+    main()
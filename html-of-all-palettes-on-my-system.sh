@@ -3,7 +3,7 @@
 # This is a simple script to generate an HTML preview of all palettes on my system.
 
 # Prefix the following line with "pudb3" to debug it.
-./gpl_to_html.py -o all-palettes.html \
+./gpl_to_html.py --jobs 0 --compact -o all-palettes.html \
 	$PWD/palettes/*.gpl \
 	~/.gimp-2.8/palettes/web_dev.gpl \
 	~/.gimp-2.8/palettes/Gimp_Palettes_by_nevit/*.gpl \
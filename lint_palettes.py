@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+#
+# Checks GIMP palette files for problems, reporting every one of them with
+# its file and line, instead of stopping at the first error as the parser in
+# gpl_to_html.py does. Files are checked in parallel, and results for files
+# that did not change are reused from a cache, so it is cheap enough to run
+# from a pre-commit hook:
+#
+#   git diff --cached --name-only -- '*.gpl' | xargs -r ./lint_palettes.py
+#
+# Reports are written as text, JSON, or SARIF (for code scanning tools).
+
+import argparse
+import glob
+import hashlib
+import json
+import os.path
+import sys
+from collections import namedtuple
+
+from gpl_to_html import _GPL_LINE_RE, list_palette_files
+
+
+# Rule: (severity, description). Severities are those of SARIF.
+RULES = {
+    'unreadable': ('error', 'The file cannot be read'),
+    'invalid-header': ('error', 'The first line is not "GIMP Palette"'),
+    'invalid-encoding': ('error', 'The file is not valid UTF-8'),
+    'invalid-line': ('error', 'A line is not a color, a comment or a header'),
+    'invalid-columns': ('error', 'Columns is not a number'),
+    'out-of-range': ('warning', 'A color component is outside 0..255 and gets clamped'),
+    'negative-columns': ('warning', 'Columns is negative'),
+    'repeated-header': ('warning', 'Name or Columns is given more than once'),
+    'missing-palette-name': ('warning', 'There is no Name line'),
+    'empty-palette': ('warning', 'There are no colors'),
+    'duplicate-color': ('warning', 'The same color appears more than once'),
+    'duplicate-name': ('note', 'Different colors have the same name'),
+    'missing-name': ('note', 'A color has no name'),
+}
+
+SEVERITIES = ('error', 'warning', 'note')
+
+Issue = namedtuple('Issue', 'filename line rule message')
+
+
+def lint_data(data, filename=None):
+    '''Returns every Issue found in the contents of a *.gpl file.
+
+    >>> for issue in lint_data(
+    ...     b'GIMP Palette\\nColumns: -2\\n0 0 0 Black\\n300 0 0\\nfoo\\n0 0 0 Black\\n', 'foo.gpl'):
+    ...     print(issue.line, issue.rule, issue.message)
+    1 missing-palette-name No Name line
+    2 negative-columns Columns is -2
+    4 out-of-range Red 300 is clamped to 255
+    4 missing-name Color has no name
+    5 invalid-line Invalid line 'foo'
+    6 duplicate-color Duplicate of #000000 at line 3
+
+    Columns: 0 means the default width, and more columns than colors is
+    harmless:
+
+    >>> lint_data(b'GIMP Palette\\nName: A\\nColumns: 0\\n0 0 0 A\\n'), lint_data(b'GIMP Palette\\nName: A\\nColumns: 9\\n0 0 0 A\\n')
+    ([], [])
+    '''
+    issues = []
+
+    def report(line, rule, message):
+        issues.append(Issue(filename, line, rule, message))
+
+    header_end = data.find(b'\n')
+    if header_end < 0:
+        header_end = len(data)
+    if data[:header_end].strip() != b'GIMP Palette':
+        report(1, 'invalid-header', 'Incorrect header at the first line')
+        return issues
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError as e:
+        report(data.count(b'\n', 0, e.start) + 1, 'invalid-encoding', 'Invalid UTF-8: {0}'.format(e.reason))
+        return issues
+
+    name_line = None
+    columns_line = None
+    colors = 0
+    # First line of each color, and of each name with the color it names.
+    seen_colors = {}
+    seen_names = {}
+    lines = _GPL_LINE_RE.findall(data, header_end + 1)
+    for lineno, (key, value, comment, r, g, b, name, invalid) in enumerate(lines, 2):
+        if r:
+            colors += 1
+            components = []
+            for channel, component in zip(('Red', 'Green', 'Blue'), (r, g, b)):
+                component = int(component)
+                clamped = min(255, max(0, component))
+                if clamped != component:
+                    report(lineno, 'out-of-range', '{0} {1} is clamped to {2}'.format(channel, component, clamped))
+                components.append(clamped)
+            color = '#{0:02x}{1:02x}{2:02x}'.format(*components)
+            name = name.decode('utf-8').strip()
+
+            if not name or name == 'Untitled':
+                report(lineno, 'missing-name', 'Color has no name')
+            elif name in seen_names and seen_names[name][1] != color:
+                report(lineno, 'duplicate-name', 'Name {0!r} is also used at line {1} for {2}'.format(
+                    name, seen_names[name][0], seen_names[name][1]))
+            else:
+                seen_names.setdefault(name, (lineno, color))
+
+            if color in seen_colors:
+                report(lineno, 'duplicate-color', 'Duplicate of {0} at line {1}'.format(color, seen_colors[color]))
+            else:
+                seen_colors[color] = lineno
+        elif key == b'Name':
+            if name_line is not None:
+                report(lineno, 'repeated-header', 'Name was already given at line {0}'.format(name_line))
+            name_line = lineno
+        elif key == b'Columns':
+            if columns_line is not None:
+                report(lineno, 'repeated-header', 'Columns was already given at line {0}'.format(columns_line))
+            columns_line = lineno
+            try:
+                columns = int(value)
+            except ValueError:
+                report(lineno, 'invalid-columns', 'Invalid Columns {0!r}'.format(value.decode('utf-8').strip()))
+            else:
+                if columns < 0:
+                    report(lineno, 'negative-columns', 'Columns is {0}'.format(columns))
+        elif invalid:
+            report(lineno, 'invalid-line', 'Invalid line {0!r}'.format(invalid.decode('utf-8').strip()))
+
+    if name_line is None:
+        report(1, 'missing-palette-name', 'No Name line')
+    if colors == 0:
+        report(1, 'empty-palette', 'No colors')
+
+    issues.sort(key=lambda issue: issue.line)
+    return issues
+
+
+def lint_file(filename):
+    '''Returns (filename, (size, mtime_ns), issues) for one file.'''
+    with open(filename, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        data = f.read()
+    return (filename, (stat.st_size, stat.st_mtime_ns), lint_data(data, filename))
+
+
+class LintCache:
+    '''Issues of each file, saved as JSON and reused while the size and
+    mtime of the file stay the same. Changes to this script or to the
+    parser invalidate the whole cache.
+    '''
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.version = self.current_version()
+        self.files = {}
+        self.changed = False
+        try:
+            with open(filename) as f:
+                saved = json.load(f)
+            if saved.get('version') == self.version:
+                self.files = saved['files']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    @classmethod
+    def current_version(cls):
+        digest = hashlib.sha256()
+        for module in (__file__, sys.modules['gpl_to_html'].__file__):
+            with open(module, 'rb') as f:
+                digest.update(f.read())
+        return '{0}:{1}'.format(cls.FORMAT_VERSION, digest.hexdigest())
+
+    def get(self, filename):
+        '''Returns the cached issues of the file, or None.'''
+        entry = self.files.get(filename)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        size, mtime_ns, issues = entry
+        if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return [Issue(*issue) for issue in issues]
+
+    def put(self, filename, stat, issues):
+        self.files[filename] = [stat[0], stat[1], [list(issue) for issue in issues]]
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Writing to a temporary file first, so concurrent runs never see a
+        # partially written cache.
+        temporary = '{0}.{1}.tmp'.format(self.filename, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump({'version': self.version, 'files': self.files}, f)
+        os.replace(temporary, self.filename)
+
+
+def lint_files(filenames, jobs=1, cache=None):
+    '''Returns the issues of all files, in the order of the files. Files
+    that cannot be read are reported as errors too.
+    '''
+    results = {}
+    pending = []
+    for filename in filenames:
+        issues = cache.get(filename) if cache else None
+        if issues is None:
+            pending.append(filename)
+        else:
+            results[filename] = issues
+
+    if jobs == 1 or len(pending) < 2:
+        checked = list(map(_lint_file_or_error, pending))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        jobs = jobs or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            checked = list(executor.map(
+                _lint_file_or_error,
+                pending,
+                chunksize=max(1, len(pending) // (4 * jobs)),
+            ))
+
+    for filename, stat, issues in checked:
+        results[filename] = issues
+        # Files that could not be read are checked again next time.
+        if cache is not None and stat is not None:
+            cache.put(filename, stat, issues)
+    if cache is not None:
+        cache.save()
+
+    return [issue for filename in filenames for issue in results[filename]]
+
+
+def _lint_file_or_error(filename):
+    try:
+        return lint_file(filename)
+    except OSError as e:
+        return (filename, None, [Issue(filename, 0, 'unreadable', e.strerror or str(e))])
+
+
+def severity(issue):
+    return RULES[issue.rule][0]
+
+
+def write_text(issues, out):
+    for issue in issues:
+        # Issues about the whole file, such as not being readable, are at line 0.
+        location = '{0}:{1}'.format(issue.filename, issue.line) if issue.line else issue.filename
+        out.write('{0}: {1}: {2} [{3}]\n'.format(location, severity(issue), issue.message, issue.rule))
+
+
+def write_json(issues, out):
+    json.dump([
+        dict(issue._asdict(), severity=severity(issue))
+        for issue in issues
+    ], out, indent=2)
+    out.write('\n')
+
+
+def _sarif_result(issue, rule_indexes):
+    return {
+        'ruleId': issue.rule,
+        'ruleIndex': rule_indexes[issue.rule],
+        'level': severity(issue),
+        'message': {'text': issue.message},
+        'locations': [{
+            'physicalLocation': {
+                'artifactLocation': {'uri': issue.filename.replace(os.sep, '/')},
+                'region': {'startLine': max(1, issue.line)},
+            },
+        }],
+    }
+
+
+def write_sarif(issues, out):
+    '''Writes a SARIF 2.1.0 log, as read by code scanning tools.'''
+    rule_indexes = {rule: i for i, rule in enumerate(RULES)}
+    json.dump({
+        'version': '2.1.0',
+        '$schema': 'https://json.schemastore.org/sarif-2.1.0.json',
+        'runs': [{
+            'tool': {
+                'driver': {
+                    'name': 'lint_palettes.py',
+                    'rules': [
+                        {
+                            'id': rule,
+                            'shortDescription': {'text': description},
+                            'defaultConfiguration': {'level': level},
+                        }
+                        for rule, (level, description) in RULES.items()
+                    ],
+                },
+            },
+            'results': [_sarif_result(issue, rule_indexes) for issue in issues],
+        }],
+    }, out, indent=2)
+    out.write('\n')
+
+
+WRITERS = {
+    'text': write_text,
+    'json': write_json,
+    'sarif': write_sarif,
+}
+
+
+def parse_args():
+    default_palettes = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'palettes', '*.gpl')
+    parser = argparse.ArgumentParser(
+        description='Checks GIMP palettes for problems',
+        epilog='Rules: ' + '; '.join(
+            '{0} ({1}): {2}'.format(rule, level, description)
+            for rule, (level, description) in RULES.items()
+        ) + '.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-f', '--format',
+        choices=list(WRITERS),
+        default='text',
+        help='Report format'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        default='-',
+        help='Where to write the report; - means stdout'
+    )
+    parser.add_argument(
+        '--ignore',
+        metavar='RULE',
+        action='append',
+        default=[],
+        help='Rule to leave out of the report; can be given many times'
+    )
+    parser.add_argument(
+        '--min-severity',
+        choices=SEVERITIES,
+        default='warning',
+        help='Leave out issues less severe than this'
+    )
+    parser.add_argument(
+        '--fail-on',
+        choices=SEVERITIES,
+        default='error',
+        help='Exit with status 1 if any reported issue is at least this severe'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Check files in this many processes (0 means one per CPU)'
+    )
+    parser.add_argument(
+        '--cache',
+        metavar='FILE',
+        default=os.path.join('.cache', 'lint.json'),
+        help='Where the results of unchanged files are kept. Use an empty'
+        ' string to not use a cache'
+    )
+    parser.add_argument(
+        'palettes',
+        nargs='*',
+        default=sorted(glob.glob(default_palettes)),
+        help='GIMP Palette files (*.gpl) or directories with such files'
+    )
+    options = parser.parse_args()
+    for rule in options.ignore:
+        if rule not in RULES:
+            parser.error('unknown rule {0!r}'.format(rule))
+    return options
+
+
+def main():
+    options = parse_args()
+
+    cache = LintCache(options.cache) if options.cache else None
+    issues = lint_files(list_palette_files(options.palettes), jobs=options.jobs, cache=cache)
+
+    reported_severities = SEVERITIES[:SEVERITIES.index(options.min_severity) + 1]
+    issues = [
+        issue for issue in issues
+        if issue.rule not in options.ignore and severity(issue) in reported_severities
+    ]
+
+    if options.output == '-':
+        WRITERS[options.format](issues, sys.stdout)
+    else:
+        with open(options.output, 'w') as f:
+            WRITERS[options.format](issues, f)
+
+    failing_severities = SEVERITIES[:SEVERITIES.index(options.fail_on) + 1]
+    if any(severity(issue) in failing_severities for issue in issues):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,14 @@ fi
 
 set -ex
 
-./gpl_to_html.py palettes/*.gpl \
+# Unchanged palettes are reused from this cache instead of being rendered again.
+cache="${GPL_TO_HTML_CACHE:-.cache/gpl_to_html.sqlite3}"
+mkdir -p "$(dirname "${cache}")"
+
+# Names and statistics of the palettes, see palette_manifest.py.
+manifest="${PALETTE_MANIFEST:-.cache/manifest.sqlite3}"
+
+./gpl_to_html.py --cache "${cache}" --stream --manifest "${manifest}" palettes/*.gpl \
 	| sed 's|\(href="\)\(palettes/[^"]*\.gpl"\)|\1https://raw.githubusercontent.com/denilsonsa/gimp-palettes/master/\2|g' \
 	| sed 's|\(</head>\)|<script data-goatcounter="https://denilsonsa.goatcounter.com/count" async src="//gc.zgo.at/count.js"></script>\n\1|' \
 	| sed 's|\(<body[^>]*>.*\)|\1\n<h1 style="text-align:center">Palettes for GIMP, Inkscape, Calligra/Krita, MyPaint, Aseprite, Drawpile... <a href="https://github.com/denilsonsa/gimp-palettes" style="text-decoration:none">https://github.com/denilsonsa/gimp-palettes</a></h1>\n|' \
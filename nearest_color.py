@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+#
+# Finds the named colors closest to a given color, across many palettes.
+#
+# All colors of all palettes are put into a uniform grid over RGB, CIELAB or
+# OKLab. The index is saved to disk and reused while the palette files are
+# unchanged, so repeated queries do not parse the palettes again.
+
+import argparse
+import glob
+import heapq
+import os.path
+import pickle
+import sys
+from array import array
+from collections import namedtuple
+
+import colorspaces
+from gpl_to_html import Color, NamedColor, expand_palette_sources, load_palette_source
+
+
+class UniformGrid:
+    '''Uniform grid over 3D points, for k-nearest neighbour queries.
+
+    The bounding box of the points is split into the same number of cells
+    along each axis, aiming at a couple of points per cell. A query visits
+    cells in growing shells around the cell of the query point, and stops
+    as soon as no unvisited cell can hold a closer point.
+
+    >>> grid = UniformGrid([(0, 0, 0), (10, 0, 0), (0, 10, 10), (9, 9, 9)])
+    >>> grid.nearest((8, 8, 8), k=2)
+    [(1.7320508075688772, 3), (8.48528137423857, 2)]
+    >>> grid.nearest((100, 100, 100), k=1)
+    [(157.61662348876783, 3)]
+    >>> grid.remove(3)
+    >>> len(grid)
+    3
+    >>> grid.nearest((8, 8, 8), k=1)
+    [(8.48528137423857, 2)]
+    '''
+
+    def __init__(self, points, points_per_cell=2):
+        self.coords = array('d')
+        for point in points:
+            self.coords.extend(point)
+        count = len(self.coords) // 3
+
+        self.origin = [min(self.coords[axis::3], default=0.0) for axis in range(3)]
+        highest = [max(self.coords[axis::3], default=0.0) for axis in range(3)]
+        self.divisions = max(1, min(64, round((count / points_per_cell) ** (1 / 3))))
+        self.cell_size = [
+            (high - low) / self.divisions or 1.0
+            for low, high in zip(self.origin, highest)
+        ]
+
+        self.cells = {}
+        for index in range(count):
+            key = self.cell_of(self.coords[3 * index:3 * index + 3])
+            self.cells.setdefault(key, []).append(index)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def remove(self, index):
+        '''Removes a point, so that it is not returned by nearest() anymore.'''
+        key = self.cell_of(self.coords[3 * index:3 * index + 3])
+        cell = self.cells[key]
+        cell.remove(index)
+        if not cell:
+            del self.cells[key]
+        self.count -= 1
+
+    def cell_of(self, point):
+        '''Returns the (x, y, z) cell containing the point, clamped to the grid.'''
+        last = self.divisions - 1
+        return tuple(
+            min(last, max(0, int((value - low) // size)))
+            for value, low, size in zip(point, self.origin, self.cell_size)
+        )
+
+    def _shell(self, center, radius):
+        '''Yields the cells at Chebyshev distance radius from center.'''
+        cx, cy, cz = center
+        last = self.divisions - 1
+        zs_all = range(max(0, cz - radius), min(last, cz + radius) + 1)
+        zs_faces = [z for z in (cz - radius, cz + radius) if 0 <= z <= last]
+        for x in range(max(0, cx - radius), min(last, cx + radius) + 1):
+            for y in range(max(0, cy - radius), min(last, cy + radius) + 1):
+                if radius == 0 or abs(x - cx) == radius or abs(y - cy) == radius:
+                    zs = zs_all
+                else:
+                    zs = zs_faces
+                for z in zs:
+                    yield (x, y, z)
+
+    def _searched_distance(self, point, center, radius):
+        '''Returns how far from the point all cells up to the given Chebyshev
+        distance from center reach. Any point not yet found is farther.
+        '''
+        reach = float('inf')
+        for value, low, size, c in zip(point, self.origin, self.cell_size, center):
+            if c - radius > 0:
+                reach = min(reach, value - (low + (c - radius) * size))
+            if c + radius + 1 < self.divisions:
+                reach = min(reach, low + (c + radius + 1) * size - value)
+        return reach
+
+    def nearest(self, point, k=1):
+        '''Returns up to k (distance, index) pairs, closest first.'''
+        px, py, pz = point
+        coords = self.coords
+        cells = self.cells
+        center = self.cell_of(point)
+
+        # Max-heap of the best candidates, as (-squared distance, -index), and
+        # the squared distance a candidate must beat to enter it.
+        best = []
+        worst = float('inf')
+        visited = 0
+        for radius in range(self.divisions):
+            # After many removals most cells are empty, and once more cells
+            # were visited than there are non-empty ones, it is cheaper to
+            # scan all the remaining non-empty cells at once.
+            scan_rest = visited > len(cells)
+            if scan_rest:
+                shell = [
+                    cell for cell in cells
+                    if max(abs(a - b) for a, b in zip(cell, center)) >= radius
+                ]
+            else:
+                shell = self._shell(center, radius)
+            for cell in shell:
+                visited += 1
+                for index in cells.get(cell, ()):
+                    i = 3 * index
+                    dx = coords[i] - px
+                    dy = coords[i + 1] - py
+                    dz = coords[i + 2] - pz
+                    distance = dx * dx + dy * dy + dz * dz
+                    if distance <= worst:
+                        candidate = (-distance, -index)
+                        if len(best) < k:
+                            heapq.heappush(best, candidate)
+                        elif candidate > best[0]:
+                            heapq.heapreplace(best, candidate)
+                        if len(best) == k:
+                            worst = -best[0][0]
+            if scan_rest:
+                break
+            if len(best) == k:
+                reach = self._searched_distance(point, center, radius)
+                if reach * reach >= worst:
+                    break
+
+        return [((-d) ** 0.5, -i) for d, i in sorted(best, reverse=True)]
+
+
+Match = namedtuple('Match', 'distance color palette filename')
+
+# Color spaces where the Euclidean distance is meaningful.
+SPACES = ('rgb', 'linear', 'xyz', 'lab', 'oklab')
+
+
+class ColorIndex:
+    '''Index of every named color in a set of palette files.
+
+    >>> index = ColorIndex.build(['palettes/CSS-named-colors.gpl'], space='rgb')
+    >>> [m.color for m in index.nearest('#3a7bd5', k=2)]
+    [NamedColor(65, 105, 225, name='royalblue'), NamedColor(70, 130, 180, name='steelblue')]
+    >>> index.nearest(Color(255, 255, 255))[0].palette
+    'CSS Color Module Level 4 named colors'
+    '''
+
+    FORMAT_VERSION = 3
+
+    def __init__(self, space='rgb'):
+        # Validates the space name.
+        colorspaces.convert(space, 0, 0, 0)
+        self.space = space
+        # (filename, size, mtime_ns) of each indexed file.
+        self.sources = []
+        self.palette_names = []
+        self.palette_filenames = []
+        # One entry per color, in the same packed layout as GimpPalette.
+        self.rgb = bytearray()
+        self.color_names = []
+        self.palette_ids = array('I')
+        self.grid = None
+
+    @staticmethod
+    def stat_files(sources):
+        '''Returns the (filename, size, mtime_ns) of each file the expanded
+        palette sources are read from, so that editing a palette inside a
+        directory or rebuilding a collection invalidates the index.
+        '''
+        filenames = []
+        for source in sources:
+            filename = source if isinstance(source, str) else source.collection
+            if filename not in filenames:
+                filenames.append(filename)
+        stats = []
+        for filename in filenames:
+            stat = os.stat(filename)
+            stats.append((filename, stat.st_size, stat.st_mtime_ns))
+        return stats
+
+    @classmethod
+    def build(cls, filenames, space='rgb'):
+        index = cls(space)
+        sources = expand_palette_sources(filenames)
+        index.sources = cls.stat_files(sources)
+        palettes = map(load_palette_source, sources)
+        for palette_id, pal in enumerate(palettes):
+            index.palette_names.append(pal.name)
+            index.palette_filenames.append(pal.filename)
+            index.rgb += pal.rgb
+            index.color_names.extend(pal.color_names)
+            index.palette_ids.extend([palette_id] * len(pal.color_names))
+
+        index.grid = UniformGrid(colorspaces.convert_all(space, index.rgb))
+        return index
+
+    @classmethod
+    def load_or_build(cls, filenames, space='rgb', index_filename=None):
+        '''Loads the index saved at index_filename, if it is still valid for
+        these files, otherwise builds it again and saves it.
+
+        Directories are checked file by file, so editing a palette inside
+        one invalidates the saved index:
+
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp:
+        ...     path = os.path.join(tmp, 'a.gpl')
+        ...     with open(path, 'w') as f:
+        ...         _ = f.write('GIMP Palette\\nName: A\\n0 0 0 black\\n')
+        ...     saved = os.path.join(tmp, 'index.pickle')
+        ...     _ = ColorIndex.load_or_build([tmp], index_filename=saved)
+        ...     with open(path, 'a') as f:
+        ...         _ = f.write('255 255 255 white\\n')
+        ...     len(ColorIndex.load_or_build([tmp], index_filename=saved))
+        2
+        '''
+        if index_filename:
+            try:
+                with open(index_filename, 'rb') as f:
+                    version, index = pickle.load(f)
+                if (
+                    version == cls.FORMAT_VERSION
+                    and index.space == space
+                    and index.sources == cls.stat_files(expand_palette_sources(filenames))
+                ):
+                    return index
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+                pass
+
+        index = cls.build(filenames, space)
+        if index_filename:
+            index.save(index_filename)
+        return index
+
+    def save(self, filename):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Writing to a temporary file first, so concurrent readers never see
+        # a partially written index.
+        temporary = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(temporary, 'wb') as f:
+            pickle.dump((self.FORMAT_VERSION, self), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, filename)
+
+    def __len__(self):
+        return len(self.color_names)
+
+    def nearest(self, color, k=5):
+        '''Returns the k closest colors as Match tuples, closest first.
+
+        The color can be a Color object or a string such as '#3a7bd5'.
+        '''
+        if isinstance(color, str):
+            color = Color(color)
+        point = colorspaces.convert(self.space, color.r, color.g, color.b)
+        matches = []
+        for distance, i in self.grid.nearest(point, k):
+            palette_id = self.palette_ids[i]
+            matches.append(Match(
+                distance,
+                NamedColor.from_int(int.from_bytes(self.rgb[3 * i:3 * i + 3], 'big'), self.color_names[i]),
+                self.palette_names[palette_id],
+                self.palette_filenames[palette_id],
+            ))
+        return matches
+
+
+def parse_args():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    default_palettes = os.path.join(script_dir, 'palettes', '*.gpl')
+    parser = argparse.ArgumentParser(
+        description='Finds the named colors closest to the given colors',
+        epilog='The index of all colors is saved to a file and reused while'
+        ' the palette files do not change.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-k',
+        type=int,
+        default=5,
+        help='How many colors to report for each query'
+    )
+    parser.add_argument(
+        '-s', '--space',
+        choices=SPACES,
+        default='rgb',
+        help='Color space where distances are measured'
+    )
+    parser.add_argument(
+        '--index',
+        metavar='FILE',
+        # Next to the script rather than in the working directory, so that
+        # running it elsewhere never unpickles a file found there.
+        default=os.path.join(script_dir, '.cache', 'nearest-{space}.pickle'),
+        help='Where the index is saved; {space} is replaced by the color space.'
+        ' Use an empty string to not save it'
+    )
+    parser.add_argument(
+        '-p', '--palettes',
+        nargs='+',
+        default=sorted(glob.glob(default_palettes)),
+        help='GIMP Palette files (*.gpl) or compiled collections (*.gplpack) to search'
+    )
+    parser.add_argument(
+        'colors',
+        nargs='+',
+        help='Colors to look for, as #RRGGBB or #RGB'
+    )
+    options = parser.parse_args()
+    return options
+
+
+def main():
+    options = parse_args()
+
+    index = ColorIndex.load_or_build(
+        options.palettes,
+        space=options.space,
+        index_filename=options.index.format(space=options.space),
+    )
+
+    for query in options.colors:
+        try:
+            color = Color(query if query.startswith('#') else '#' + query)
+        except ValueError as e:
+            sys.exit('Invalid color {0!r}: {1}'.format(query, e))
+        print(color)
+        for match in index.nearest(color, k=options.k):
+            print('{0:10.4f}  {1}  {2}  ({3}, {4})'.format(
+                match.distance,
+                match.color,
+                match.color.name,
+                match.palette,
+                match.filename,
+            ))
+
+
+if __name__ == '__main__':
+    main()
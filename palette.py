@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# Single entry point for the tools in this repository, as subcommands:
+#
+#   ./palette.py html -o all-palettes.html palettes/*.gpl
+#   ./palette.py sort --in-place palettes/Tango.gpl
+#   ./palette.py hex2rgb < colors.txt
+#
+# Only the module of the subcommand is imported, and it is imported from its
+# cached bytecode, while a script run directly is compiled again every time.
+# Each subcommand takes the same options as the script it stands for.
+#
+# To run many commands in a single process, list them in a manifest, one per
+# line, with the same quoting as in a shell, and give it to "batch":
+#
+#   for f in palettes/*.gpl; do echo "sort -i '$f'"; done | ./palette.py batch
+#
+# Startup is measured by the "startup" benchmark of benchmark.py, which fails
+# when a subcommand goes over its budget in STARTUP_BUDGETS there.
+
+import sys
+
+
+# Subcommand: (module, description). The module must have a main() function
+# that reads its options from sys.argv.
+COMMANDS = {
+    'html': ('gpl_to_html', 'Renders palettes as an HTML page'),
+    'sort': ('sort_by_hue', 'Sorts the colors of palettes'),
+    'hex2rgb': ('hex_to_decimal_rgb', 'Replaces #RRGGBB colors in stdin by decimal RGB'),
+    'convert': ('convert_palettes', 'Converts palettes to and from other formats'),
+    'quantize': ('quantize_image', 'Maps the colors of an image to a palette'),
+    'nearest': ('nearest_color', 'Finds the named colors closest to a color'),
+    'similar': ('similar_palettes', 'Finds duplicate and near-duplicate palettes'),
+    'lint': ('lint_palettes', 'Checks palettes for problems'),
+    'manifest': ('palette_manifest', 'Keeps statistics of palettes in a manifest and queries them'),
+    'pack': ('palette_pack', 'Compiles palettes into a binary collection'),
+    'serve': ('palette_server', 'Serves a live preview of palettes over HTTP'),
+}
+
+PROG = 'palette.py'
+
+
+def usage():
+    width = max(map(len, COMMANDS))
+    lines = [
+        'usage: {0} COMMAND [ARGS...]'.format(PROG),
+        '       {0} batch [MANIFEST]'.format(PROG),
+        '',
+        'Commands (see "{0} COMMAND --help"):'.format(PROG),
+    ]
+    for name, (module, description) in COMMANDS.items():
+        lines.append('  {0:<{1}}  {2}'.format(name, width, description))
+    lines.append('  {0:<{1}}  {2}'.format('batch', width, 'Runs the commands listed in a file, or stdin, in this process'))
+    return '\n'.join(lines) + '\n'
+
+
+def run_command(argv):
+    '''Runs one subcommand, given its name and arguments, and returns its
+    exit status.
+
+    >>> run_command(['sort', '--no-such-option'])
+    2
+    '''
+    name = argv[0]
+    if name not in COMMANDS:
+        sys.exit('{0}: unknown command {1!r}\n\n{2}'.format(PROG, name, usage()))
+    module_name = COMMANDS[name][0]
+    module = __import__(module_name)
+
+    saved_argv = sys.argv
+    sys.argv = ['{0} {1}'.format(PROG, name)] + list(argv[1:])
+    try:
+        module.main()
+    except SystemExit as e:
+        if e.code is None or e.code == 0:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        sys.stderr.write('{0}\n'.format(e.code))
+        return 1
+    finally:
+        sys.argv = saved_argv
+        sys.stdout.flush()
+    return 0
+
+
+def run_batch(f, filename):
+    '''Runs every command in a manifest, one per line. Blank lines and lines
+    starting with # are skipped. Returns how many commands failed.
+
+    Commands that write to stdout leave it open for the next ones:
+
+    >>> import io
+    >>> from contextlib import redirect_stdout
+    >>> out = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+    >>> manifest = io.StringIO('html palettes/DawnBringer16.gpl\\nsort palettes/DawnBringer16.gpl\\n')
+    >>> with redirect_stdout(out):
+    ...     failed = run_batch(manifest, 'manifest')
+    >>> out.flush()
+    >>> data = out.buffer.getvalue()
+    >>> failed, data.count(b'</html>'), data.count(b'GIMP Palette')
+    (0, 1, 1)
+    '''
+    import shlex
+
+    failed = 0
+    for lineno, line in enumerate(f, 1):
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError as e:
+            sys.stderr.write('{0}:{1}: {2}\n'.format(filename, lineno, e))
+            failed += 1
+            continue
+        if not argv:
+            continue
+        if argv[0] == 'batch':
+            sys.stderr.write('{0}:{1}: batch cannot be nested\n'.format(filename, lineno))
+            failed += 1
+            continue
+        if argv[0] not in COMMANDS:
+            sys.stderr.write('{0}:{1}: unknown command {2!r}\n'.format(filename, lineno, argv[0]))
+            failed += 1
+            continue
+        try:
+            status = run_command(argv)
+        except Exception:
+            # A command that crashes would have exited with status 1 when
+            # run on its own; the other commands still run.
+            import traceback
+
+            traceback.print_exc()
+            status = 1
+        if status:
+            sys.stderr.write('{0}:{1}: exit status {2}: {3}\n'.format(filename, lineno, status, line.strip()))
+            failed += 1
+    return failed
+
+
+def main():
+    args = sys.argv[1:]
+    if not args or args[0] in ('-h', '--help', 'help') and len(args) == 1:
+        sys.stdout.write(usage())
+        return
+    if args[0] == 'help':
+        args = [args[1], '--help']
+
+    if args[0] == 'batch':
+        if len(args) > 2 or args[1:] in (['-h'], ['--help']):
+            sys.exit('usage: {0} batch [MANIFEST]'.format(PROG))
+        filename = args[1] if len(args) == 2 and args[1] != '-' else None
+        if filename is None:
+            failed = run_batch(sys.stdin, '<stdin>')
+        else:
+            with open(filename) as f:
+                failed = run_batch(f, filename)
+        if failed:
+            sys.exit('{0}: {1} commands failed'.format(PROG, failed))
+        return
+
+    sys.exit(run_command(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+#
+# Manifest of a palette collection: the name, color counts, columns, comments
+# and content hash of every palette, plus the set of colors in each one, in a
+# SQLite database. Other tools read these facts from here instead of parsing
+# every file again:
+#
+#   ./gpl_to_html.py --stream --manifest .cache/manifest.sqlite3 palettes/
+#   ./similar_palettes.py --manifest .cache/manifest.sqlite3
+#
+# The manifest is brought up to date before every use. Only files whose size
+# or mtime changed are read again, and only those whose content hash changed
+# are parsed again.
+#
+# Running this script updates the manifest and lists the palettes matching
+# the given conditions:
+#
+#   ./palette_manifest.py --min-colors 257
+#   ./palette_manifest.py --contains '#ff0000' --contains '#00ff00'
+
+import argparse
+import hashlib
+import json
+import os.path
+import sqlite3
+import sys
+from collections import namedtuple
+
+from gpl_to_html import Color, GimpPalette, stat_palette_files
+
+
+Entry = namedtuple('Entry', 'filename size mtime_ns sha256 name columns colors unique_colors comments')
+
+
+def read_palette_entry(filename):
+    '''Parses a palette file, returning its Entry and the sorted list of its
+    distinct colors, as 0xRRGGBB integers.
+
+    This is the unit of work sent to each process when using --jobs.
+    '''
+    with open(filename, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        data = f.read()
+    pal = GimpPalette.new_from_bytes(data, filename=filename)
+    rgb = pal.rgb
+    unique = sorted({r << 16 | g << 8 | b for r, g, b in zip(rgb[0::3], rgb[1::3], rgb[2::3])})
+    entry = Entry(
+        filename=filename,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        sha256=hashlib.sha256(data).hexdigest(),
+        name=pal.name,
+        columns=pal.columns,
+        colors=len(pal.color_names),
+        unique_colors=len(unique),
+        comments=pal.comments,
+    )
+    return entry, unique
+
+
+def _read_palette_entry_or_error(filename):
+    try:
+        return filename, read_palette_entry(filename), None
+    except (OSError, ValueError) as e:
+        return filename, None, str(e)
+
+
+def color_value(text):
+    '''Parses a color given in the command line into a 0xRRGGBB integer.
+
+    >>> hex(color_value('#ff0000')), hex(color_value('0f0'))
+    ('0xff0000', '0xff00')
+    '''
+    color = Color(text if text.startswith('#') else '#' + text)
+    return color.r << 16 | color.g << 8 | color.b
+
+
+class PaletteManifest:
+    '''Statistics and colors of palette files, in a SQLite database.
+
+    Entries are keyed by the file name as given to update(). The whole
+    manifest is discarded whenever the parser in gpl_to_html.py changes.
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> filename = os.path.join(directory, 'rgb.gpl')
+    >>> with open(filename, 'w') as f:
+    ...     _ = f.write('GIMP Palette\\nName: RGB\\n255 0 0 Red\\n0 255 0 Green\\n255 0 0 Red\\n')
+    >>> with PaletteManifest(os.path.join(directory, 'manifest.sqlite3')) as manifest:
+    ...     manifest.update([directory])  # doctest: +ELLIPSIS
+    ...     [(e.name, e.colors, e.unique_colors) for e in manifest.query(contains=[0xff0000])]
+    ...     manifest.query(min_colors=4)
+    ...     manifest.update([directory])
+    ([...rgb.gpl'], [], [])
+    [('RGB', 3, 2)]
+    []
+    ([], [], [])
+    '''
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, filename):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(filename)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        version = self.version()
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != version:
+            with self.db:
+                self.db.execute('DROP TABLE IF EXISTS palettes')
+                self.db.execute('DROP TABLE IF EXISTS colors')
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS palettes (
+                filename TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sha256 TEXT,
+                name TEXT,
+                columns INTEGER,
+                colors INTEGER,
+                unique_colors INTEGER,
+                comments TEXT
+            )
+        ''')
+        # Keyed by color first, so finding the palettes with a color is a
+        # single index lookup.
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS colors (
+                rgb INTEGER,
+                filename TEXT,
+                PRIMARY KEY (rgb, filename)
+            ) WITHOUT ROWID
+        ''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS colors_by_filename ON colors (filename)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def version(cls):
+        '''Returns a stamp that changes whenever the parser may have changed.'''
+        with open(sys.modules[GimpPalette.__module__].__file__, 'rb') as f:
+            source = f.read()
+        return '{0}:{1}'.format(cls.FORMAT_VERSION, hashlib.sha256(source).hexdigest())
+
+    def update(self, paths, jobs=1):
+        '''Brings the entries of the palette files in paths up to date, where
+        directories stand for the *.gpl files inside them, and deletes the
+        entries of files that no longer exist.
+
+        Returns three lists: the files parsed again, the files deleted, and
+        (filename, message) for the files that could not be parsed, which
+        are left out of the manifest.
+        '''
+        snapshot = stat_palette_files([path for path in paths if path != '-'])
+        known = {
+            filename: (size, mtime_ns, sha256)
+            for filename, size, mtime_ns, sha256 in self.db.execute(
+                'SELECT filename, size, mtime_ns, sha256 FROM palettes')
+        }
+
+        stale = []
+        for filename, stat in snapshot.items():
+            if filename.endswith('.gplpack'):
+                # Compiled collections have an index of their own.
+                continue
+            entry = known.get(filename)
+            if entry is None:
+                stale.append(filename)
+            elif entry[:2] != stat:
+                # A fresh git checkout changes the mtime, but not the content.
+                with open(filename, 'rb') as f:
+                    if hashlib.sha256(f.read()).hexdigest() == entry[2]:
+                        self.db.execute(
+                            'UPDATE palettes SET size = ?, mtime_ns = ? WHERE filename = ?',
+                            stat + (filename,))
+                        continue
+                stale.append(filename)
+
+        deleted = [filename for filename in known if not os.path.exists(filename)]
+        for filename in deleted:
+            self._delete(filename)
+
+        updated = []
+        errors = []
+        for filename, result, error in self._read_entries(stale, jobs):
+            if error is not None:
+                self._delete(filename)
+                errors.append((filename, error))
+                continue
+            entry, unique = result
+            self._delete(filename)
+            self.db.execute(
+                'INSERT INTO palettes VALUES ({0})'.format(', '.join('?' * len(Entry._fields))),
+                entry._replace(comments=json.dumps(entry.comments)),
+            )
+            self.db.executemany('INSERT INTO colors VALUES (?, ?)', [(rgb, filename) for rgb in unique])
+            updated.append(filename)
+
+        self.db.commit()
+        return updated, deleted, errors
+
+    def _read_entries(self, filenames, jobs):
+        if jobs == 1 or len(filenames) < 2:
+            return map(_read_palette_entry_or_error, filenames)
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        jobs = jobs or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(
+                _read_palette_entry_or_error,
+                filenames,
+                chunksize=max(1, len(filenames) // (4 * jobs)),
+            ))
+
+    def _delete(self, filename):
+        self.db.execute('DELETE FROM palettes WHERE filename = ?', (filename,))
+        self.db.execute('DELETE FROM colors WHERE filename = ?', (filename,))
+
+    def get(self, filename):
+        '''Returns the Entry of a file, or None.'''
+        row = self.db.execute(
+            'SELECT {0} FROM palettes WHERE filename = ?'.format(', '.join(Entry._fields)),
+            (filename,),
+        ).fetchone()
+        return None if row is None else self._entry(row)
+
+    def query(self, min_colors=None, max_colors=None, contains=(), name=None):
+        '''Returns the Entry of every palette matching all the conditions,
+        sorted by name as in the page made by gpl_to_html.py.
+
+        The color counts include repeated colors. `contains` is a list of
+        0xRRGGBB integers that must all be in the palette, and `name` is a
+        case-insensitive substring of the palette name.
+        '''
+        conditions = []
+        parameters = []
+        if min_colors is not None:
+            conditions.append('colors >= ?')
+            parameters.append(min_colors)
+        if max_colors is not None:
+            conditions.append('colors <= ?')
+            parameters.append(max_colors)
+        for rgb in contains:
+            conditions.append('filename IN (SELECT filename FROM colors WHERE rgb = ?)')
+            parameters.append(rgb)
+        sql = 'SELECT {0} FROM palettes'.format(', '.join(Entry._fields))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+
+        entries = [self._entry(row) for row in self.db.execute(sql, parameters)]
+        if name is not None:
+            # SQLite only folds the case of ASCII letters.
+            name = name.lower()
+            entries = [entry for entry in entries if name in entry.name.lower()]
+        entries.sort(key=lambda entry: (entry.name.lower(), entry.filename))
+        return entries
+
+    def names(self):
+        '''Returns {filename: palette name} for all palettes.'''
+        return dict(self.db.execute('SELECT filename, name FROM palettes'))
+
+    def colors_of(self, filename):
+        '''Returns the distinct colors of a palette as sorted 0xRRGGBB
+        integers.
+        '''
+        return [rgb for rgb, in self.db.execute(
+            'SELECT rgb FROM colors WHERE filename = ? ORDER BY rgb', (filename,))]
+
+    @staticmethod
+    def _entry(row):
+        entry = Entry(*row)
+        return entry._replace(comments=json.loads(entry.comments))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def parse_args():
+    default_palettes = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'palettes')
+    parser = argparse.ArgumentParser(
+        description='Updates the manifest of a palette collection and queries it',
+        epilog='The manifest keeps the name, color counts, columns, comments,'
+        ' content hash and colors of every palette. Only changed files are'
+        ' parsed again. The palettes matching all the given conditions are'
+        ' listed, sorted by name.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-m', '--manifest',
+        metavar='FILE',
+        default=os.path.join('.cache', 'manifest.sqlite3'),
+        help='Manifest file'
+    )
+    parser.add_argument(
+        '--min-colors',
+        metavar='N',
+        type=int,
+        help='List only palettes with at least this many colors'
+    )
+    parser.add_argument(
+        '--max-colors',
+        metavar='N',
+        type=int,
+        help='List only palettes with at most this many colors'
+    )
+    parser.add_argument(
+        '-c', '--contains',
+        metavar='COLOR',
+        type=color_value,
+        action='append',
+        default=[],
+        help='List only palettes with this color, such as #ff0000; can be'
+        ' given many times'
+    )
+    parser.add_argument(
+        '-n', '--name',
+        metavar='TEXT',
+        help='List only palettes whose name contains this text, ignoring case'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Parse changed palettes in this many processes (0 means one per CPU)'
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Write the matching palettes as JSON, with all their statistics'
+    )
+    parser.add_argument(
+        'palettes',
+        nargs='*',
+        default=[os.path.relpath(default_palettes)],
+        help='GIMP Palette files (*.gpl) or directories with such files'
+    )
+    options = parser.parse_args()
+    if options.jobs < 0:
+        parser.error('--jobs must not be negative')
+    return options
+
+
+def main():
+    options = parse_args()
+    with PaletteManifest(options.manifest) as manifest:
+        updated, deleted, errors = manifest.update(options.palettes, jobs=options.jobs)
+        for filename, message in errors:
+            sys.stderr.write('{0}\n'.format(message))
+        if updated or deleted:
+            sys.stderr.write('{0}: {1} palettes updated, {2} deleted\n'.format(
+                options.manifest, len(updated), len(deleted)))
+
+        # Entries of other files may be kept in the same manifest.
+        filenames = set(stat_palette_files(options.palettes))
+        entries = [
+            entry
+            for entry in manifest.query(
+                min_colors=options.min_colors,
+                max_colors=options.max_colors,
+                contains=options.contains,
+                name=options.name,
+            )
+            if entry.filename in filenames
+        ]
+
+    if options.json:
+        json.dump([entry._asdict() for entry in entries], sys.stdout, indent=2, ensure_ascii=False)
+        sys.stdout.write('\n')
+    else:
+        for entry in entries:
+            print('{0.filename}\t{0.colors}\t{0.unique_colors}\t{0.name}'.format(entry))
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
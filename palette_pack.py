@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+#
+# Compiles many GIMP palettes into a single binary collection file, which can
+# be loaded without parsing any text. The *.gpl files remain the source of
+# truth; the collection is only a build artifact.
+#
+# File layout (all integers are little-endian):
+#
+#   header:   magic, version, palette count, and the offsets of the other
+#             three sections (see HEADER)
+#   palettes: one PALETTE_ENTRY per palette, pointing into the other sections
+#   strings:  string count N, N + 1 uint32 offsets, then the UTF-8 data of all
+#             file names, palette names, comments and color names
+#   colors:   the packed RGB bytes of all palettes, one after the other
+#
+# Loaded palettes share memory with the memory-mapped file: their rgb is a
+# read-only memoryview, and their names are decoded only when accessed.
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import namedtuple
+from collections.abc import Sequence
+
+from gpl_to_html import GimpPalette
+
+
+PACK_EXTENSION = '.gplpack'
+MAGIC = b'GPLPACK\0'
+VERSION = 1
+
+# magic, version, palette count, then offsets of: palette table, strings, colors.
+HEADER = struct.Struct('<8sIIQQQ')
+# Indexes into the string table: file name, palette name, first comment,
+# first color name. Then: columns, comment count, first color, color count.
+PALETTE_ENTRY = struct.Struct('<IIIIiIII')
+
+
+class PackError(ValueError):
+    pass
+
+
+# Reference to one palette inside a collection file.
+PaletteRef = namedtuple('PaletteRef', 'collection index name')
+
+
+def is_collection(filename):
+    return isinstance(filename, str) and filename.endswith(PACK_EXTENSION)
+
+
+class PackedStrings(Sequence):
+    '''Read-only sequence of strings from the string table, decoded on demand.'''
+
+    __slots__ = ('_data', '_offsets', '_first', '_count')
+
+    def __init__(self, data, offsets, first, count):
+        self._data = data
+        self._offsets = offsets
+        self._first = first
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('string index out of range')
+        i = self._first + index
+        return str(self._data[self._offsets[i]:self._offsets[i + 1]], 'utf-8')
+
+    def __iter__(self):
+        data = self._data
+        offsets = self._offsets
+        for i in range(self._first, self._first + self._count):
+            yield str(data[offsets[i]:offsets[i + 1]], 'utf-8')
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class PaletteCollection(Sequence):
+    '''A compiled collection file, memory-mapped, as a sequence of GimpPalette.
+
+    >>> import tempfile
+    >>> pal = GimpPalette.new_from_bytes(
+    ...     b'GIMP Palette\\nName: Foo\\n# Bar\\n1 2 3 One\\n4 5 6\\n', 'foo.gpl')
+    >>> with tempfile.TemporaryDirectory() as tmp:
+    ...     filename = os.path.join(tmp, 'test.gplpack')
+    ...     write_collection(filename, [pal, pal])
+    ...     with PaletteCollection(filename) as collection:
+    ...         loaded = collection[1]
+    ...         print(len(collection), loaded, bytes(loaded.rgb), list(loaded.colors))
+    ...         print(loaded.filename, loaded.comments, collection.palette_names())
+    ...         del loaded
+    2 GimpPalette Foo b'\\x01\\x02\\x03\\x04\\x05\\x06' [NamedColor(1, 2, 3, name='One'), NamedColor(4, 5, 6, name='Untitled')]
+    foo.gpl ['Bar'] ['Foo', 'Foo']
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise PackError('{0}: empty file'.format(filename)) from None
+        self._data = memoryview(self._mmap)
+
+        try:
+            magic, version, count, table_offset, strings_offset, colors_offset = HEADER.unpack_from(self._data)
+        except struct.error:
+            magic = version = None
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise PackError('{0}: not a palette collection of version {1}'.format(filename, VERSION))
+
+        self._count = count
+        self._table_offset = table_offset
+        self._colors_offset = colors_offset
+
+        (string_count,) = struct.unpack_from('<I', self._data, strings_offset)
+        offsets_start = strings_offset + 4
+        offsets_end = offsets_start + 4 * (string_count + 1)
+        if sys.byteorder == 'little':
+            self._offsets = self._data[offsets_start:offsets_end].cast('I')
+        else:
+            self._offsets = array('I', self._data[offsets_start:offsets_end])
+            self._offsets.byteswap()
+        self._strings = self._data[offsets_end:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''Closes the file. Fails while loaded palettes are still referenced.'''
+        self._strings = self._offsets = None
+        self._data.release()
+        self._mmap.close()
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, index):
+        return PALETTE_ENTRY.unpack_from(self._data, self._table_offset + index * PALETTE_ENTRY.size)
+
+    def _string(self, i):
+        return str(self._strings[self._offsets[i]:self._offsets[i + 1]], 'utf-8')
+
+    def palette_names(self):
+        '''Returns the names of all palettes, without loading their colors.'''
+        return [self._string(self._entry(i)[1]) for i in range(self._count)]
+
+    def references(self):
+        '''Returns a PaletteRef for each palette in the collection.'''
+        return [
+            PaletteRef(self.filename, i, name)
+            for i, name in enumerate(self.palette_names())
+        ]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('palette index out of range')
+
+        filename, name, comments, color_names, columns, comment_count, first_color, color_count = self._entry(index)
+        pal = GimpPalette()
+        pal.filename = self._string(filename)
+        pal.name = self._string(name)
+        pal.columns = columns
+        pal.comments = list(PackedStrings(self._strings, self._offsets, comments, comment_count))
+        start = self._colors_offset + 3 * first_color
+        pal.rgb = self._data[start:start + 3 * color_count].toreadonly()
+        pal.color_names = PackedStrings(self._strings, self._offsets, color_names, color_count)
+        return pal
+
+
+def write_collection(filename, palettes):
+    '''Writes the palettes into a new collection file, atomically.'''
+    strings = []
+    entries = []
+    colors = bytearray()
+    for pal in palettes:
+        entries.append((
+            len(strings),
+            len(strings) + 1,
+            len(strings) + 2,
+            len(strings) + 2 + len(pal.comments),
+            pal.columns,
+            len(pal.comments),
+            len(colors) // 3,
+            len(pal.color_names),
+        ))
+        strings.append(pal.filename)
+        strings.append(pal.name)
+        strings.extend(pal.comments)
+        strings.extend(pal.color_names)
+        colors += pal.rgb
+
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = array('I', [0])
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+
+    table_offset = HEADER.size
+    strings_offset = table_offset + PALETTE_ENTRY.size * len(entries)
+    colors_offset = strings_offset + 4 + len(offsets) * 4 + sum(map(len, encoded))
+
+    temporary = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(entries), table_offset, strings_offset, colors_offset))
+        for entry in entries:
+            f.write(PALETTE_ENTRY.pack(*entry))
+        f.write(struct.pack('<I', len(encoded)))
+        f.write(offsets.tobytes())
+        f.writelines(encoded)
+        f.write(colors)
+    os.replace(temporary, filename)
+
+
+# Collections opened by load_palette(), by file name, with the (st_ino,
+# st_size, st_mtime_ns) of the file they were opened from.
+_open_collections = {}
+
+
+def load_palette(ref):
+    '''Loads the palette a PaletteRef points to.
+
+    The collection stays open for later calls, and is opened again once the
+    file is rewritten, so long-running callers see the new palettes:
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as tmp:
+    ...     filename = os.path.join(tmp, 'test.gplpack')
+    ...     for data in (b'GIMP Palette\\nName: Old\\n1 2 3 One\\n',
+    ...                  b'GIMP Palette\\nName: New\\n4 5 6 Two\\n7 8 9 Three\\n'):
+    ...         write_collection(filename, [GimpPalette.new_from_bytes(data)])
+    ...         pal = load_palette(PaletteRef(filename, 0, None))
+    ...         print(pal.name, list(pal.color_names))
+    ...     del pal, _open_collections[filename]
+    Old ['One']
+    New ['Two', 'Three']
+    '''
+    stat = os.stat(ref.collection)
+    version = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    opened = _open_collections.get(ref.collection)
+    if opened is None or opened[1] != version:
+        # The old collection is not closed: palettes loaded from it may still
+        # be in use, and its mapping goes away along with them.
+        opened = _open_collections[ref.collection] = (PaletteCollection(ref.collection), version)
+    return opened[0][ref.index]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compiles GIMP palettes into a single binary collection file',
+        epilog='The collection can be given to gpl_to_html.py and the other'
+        ' tools in place of the *.gpl files. It is loaded through mmap, without'
+        ' parsing any text.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-o', '--output',
+        required=True,
+        help='Collection file to write (*{0})'.format(PACK_EXTENSION)
+    )
+    parser.add_argument(
+        'palettes',
+        nargs='+',
+        help='GIMP Palette files (*.gpl)'
+    )
+    options = parser.parse_args()
+    return options
+
+
+def main():
+    options = parse_args()
+    write_collection(
+        options.output,
+        (GimpPalette.new_from_filename(filename) for filename in options.palettes),
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+#
+# Local HTTP server for previewing palettes while editing them.
+#
+# Palettes are rendered on demand and kept in memory, keyed by the size and
+# mtime of their files, so a reload only renders the palettes that changed.
+# Responses carry an ETag and Last-Modified, and are gzipped when the
+# browser accepts it, so reloading an unchanged page costs a 304.
+#
+# Endpoints:
+#
+#   /                              the preview page, as gpl_to_html.py makes it
+#   /api/palettes                  JSON list of all palettes
+#   /api/palettes/<id>             JSON with the comments and colors of a palette
+#   /api/palettes/<id>.html        HTML fragment of a palette
+#   /api/nearest?color=#rrggbb     JSON with the closest named colors (see
+#                                  nearest_color.py); also takes k and space
+#   /<file>                        any of the palette files being served
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os.path
+import sys
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import gpl_to_html
+from gpl_to_html import Color, expand_palette_sources, render_palette_file, stat_palette_files, write_page
+
+
+class LRUCache:
+    '''Thread-safe mapping that keeps only the most recently used entries.
+
+    >>> cache = LRUCache(2)
+    >>> cache.put('a', 1); cache.put('b', 2); cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b') is None, len(cache)
+    (True, 2)
+    '''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+# A response body, with its gzipped version computed on first use.
+class Body:
+    __slots__ = ('data', 'content_type', '_gzipped')
+
+    def __init__(self, data, content_type):
+        self.data = data
+        self.content_type = content_type
+        self._gzipped = None
+
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.data, compresslevel=6)
+        return self._gzipped
+
+
+class PaletteServer(ThreadingHTTPServer):
+    '''Serves the palette files given as paths, where directories stand for
+    the *.gpl files inside them. The list of files is checked again on every
+    request, so added, removed and changed palettes show up on reload.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address, paths, compact=False, cache_entries=1024):
+        super().__init__(address, PaletteRequestHandler)
+        self.paths = paths
+        self.compact = compact
+        # RenderedPalette by (source, size, mtime_ns).
+        self.rendered = LRUCache(cache_entries)
+        # Body by (request path, ETag).
+        self.responses = LRUCache(64)
+        self.color_indexes = LRUCache(4)
+        self.version = gpl_to_html.RenderCache.version('compact' if compact else '')
+
+    def snapshot(self):
+        return stat_palette_files(self.paths)
+
+    def etag(self, *parts):
+        digest = hashlib.sha1(repr((self.version,) + parts).encode('utf-8')).hexdigest()
+        return '"{0}"'.format(digest[:32])
+
+    def sources(self, snapshot):
+        '''Returns (source, stat) for every palette, in command-line order.'''
+        sources = []
+        for filename, stat in snapshot.items():
+            for source in expand_palette_sources([filename]):
+                sources.append((source, stat))
+        return sources
+
+    def render(self, source, stat):
+        key = (source, stat)
+        rendered = self.rendered.get(key)
+        if rendered is None:
+            rendered = render_palette_file(source, compact=self.compact)
+            self.rendered.put(key, rendered)
+        return rendered
+
+    def palettes(self, snapshot):
+        '''Returns (id, RenderedPalette) for every palette that can be
+        rendered, sorted by name as in the page made by gpl_to_html.py.
+        '''
+        palettes = []
+        for i, (source, stat) in enumerate(self.sources(snapshot)):
+            # A palette being edited may be broken for a moment; the page
+            # shows the others meanwhile.
+            try:
+                palettes.append((i, self.render(source, stat)))
+            except (OSError, ValueError) as e:
+                sys.stderr.write('{0}\n'.format(e))
+        palettes.sort(key=lambda item: item[1].name.lower())
+        return palettes
+
+    def color_index(self, snapshot, space):
+        import nearest_color
+
+        key = (tuple(snapshot.items()), space)
+        index = self.color_indexes.get(key)
+        if index is None:
+            index = nearest_color.ColorIndex.build(list(snapshot), space)
+            self.color_indexes.put(key, index)
+        return index
+
+
+def _json_body(value):
+    return Body(json.dumps(value, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8')
+
+
+class PaletteRequestHandler(BaseHTTPRequestHandler):
+
+    server_version = 'PaletteServer'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        server = self.server
+        snapshot = server.snapshot()
+        last_modified = max((mtime_ns for _, mtime_ns in snapshot.values()), default=0)
+
+        try:
+            if path in ('/', '/index.html'):
+                etag = server.etag('page', tuple(snapshot.items()))
+                self.respond(etag, last_modified, lambda: self.page(snapshot))
+            elif path == '/api/palettes':
+                etag = server.etag('list', tuple(snapshot.items()))
+                self.respond(etag, last_modified, lambda: self.palette_list(snapshot))
+            elif path.startswith('/api/palettes/'):
+                self.palette(snapshot, path[len('/api/palettes/'):])
+            elif path == '/api/nearest':
+                etag = server.etag('nearest', tuple(snapshot.items()), sorted(query.items()))
+                self.respond(etag, last_modified, lambda: self.nearest(snapshot, query))
+            elif path.lstrip('/') in snapshot:
+                filename = path.lstrip('/')
+                etag = server.etag('file', filename, snapshot[filename])
+                self.respond(etag, snapshot[filename][1], lambda: self.raw_file(filename))
+            else:
+                self.send_error(HTTPStatus.NOT_FOUND)
+        except (ValueError, KeyError) as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+
+    def respond(self, etag, mtime_ns, make_body):
+        '''Sends 304 if the browser already has this ETag, or else the body,
+        taken from the response cache or built by make_body().
+        '''
+        if self.headers.get('If-None-Match') == etag or self.not_modified_since(mtime_ns):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        key = (self.path, etag)
+        body = self.server.responses.get(key)
+        if body is None:
+            body = make_body()
+            self.server.responses.put(key, body)
+
+        data = body.data
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '') and len(data) > 1024
+        if gzipped:
+            data = body.gzipped()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', body.content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(mtime_ns / 1e9, usegmt=True))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def not_modified_since(self, mtime_ns):
+        since = self.headers.get('If-Modified-Since')
+        if since is None or 'If-None-Match' in self.headers:
+            return False
+        try:
+            return mtime_ns // 10 ** 9 <= parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    def page(self, snapshot):
+        out = io.StringIO()
+        write_page([rendered for _, rendered in self.server.palettes(snapshot)], out)
+        return Body(out.getvalue().encode('utf-8'), 'text/html; charset=utf-8')
+
+    def palette_list(self, snapshot):
+        return _json_body([
+            {
+                'id': i,
+                'filename': rendered.filename,
+                'name': rendered.name,
+                'columns': rendered.columns,
+                'colors': rendered.colors,
+                'unique_colors': rendered.unique_colors,
+            }
+            for i, rendered in self.server.palettes(snapshot)
+        ])
+
+    def palette(self, snapshot, name):
+        palette_id, _, extension = name.partition('.')
+        sources = self.server.sources(snapshot)
+        try:
+            source, stat = sources[int(palette_id)]
+        except (ValueError, IndexError):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        if extension not in ('', 'html'):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        etag = self.server.etag('palette', source, stat, extension)
+        rendered = lambda: self.server.render(source, stat)
+        if extension == 'html':
+            make_body = lambda: Body(rendered().html.encode('utf-8'), 'text/html; charset=utf-8')
+        else:
+            make_body = lambda: self.palette_details(rendered())
+        self.respond(etag, stat[1], make_body)
+
+    def palette_details(self, rendered):
+        name, properties, comments, color_names, hex_colors = json.loads(rendered.search_entry)
+        return _json_body({
+            'filename': rendered.filename,
+            'name': rendered.name,
+            'columns': rendered.columns,
+            'properties': properties,
+            'comments': rendered.comments,
+            'colors': [
+                [color_name, '#' + hex_colors[6 * i:6 * i + 6]]
+                for i, color_name in enumerate(color_names)
+            ],
+        })
+
+    def nearest(self, snapshot, query):
+        color = Color(query['color'] if query['color'].startswith('#') else '#' + query['color'])
+        k = int(query.get('k', 5))
+        space = query.get('space', 'rgb')
+        index = self.server.color_index(snapshot, space)
+        return _json_body([
+            {
+                'distance': match.distance,
+                'name': match.color.name,
+                'color': str(match.color),
+                'palette': match.palette,
+                'filename': match.filename,
+            }
+            for match in index.nearest(color, k=k)
+        ])
+
+    def raw_file(self, filename):
+        with open(filename, 'rb') as f:
+            return Body(f.read(), 'text/plain; charset=utf-8')
+
+
+def parse_args():
+    default_palettes = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'palettes')
+    parser = argparse.ArgumentParser(
+        description='Serves a live preview of GIMP palettes over HTTP',
+        epilog='Palettes are rendered when requested and kept in memory while'
+        ' their files are unchanged. Besides the preview page, there are JSON'
+        ' endpoints: /api/palettes, /api/palettes/<id> and'
+        ' /api/nearest?color=%%23rrggbb.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-b', '--bind',
+        default='127.0.0.1',
+        help='Address to listen on'
+    )
+    parser.add_argument(
+        '-p', '--port',
+        type=int,
+        default=8000,
+        help='Port to listen on'
+    )
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='Serve the page in the compact mode of gpl_to_html.py'
+    )
+    parser.add_argument(
+        '--cache-entries',
+        type=int,
+        default=1024,
+        help='How many rendered palettes are kept in memory'
+    )
+    parser.add_argument(
+        'palettes',
+        nargs='*',
+        default=[os.path.relpath(default_palettes)],
+        help='GIMP Palette files (*.gpl), directories with such files, or'
+        ' compiled collections (*.gplpack)'
+    )
+    options = parser.parse_args()
+    return options
+
+
+def main():
+    options = parse_args()
+    server = PaletteServer(
+        (options.bind, options.port),
+        options.palettes,
+        compact=options.compact,
+        cache_entries=options.cache_entries,
+    )
+    host, port = server.server_address[:2]
+    sys.stderr.write('Serving palettes on http://{0}:{1}/\n'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,556 @@
+#!/usr/bin/env python3
+#
+# Maps every pixel of an image to the nearest color of a palette, optionally
+# with ordered (Bayer) or Floyd-Steinberg dithering.
+#
+# Images are uncompressed binary PPM (P6) or PAM (P7, RGB or RGB_ALPHA), with
+# 8 bits per channel; the alpha channel is kept as it is. Any other format
+# can be converted with netpbm or ImageMagick, for example:
+#
+#   convert sprites.png sprites.pam
+#   ./quantize_image.py -p palettes/DawnBringer32.gpl sprites.pam > out.pam
+#
+# Instead of searching the palette for every pixel, the RGB cube is divided
+# into cells (32 per channel by default) and the nearest palette color of
+# each cell is computed once. That lookup table is saved to disk and reused
+# for the same palette. Pixels are then remapped in chunks, with NumPy when
+# it is installed, and otherwise with bytes.translate() and map().
+
+import argparse
+import hashlib
+import os.path
+import re
+import sys
+import time
+from array import array
+
+import colorspaces
+from convert_palettes import read_palette
+from nearest_color import SPACES, UniformGrid
+
+
+# Pixels remapped at once; bounds the memory of the intermediate lists.
+CHUNK_PIXELS = 1 << 16
+
+# Size of the float64 distance matrix of each chunk of colors when building a
+# table with NumPy: 32 MB, whatever the size of the palette.
+NEAREST_CHUNK_ELEMENTS = 1 << 22
+
+# 8x8 Bayer matrix for ordered dithering.
+BAYER_8X8 = (
+    (0, 32, 8, 40, 2, 34, 10, 42),
+    (48, 16, 56, 24, 50, 18, 58, 26),
+    (12, 44, 4, 36, 14, 46, 6, 38),
+    (60, 28, 52, 20, 62, 30, 54, 22),
+    (3, 35, 11, 43, 1, 33, 9, 41),
+    (51, 19, 59, 27, 49, 17, 57, 25),
+    (15, 47, 7, 39, 13, 45, 5, 37),
+    (63, 31, 55, 23, 61, 29, 53, 21),
+)
+
+
+class ImageError(ValueError):
+    pass
+
+
+class Image:
+    '''An 8-bit image with interleaved channels, as read from PPM or PAM.'''
+
+    def __init__(self, width, height, depth, pixels, tupltype=None):
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.pixels = pixels
+        # None for PPM images, the TUPLTYPE for PAM images.
+        self.tupltype = tupltype
+
+    def __repr__(self):
+        return '<Image {0.width}x{0.height}, {0.depth} channels>'.format(self)
+
+
+# Fields are separated by whitespace or comments, and the last one by a single
+# whitespace character.
+_PPM_HEADER_RE = re.compile(rb'''
+    P6
+    (?:\s|\#[^\n]*\n)+ (\d+)
+    (?:\s|\#[^\n]*\n)+ (\d+)
+    (?:\s|\#[^\n]*\n)+ (\d+)
+    \s
+''', re.VERBOSE)
+
+
+def read_image(data):
+    '''Reads a binary PPM or PAM image.
+
+    >>> read_image(b'P6\\n# comment\\n2 1\\n255\\n\\x01\\x02\\x03\\x04\\x05\\x06')
+    <Image 2x1, 3 channels>
+    >>> read_image(b'P7\\nWIDTH 1\\nHEIGHT 1\\nDEPTH 4\\nMAXVAL 255\\nTUPLTYPE RGB_ALPHA\\nENDHDR\\n\\x01\\x02\\x03\\x04').tupltype
+    'RGB_ALPHA'
+    '''
+    if data[:2] == b'P6':
+        match = _PPM_HEADER_RE.match(data)
+        if not match:
+            raise ImageError('Invalid PPM header')
+        width, height, maxval = map(int, match.groups())
+        depth = 3
+        tupltype = None
+        start = match.end()
+    elif data[:3] == b'P7\n':
+        end = data.find(b'ENDHDR\n')
+        if end < 0:
+            raise ImageError('Invalid PAM header')
+        header = {}
+        for line in bytes(data[3:end]).decode('ascii', 'replace').splitlines():
+            key, _, value = line.strip().partition(' ')
+            if key and not key.startswith('#'):
+                header[key] = value.strip()
+        try:
+            width = int(header['WIDTH'])
+            height = int(header['HEIGHT'])
+            depth = int(header['DEPTH'])
+            maxval = int(header['MAXVAL'])
+        except (KeyError, ValueError) as e:
+            raise ImageError('Invalid PAM header: {0}'.format(e)) from None
+        tupltype = header.get('TUPLTYPE', 'RGB_ALPHA' if depth == 4 else 'RGB')
+        if depth not in (3, 4):
+            raise ImageError('Only RGB and RGB_ALPHA images are supported, not {0}'.format(tupltype))
+        start = end + len(b'ENDHDR\n')
+    else:
+        raise ImageError('Not a binary PPM (P6) or PAM (P7) image')
+
+    if maxval != 255:
+        raise ImageError('Only 8 bits per channel are supported (MAXVAL 255)')
+    size = width * height * depth
+    pixels = bytearray(data[start:start + size])
+    if len(pixels) != size:
+        raise ImageError('Image data is truncated')
+    return Image(width, height, depth, pixels, tupltype)
+
+
+def write_image(image, f):
+    '''Writes an image in the same format it was read from.'''
+    if image.tupltype is None:
+        f.write('P6\n{0.width} {0.height}\n255\n'.format(image).encode('ascii'))
+    else:
+        f.write(
+            'P7\nWIDTH {0.width}\nHEIGHT {0.height}\nDEPTH {0.depth}\nMAXVAL 255\n'
+            'TUPLTYPE {0.tupltype}\nENDHDR\n'.format(image).encode('ascii')
+        )
+    f.write(image.pixels)
+
+
+def _index_typecode(count):
+    for typecode in ('B', 'H', 'I'):
+        if count <= 1 << (8 * array(typecode).itemsize):
+            return typecode
+    raise ValueError('Too many colors')
+
+
+class NearestColorTable:
+    '''Precomputed nearest palette color for every cell of the RGB cube,
+    with 2 ** bits cells along each channel. With 8 bits, every color has
+    its own cell and the result is exact.
+
+    >>> table = NearestColorTable.build(bytes([0, 0, 0, 255, 255, 255, 255, 0, 0]), bits=4)
+    >>> len(table.indexes), table.index_of(250, 30, 10), table.index_of(90, 90, 90)
+    (4096, 2, 0)
+    '''
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, rgb, bits, space, indexes):
+        self.rgb = bytes(rgb)
+        self.bits = bits
+        self.space = space
+        self.indexes = indexes
+        # Palette colors as 3-byte strings, by index.
+        self.colors = [self.rgb[i:i + 3] for i in range(0, len(self.rgb), 3)]
+
+    @staticmethod
+    def cell_centers(bits):
+        '''Returns the packed RGB color at the center of each cell.'''
+        shift = 8 - bits
+        return _cube(bytes((v << shift) + (1 << shift >> 1) for v in range(1 << bits)))
+
+    @classmethod
+    def build(cls, rgb, bits=5, space='rgb'):
+        if not rgb:
+            raise ValueError('The palette has no colors')
+        centers = cls.cell_centers(bits)
+        typecode = _index_typecode(len(rgb) // 3)
+        if colorspaces.have_numpy():
+            indexes = array(typecode, _nearest_numpy(rgb, centers, space).astype(typecode).tobytes())
+        else:
+            grid = UniformGrid(colorspaces.convert_all(space, rgb))
+            nearest = grid.nearest
+            indexes = array(typecode, [
+                nearest(point, 1)[0][1]
+                for point in colorspaces.convert_all(space, centers)
+            ])
+        return cls(rgb, bits, space, indexes)
+
+    @classmethod
+    def load_or_build(cls, rgb, bits=5, space='rgb', cache_dir=None):
+        '''Loads the table for this palette from cache_dir, or builds it and
+        saves it there. Tables are named after a hash of the palette colors.
+        '''
+        if not cache_dir:
+            return cls.build(rgb, bits, space)
+
+        key = hashlib.sha256(
+            '{0}:{1}:{2}:'.format(cls.FORMAT_VERSION, bits, space).encode('ascii') + bytes(rgb)
+        ).hexdigest()
+        filename = os.path.join(cache_dir, '{0}.lut'.format(key))
+        typecode = _index_typecode(len(rgb) // 3)
+        try:
+            with open(filename, 'rb') as f:
+                indexes = array(typecode)
+                indexes.frombytes(f.read())
+            if sys.byteorder != 'little':
+                indexes.byteswap()
+            if len(indexes) == 1 << (3 * bits):
+                return cls(rgb, bits, space, indexes)
+        except (OSError, ValueError):
+            pass
+
+        table = cls.build(rgb, bits, space)
+        os.makedirs(cache_dir, exist_ok=True)
+        data = array(typecode, table.indexes)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        # Writing to a temporary file first, so concurrent readers never see
+        # a partially written table.
+        temporary = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(temporary, 'wb') as f:
+            f.write(data.tobytes())
+        os.replace(temporary, filename)
+        return table
+
+    def cell_of(self, r, g, b):
+        shift = 8 - self.bits
+        return ((r >> shift) << (2 * self.bits)) | ((g >> shift) << self.bits) | (b >> shift)
+
+    def index_of(self, r, g, b):
+        '''Returns the index of the palette color nearest to (r, g, b).'''
+        return self.indexes[self.cell_of(r, g, b)]
+
+
+def _cube(values):
+    '''Returns all (r, g, b) combinations of the values, packed, r slowest.'''
+    count = len(values)
+    # The blue channel cycles fastest: one row of all values, repeated.
+    blue = values * (count * count)
+    green = bytes(v for v in values for _ in range(count)) * count
+    red = bytes(v for v in values for _ in range(count * count))
+    cube = bytearray(3 * count ** 3)
+    cube[0::3] = red
+    cube[1::3] = green
+    cube[2::3] = blue
+    return bytes(cube)
+
+
+def _nearest_numpy(rgb, colors, space, max_elements=NEAREST_CHUNK_ELEMENTS):
+    '''Returns the index of the nearest palette color of each color, as a
+    NumPy array, comparing every color with every palette color in chunks.
+
+    Each chunk has as many colors as fit in a distance matrix of max_elements,
+    so memory use does not grow with the size of the palette:
+
+    >>> import random, tracemalloc
+    >>> rng = random.Random(1)
+    >>> big = bytes(rng.randrange(256) for _ in range(3 * 16384))
+    >>> if colorspaces.have_numpy():
+    ...     tracemalloc.start()
+    ...     table = NearestColorTable.build(big, bits=5)
+    ...     peak = tracemalloc.get_traced_memory()[1]
+    ...     tracemalloc.stop()
+    ...     assert peak < 4 * 8 * NEAREST_CHUNK_ELEMENTS, peak
+    ...     grid = UniformGrid(colorspaces.convert_all('rgb', big))
+    ...     centers = NearestColorTable.cell_centers(5)
+    ...     for cell in range(0, 1 << 15, 97):
+    ...         point = tuple(centers[3 * cell:3 * cell + 3])
+    ...         expected = grid.nearest(point, 1)[0][0]
+    ...         got = sum((a - b) ** 2 for a, b in zip(point, table.colors[table.indexes[cell]])) ** 0.5
+    ...         assert abs(got - expected) < 1e-9, (cell, got, expected)
+    '''
+    numpy = colorspaces.numpy
+    palette = colorspaces.convert_array(space, bytes(rgb))
+    palette_norms = (palette * palette).sum(axis=1)
+    chunk = max(1, max_elements // len(palette))
+    result = numpy.empty(len(colors) // 3, dtype=numpy.intp)
+    for start in range(0, len(result), chunk):
+        points = colorspaces.convert_array(space, colors[3 * start:3 * (start + chunk)])
+        # |p - q|^2 without the |p|^2 term, which is the same for every q,
+        # computed in place to keep a single chunk x palette matrix.
+        distances = points @ palette.T
+        distances *= -2
+        distances += palette_norms
+        result[start:start + len(points)] = distances.argmin(axis=1)
+    return result
+
+
+class _CellColors(dict):
+    '''Maps cells of the table, as (r, g, b) tuples of cell coordinates, to
+    the bytes of their palette colors, filled on first use.
+    '''
+
+    def __init__(self, table):
+        self.table = table
+
+    def __missing__(self, cell):
+        r, g, b = cell
+        bits = self.table.bits
+        value = self[cell] = self.table.colors[self.table.indexes[(r << (2 * bits)) | (g << bits) | b]]
+        return value
+
+
+def remap(pixels, depth, table):
+    '''Returns the pixels with their colors replaced by the nearest palette
+    colors. Channels after the first three, such as alpha, are kept.
+
+    >>> table = NearestColorTable.build(bytes([0, 0, 0, 255, 255, 255]), bits=4)
+    >>> list(remap(bytes([10, 20, 30, 200, 220, 240]), 3, table))
+    [0, 0, 0, 255, 255, 255]
+    >>> list(remap(bytes([200, 220, 240, 128]), 4, table))
+    [255, 255, 255, 128]
+    '''
+    if colorspaces.have_numpy():
+        return _remap_numpy(pixels, depth, table)
+
+    # Every step but the dictionary lookups runs in C: the channels are
+    # split with slices, reduced to cell coordinates with bytes.translate(),
+    # and the colors are put back in place with slice assignments.
+    shift = 8 - table.bits
+    to_cell = bytes(v >> shift for v in range(256))
+    lookup = _CellColors(table).__getitem__
+    out = bytearray(pixels)
+    step = CHUNK_PIXELS * depth
+    for start in range(0, len(pixels), step):
+        chunk = pixels[start:start + step]
+        cells = zip(*[chunk[c::depth].translate(to_cell) for c in range(3)])
+        colors = b''.join(map(lookup, cells))
+        end = start + len(chunk)
+        for c in range(3):
+            out[start + c:end:depth] = colors[c::3]
+    return out
+
+
+def _remap_numpy(pixels, depth, table):
+    numpy = colorspaces.numpy
+    shift = 8 - table.bits
+    indexes = numpy.frombuffer(table.indexes, dtype=numpy.dtype(table.indexes.typecode))
+    palette = numpy.frombuffer(table.rgb, dtype=numpy.uint8).reshape(-1, 3)
+    out = numpy.frombuffer(bytearray(pixels), dtype=numpy.uint8).reshape(-1, depth)
+    for start in range(0, len(out), CHUNK_PIXELS):
+        chunk = out[start:start + CHUNK_PIXELS]
+        rgb = (chunk[:, :3] >> shift).astype(numpy.intp)
+        cells = (rgb[:, 0] << (2 * table.bits)) | (rgb[:, 1] << table.bits) | rgb[:, 2]
+        chunk[:, :3] = palette[indexes[cells]]
+    return bytearray(out.tobytes())
+
+
+def ordered_offsets(table):
+    '''Returns the 8x8 offsets added to the channels by ordered dithering,
+    scaled to the typical distance between palette colors.
+    '''
+    spread = 255 / max(2, round((len(table.colors)) ** (1 / 3)))
+    return [[round((value + 0.5) / 64 * spread - spread / 2) for value in row] for row in BAYER_8X8]
+
+
+def dither_ordered(pixels, width, depth, table):
+    '''Remaps the pixels after adding a Bayer threshold map to them.
+
+    The threshold is applied with bytes.translate() over strided slices of
+    each row, one slice per column of the matrix, and the result goes
+    through remap(). An image without pixels is returned as is:
+
+    >>> table = NearestColorTable.build(bytes([0, 0, 0, 255, 255, 255]), bits=4)
+    >>> list(dither_ordered(bytes([100, 100, 100, 160, 160, 160]), 2, 3, table))
+    [0, 0, 0, 255, 255, 255]
+    >>> dither_ordered(b'', 0, 3, table)
+    b''
+    '''
+    if width == 0 or not pixels:
+        return pixels
+    offsets = ordered_offsets(table)
+    translations = [
+        [bytes(min(255, max(0, v + offset)) for v in range(256)) for offset in row]
+        for row in offsets
+    ]
+    adjusted = bytearray(pixels)
+    stride = width * depth
+    for y in range(len(pixels) // stride):
+        row_start = y * stride
+        row = pixels[row_start:row_start + stride]
+        row_translations = translations[y & 7]
+        for x in range(min(8, width)):
+            translation = row_translations[x]
+            for c in range(3):
+                start = x * depth + c
+                adjusted[row_start + start:row_start + stride:8 * depth] = row[start::8 * depth].translate(translation)
+    return remap(adjusted, depth, table)
+
+
+def dither_floyd_steinberg(pixels, width, depth, table):
+    '''Remaps the pixels one by one, spreading the error of each pixel over
+    its unvisited neighbours (7/16 right, 3/16, 5/16 and 1/16 below).
+    '''
+    out = bytearray(pixels)
+    colors = table.colors
+    indexes = table.indexes
+    bits = table.bits
+    shift = 8 - bits
+    stride = width * depth
+    height = len(pixels) // stride if stride else 0
+    # Accumulated errors of the current and the next row, in 1/16 units,
+    # with one extra pixel at each end so the edges need no special cases.
+    errors = [0] * (3 * (width + 2))
+    for y in range(height):
+        next_errors = [0] * len(errors)
+        i = y * stride
+        e = 3
+        for x in range(width):
+            r = pixels[i] + ((errors[e] + 8) >> 4)
+            g = pixels[i + 1] + ((errors[e + 1] + 8) >> 4)
+            b = pixels[i + 2] + ((errors[e + 2] + 8) >> 4)
+            r = 0 if r < 0 else 255 if r > 255 else r
+            g = 0 if g < 0 else 255 if g > 255 else g
+            b = 0 if b < 0 else 255 if b > 255 else b
+            color = colors[indexes[((r >> shift) << (2 * bits)) | ((g >> shift) << bits) | (b >> shift)]]
+            out[i:i + 3] = color
+
+            error = r - color[0]
+            errors[e + 3] += 7 * error
+            next_errors[e - 3] += 3 * error
+            next_errors[e] += 5 * error
+            next_errors[e + 3] += error
+            error = g - color[1]
+            errors[e + 4] += 7 * error
+            next_errors[e - 2] += 3 * error
+            next_errors[e + 1] += 5 * error
+            next_errors[e + 4] += error
+            error = b - color[2]
+            errors[e + 5] += 7 * error
+            next_errors[e - 1] += 3 * error
+            next_errors[e + 2] += 5 * error
+            next_errors[e + 5] += error
+
+            i += depth
+            e += 3
+        errors = next_errors
+    return out
+
+
+DITHERING = {
+    'none': lambda pixels, width, depth, table: remap(pixels, depth, table),
+    'ordered': dither_ordered,
+    'floyd-steinberg': dither_floyd_steinberg,
+}
+
+
+def quantize_image(image, table, dither='none'):
+    '''Replaces the pixels of the image by the nearest palette colors.'''
+    image.pixels = DITHERING[dither](image.pixels, image.width, image.depth, table)
+    return image
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Maps the colors of an image to the nearest colors of a palette',
+        epilog='Images are binary PPM (P6) or PAM (P7) with 8 bits per channel,'
+        ' and are written in the same format. The nearest palette color of'
+        ' each cell of the RGB cube is computed once per palette and saved.'
+        ' Palettes can be in any format known to convert_palettes.py.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-p', '--palette',
+        required=True,
+        help='Palette to map the colors to'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        default='-',
+        help='Image to write; - means stdout'
+    )
+    parser.add_argument(
+        '-d', '--dither',
+        choices=list(DITHERING),
+        default='none',
+        help='Dithering method'
+    )
+    parser.add_argument(
+        '--bits',
+        type=int,
+        choices=range(1, 9),
+        default=5,
+        metavar='{1..8}',
+        help='Bits per channel of the lookup table; 8 is exact, but takes'
+        ' 16 MB per palette and long to build the first time'
+    )
+    parser.add_argument(
+        '-s', '--space',
+        choices=SPACES,
+        default='rgb',
+        help='Color space where distances are measured'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIR',
+        default=os.path.join('.cache', 'quantize'),
+        help='Where the lookup tables are saved. Use an empty string to not'
+        ' save them'
+    )
+    parser.add_argument(
+        '--timings',
+        action='store_true',
+        help='Report the time spent and the throughput to stderr'
+    )
+    parser.add_argument(
+        'image',
+        nargs='?',
+        default='-',
+        help='Image to read; - means stdin'
+    )
+    options = parser.parse_args()
+    return options
+
+
+def main():
+    options = parse_args()
+
+    start = time.perf_counter()
+    try:
+        pal = read_palette(options.palette)
+        table = NearestColorTable.load_or_build(pal.rgb, options.bits, options.space, options.cache_dir)
+    except (OSError, ValueError) as e:
+        sys.exit(str(e))
+    table_seconds = time.perf_counter() - start
+
+    try:
+        if options.image == '-':
+            image = read_image(sys.stdin.buffer.read())
+        else:
+            with open(options.image, 'rb') as f:
+                image = read_image(f.read())
+    except (OSError, ImageError) as e:
+        sys.exit('{0}: {1}'.format(options.image, e))
+
+    start = time.perf_counter()
+    quantize_image(image, table, options.dither)
+    seconds = time.perf_counter() - start
+
+    if options.output == '-':
+        write_image(image, sys.stdout.buffer)
+    else:
+        with open(options.output, 'wb') as f:
+            write_image(image, f)
+
+    if options.timings:
+        megapixels = image.width * image.height / 1e6
+        sys.stderr.write('Lookup table: {0:.3f} s; {1:.2f} megapixels in {2:.3f} s: {3:.2f} Mpx/s\n'.format(
+            table_seconds, megapixels, seconds, megapixels / seconds if seconds else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+#
+# Finds duplicate and near-duplicate palettes among many palette files.
+#
+# Exact duplicates have the same set of colors, regardless of names and
+# order. Near duplicates are found by MinHash signatures over the colors
+# quantized to a few bits per channel, bucketed with locality-sensitive
+# hashing (LSH), so that only palettes sharing a bucket are compared.
+
+import argparse
+import glob
+import hashlib
+import json
+import os.path
+import random
+import sys
+from collections import defaultdict, namedtuple
+from itertools import combinations
+
+from gpl_to_html import expand_palette_sources, load_palette_source
+
+
+# A Mersenne prime, larger than any quantized color, for the universal hash
+# functions (a * x + b) % MERSENNE_PRIME used by MinHash.
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+Fingerprint = namedtuple('Fingerprint', 'filename name colors exact quantized signature')
+
+
+def hash_functions(count, seed=1):
+    '''Returns count (a, b) pairs, always the same ones for the same seed.'''
+    rng = random.Random(seed)
+    return [
+        (rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+        for _ in range(count)
+    ]
+
+
+def quantize_colors(rgb, bits=5):
+    '''Returns the set of colors of a packed RGB buffer, keeping only the
+    highest bits of each channel, packed into one integer.
+
+    >>> sorted(quantize_colors(bytes([255, 0, 0, 250, 1, 2, 0, 0, 0]), bits=1))
+    [0, 4]
+    '''
+    shift = 8 - bits
+    return {
+        (r >> shift) << (2 * bits) | (g >> shift) << bits | (b >> shift)
+        for r, g, b in zip(rgb[0::3], rgb[1::3], rgb[2::3])
+    }
+
+
+def minhash(values, functions):
+    '''Returns the MinHash signature of a non-empty set of integers.
+
+    The fraction of equal positions in two signatures estimates the Jaccard
+    similarity of the two sets.
+    '''
+    values = list(values)
+    return tuple(
+        min([(a * x + b) % MERSENNE_PRIME for x in values])
+        for a, b in functions
+    )
+
+
+def jaccard(a, b):
+    '''Jaccard similarity of two sets.
+
+    >>> jaccard({1, 2, 3}, {2, 3, 4})
+    0.5
+    '''
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def fingerprint_colors(filename, name, rgb, bits=5, num_hashes=64):
+    '''Returns the Fingerprint of a palette, given its colors as a packed
+    RGB buffer.
+    '''
+    rgb = bytes(rgb)
+    unique = sorted({rgb[i:i + 3] for i in range(0, len(rgb), 3)})
+    quantized = frozenset(quantize_colors(rgb, bits))
+    return Fingerprint(
+        filename=filename,
+        name=name,
+        colors=len(unique),
+        exact=hashlib.sha1(b''.join(unique)).hexdigest(),
+        quantized=quantized,
+        signature=minhash(quantized, hash_functions(num_hashes)) if quantized else None,
+    )
+
+
+def fingerprint_file(source, bits=5, num_hashes=64):
+    pal = load_palette_source(source)
+    return fingerprint_colors(pal.filename, pal.name, pal.rgb, bits, num_hashes)
+
+
+def fingerprint_manifest_entries(manifest, filenames, bits=5, num_hashes=64):
+    '''Returns {filename: Fingerprint} for the files that are in the
+    manifest (see palette_manifest.py), without reading them.
+    '''
+    names = manifest.names()
+    fingerprints = {}
+    for filename in filenames:
+        if isinstance(filename, str) and filename in names:
+            rgb = b''.join(value.to_bytes(3, 'big') for value in manifest.colors_of(filename))
+            fingerprints[filename] = fingerprint_colors(filename, names[filename], rgb, bits, num_hashes)
+    return fingerprints
+
+
+def fingerprint_files(filenames, bits=5, num_hashes=64, jobs=1, manifest=None):
+    '''Returns the Fingerprint of every palette. Those in the manifest, if
+    given, are taken from it; the others are read from their files.
+    '''
+    filenames = expand_palette_sources(filenames)
+    known = {}
+    if manifest is not None:
+        manifest.update([filename for filename in filenames if isinstance(filename, str)], jobs=jobs)
+        known = fingerprint_manifest_entries(manifest, filenames, bits, num_hashes)
+    missing = [filename for filename in filenames if not isinstance(filename, str) or filename not in known]
+
+    if jobs == 1 or len(missing) < 2:
+        read = [fingerprint_file(filename, bits, num_hashes) for filename in missing]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        jobs = jobs or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            read = list(executor.map(
+                fingerprint_file,
+                missing,
+                [bits] * len(missing),
+                [num_hashes] * len(missing),
+                chunksize=max(1, len(missing) // (4 * jobs)),
+            ))
+
+    read = iter(read)
+    return [
+        known[filename] if isinstance(filename, str) and filename in known else next(read)
+        for filename in filenames
+    ]
+
+
+def exact_duplicates(fingerprints):
+    '''Returns groups of palettes with exactly the same set of colors.'''
+    groups = defaultdict(list)
+    for fp in fingerprints:
+        if fp.colors:
+            groups[fp.exact].append(fp)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def near_duplicates(fingerprints, threshold=0.8, bands=16):
+    '''Returns (similarity, fingerprint, fingerprint) for pairs of palettes
+    whose quantized color sets have a Jaccard similarity of at least the
+    threshold, most similar first. Exact duplicates are left out.
+
+    Signatures are split into bands; only palettes sharing the whole of at
+    least one band are compared. More bands find less similar pairs, at the
+    cost of more comparisons.
+    '''
+    buckets = defaultdict(list)
+    for i, fp in enumerate(fingerprints):
+        if fp.signature is None:
+            continue
+        rows = len(fp.signature) // bands
+        for band in range(bands):
+            key = (band,) + fp.signature[band * rows:(band + 1) * rows]
+            buckets[key].append(i)
+
+    candidates = set()
+    for members in buckets.values():
+        candidates.update(combinations(members, 2))
+
+    pairs = []
+    for i, j in candidates:
+        a = fingerprints[i]
+        b = fingerprints[j]
+        if a.exact == b.exact:
+            continue
+        similarity = jaccard(a.quantized, b.quantized)
+        if similarity >= threshold:
+            pairs.append((similarity, a, b))
+    pairs.sort(key=lambda pair: (-pair[0], pair[1].filename, pair[2].filename))
+    return pairs
+
+
+def parse_args():
+    default_palettes = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'palettes', '*.gpl')
+    parser = argparse.ArgumentParser(
+        description='Finds duplicate and near-duplicate GIMP palettes',
+        epilog='Exact duplicates have the same set of colors. Near duplicates'
+        ' are found with MinHash and locality-sensitive hashing over colors'
+        ' quantized to a few bits per channel, without comparing every pair'
+        ' of palettes.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-t', '--threshold',
+        type=float,
+        default=0.8,
+        help='Minimum Jaccard similarity of the quantized color sets'
+    )
+    parser.add_argument(
+        '--bits',
+        type=int,
+        choices=range(1, 9),
+        default=5,
+        metavar='{1..8}',
+        help='Bits kept from each color channel before comparing'
+    )
+    parser.add_argument(
+        '--hashes',
+        type=int,
+        default=64,
+        help='Length of the MinHash signatures'
+    )
+    parser.add_argument(
+        '--bands',
+        type=int,
+        default=16,
+        help='LSH bands the signatures are split into'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Read palettes in this many processes (0 means one per CPU)'
+    )
+    parser.add_argument(
+        '--manifest',
+        metavar='FILE',
+        help='Take the colors of the palettes from this manifest (see'
+        ' palette_manifest.py), brought up to date first, instead of parsing'
+        ' every file'
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Write the report as JSON'
+    )
+    parser.add_argument(
+        'palettes',
+        nargs='*',
+        default=sorted(glob.glob(default_palettes)),
+        help='GIMP Palette files (*.gpl) or compiled collections (*.gplpack)'
+    )
+    options = parser.parse_args()
+    if options.bands < 1 or options.hashes % options.bands:
+        parser.error('--hashes must be a multiple of --bands')
+    return options
+
+
+def main():
+    options = parse_args()
+
+    manifest = None
+    if options.manifest:
+        from palette_manifest import PaletteManifest
+
+        manifest = PaletteManifest(options.manifest)
+    try:
+        fingerprints = fingerprint_files(
+            options.palettes,
+            bits=options.bits,
+            num_hashes=options.hashes,
+            jobs=options.jobs,
+            manifest=manifest,
+        )
+    finally:
+        if manifest is not None:
+            manifest.close()
+    exact = exact_duplicates(fingerprints)
+    near = near_duplicates(fingerprints, threshold=options.threshold, bands=options.bands)
+
+    if options.json:
+        json.dump({
+            'exact': [[fp.filename for fp in group] for group in exact],
+            'near': [
+                {'similarity': round(similarity, 4), 'palettes': [a.filename, b.filename]}
+                for similarity, a, b in near
+            ],
+        }, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    print('Exact duplicates (same set of colors):')
+    for group in exact:
+        print()
+        for fp in group:
+            print('  {0} ({1}, {2} colors)'.format(fp.filename, fp.name, fp.colors))
+    print()
+    print('Near duplicates (similarity of colors quantized to {0} bits):'.format(options.bits))
+    print()
+    for similarity, a, b in near:
+        print('  {0:.3f}  {1}  {2}'.format(similarity, a.filename, b.filename))
+
+
+if __name__ == '__main__':
+    main()
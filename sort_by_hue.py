@@ -1,25 +1,229 @@
 #!/usr/bin/env python3
 #
-# Reads a GPL palette file from stdin, outputs the palette with the colors
-# sorted. First all grayscale colors, then sorted by hue and lightness.
+# Sorts the colors of GIMP palettes. The header, comments and blank lines stay
+# where they are; only the color lines are reordered among themselves.
+#
+# Without file arguments, reads a palette from stdin and writes the sorted
+# palette to stdout. With --in-place, rewrites each given file, in parallel
+# with --jobs.
 
-from colorsys import rgb_to_hls
+import argparse
+import os
 import re
 import sys
 
+import colorspaces
+from gpl_to_html import GimpPalette
+
+
+# In a palette that was parsed successfully, only color lines start with a
+# number.
+_is_color_line = re.compile(rb'[ \t\r\f\v]*[-+]?[0-9]').match
+
+
+def _sorted_indexes(values, key):
+    keys = list(map(key, values))
+    return sorted(range(len(keys)), key=keys.__getitem__)
+
+
+def order_by_hue(pal):
+    '''All grayscale colors first, then by hue, lightness and saturation.'''
+    return _sorted_indexes(
+        colorspaces.convert_all('hls', pal.rgb),
+        lambda hls: (hls[2] != 0, hls[0], hls[1], hls[2]),
+    )
+
+
+def order_by_lightness(pal):
+    '''By HLS lightness, then hue.'''
+    return _sorted_indexes(
+        colorspaces.convert_all('hls', pal.rgb),
+        lambda hls: (hls[1], hls[0]),
+    )
+
+
+def order_by_saturation(pal):
+    '''By HLS saturation, then hue.'''
+    return _sorted_indexes(
+        colorspaces.convert_all('hls', pal.rgb),
+        lambda hls: (hls[2], hls[0]),
+    )
+
+
+def order_by_oklab(pal):
+    '''By OKLab perceptual lightness.'''
+    return _sorted_indexes(colorspaces.convert_all('oklab', pal.rgb), lambda lab: lab)
+
+
+def order_by_luminance(pal):
+    '''By relative luminance (the Y of CIE XYZ).'''
+    return _sorted_indexes(
+        colorspaces.convert_all('xyz', pal.rgb),
+        lambda xyz: xyz[1],
+    )
+
+
+def order_by_path(pal):
+    '''A path through OKLab, from the darkest color, always moving to the
+    nearest color not visited yet. Gives smooth gradients, but is much
+    slower than the other keys on large palettes.
+    '''
+    from nearest_color import UniformGrid
+
+    points = colorspaces.convert_all('oklab', pal.rgb)
+    if not points:
+        return []
+    grid = UniformGrid(points)
+    current = min(range(len(points)), key=points.__getitem__)
+    order = [current]
+    grid.remove(current)
+    while len(grid):
+        current = grid.nearest(points[current], k=1)[0][1]
+        order.append(current)
+        grid.remove(current)
+    return order
+
 
-colors = []
-for line in sys.stdin.readlines():
-    if match := re.match(r"^\s*([0-9]{,3})\s+([0-9]{,3})\s+([0-9]{,3})\s*", line):
-        h, l, s = rgb_to_hls(
-            int(match.group(1)) / 255,
-            int(match.group(2)) / 255,
-            int(match.group(3)) / 255,
-        )
-        colors.append((s != 0, h, l, s, line))
+SORT_KEYS = {
+    'hue': order_by_hue,
+    'lightness': order_by_lightness,
+    'saturation': order_by_saturation,
+    'oklab': order_by_oklab,
+    'luminance': order_by_luminance,
+    'path': order_by_path,
+}
+
+
+def sort_palette_data(data, key='hue', reverse=False, filename=None):
+    '''Returns the contents of a *.gpl file with the color lines sorted.
+
+    >>> print(sort_palette_data(
+    ...     b'GIMP Palette\\n# Grays last\\n255 0 0 Red\\n0 0 0 Black\\n'
+    ...     b'# Done\\n0 0 255 Blue\\n', key='luminance').decode(), end='')
+    GIMP Palette
+    # Grays last
+    0 0 0 Black
+    0 0 255 Blue
+    # Done
+    255 0 0 Red
+    '''
+    pal = GimpPalette.new_from_bytes(data, filename=filename)
+    order = SORT_KEYS[key](pal)
+    if reverse:
+        order.reverse()
+
+    lines = data.split(b'\n')
+    slots = [lineno for lineno in range(1, len(lines)) if _is_color_line(lines[lineno])]
+    color_lines = [lines[lineno] for lineno in slots]
+    for lineno, i in zip(slots, order):
+        lines[lineno] = color_lines[i]
+    return b'\n'.join(lines)
+
+
+def sort_palette_file(filename, key='hue', reverse=False):
+    '''Sorts a *.gpl file in place. Returns whether the file changed.'''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    sorted_data = sort_palette_data(data, key=key, reverse=reverse, filename=filename)
+    if sorted_data == data:
+        return False
+
+    # Writing to a temporary file first, so that an interrupted run never
+    # leaves a truncated palette behind.
+    temporary = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(sorted_data)
+    os.chmod(temporary, os.stat(filename).st_mode)
+    os.replace(temporary, filename)
+    return True
+
+
+def _sort_palette_file_star(args):
+    return sort_palette_file(*args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Sorts the colors of GIMP palettes',
+        epilog='Only the color lines are reordered; the header, comments and'
+        ' blank lines keep their positions. Without files, reads from stdin'
+        ' and writes to stdout.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-k', '--key',
+        choices=list(SORT_KEYS),
+        default='hue',
+        help='Sort order: ' + '; '.join(
+            '{0}: {1}'.format(name, ' '.join(func.__doc__.split()).rstrip('.'))
+            for name, func in SORT_KEYS.items()
+        ).replace('%', '%%')
+    )
+    parser.add_argument(
+        '-r', '--reverse',
+        action='store_true',
+        help='Reverse the order'
+    )
+    parser.add_argument(
+        '-i', '--in-place',
+        action='store_true',
+        help='Rewrite the given files instead of writing to stdout'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Sort files in this many processes (0 means one per CPU)'
+    )
+    parser.add_argument(
+        'palettes',
+        nargs='*',
+        help='GIMP Palette files (*.gpl)'
+    )
+    options = parser.parse_args()
+    if options.jobs < 0:
+        parser.error('--jobs must not be negative')
+    if options.in_place and not options.palettes:
+        parser.error('--in-place requires palette files')
+    for filename in options.palettes:
+        if options.in_place and not os.access(filename, os.W_OK):
+            parser.error("can't write to {0!r}".format(filename))
+    return options
+
+
+def main():
+    options = parse_args()
+
+    if not options.palettes:
+        sys.stdout.buffer.write(sort_palette_data(
+            sys.stdin.buffer.read(),
+            key=options.key,
+            reverse=options.reverse,
+            filename='<stdin>',
+        ))
+        return
+
+    if not options.in_place:
+        for filename in options.palettes:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            sys.stdout.buffer.write(sort_palette_data(
+                data, key=options.key, reverse=options.reverse, filename=filename))
+        return
+
+    tasks = [(filename, options.key, options.reverse) for filename in options.palettes]
+    if options.jobs == 1 or len(tasks) < 2:
+        changed = list(map(_sort_palette_file_star, tasks))
     else:
-        sys.stdout.write(line)
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=options.jobs or None) as executor:
+            changed = list(executor.map(_sort_palette_file_star, tasks))
+
+    for filename, was_changed in zip(options.palettes, changed):
+        if was_changed:
+            print('Sorted {0}'.format(filename))
+
 
-for row in sorted(colors):
-    line = row[-1]
-    sys.stdout.write(line)
+if __name__ == '__main__':
+    main()